@@ -0,0 +1,437 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+##
+#   End-to-end benchmark of the daemon: the real watcher.py is run in debug mode on a
+#   generated config, against a synthetic load written to a tmpfs directory.
+#
+#   Run `python benchmarks/bench_e2e.py [--quick] [-o results.json] [--compare old.json]`
+#   from the repository root. Scenarios:
+#     create  - files created at a steady rate: event-to-command-start latency
+#     spawn   - files created at once: commands started per second
+#     storm   - modifications at increasing rates: sustained events/s before the queue overflows
+#     tree    - deep trees of increasing size: startup time and RSS per 100k watches
+#     rename  - files renamed at once, paired by 'rename_wait': renames/s and latency
+#   The commands record when they start; their startup time (measured alone as
+#   `child_start_ms`) is included in the latencies.
+##
+
+import os
+import sys
+import json
+import socket
+import shutil
+import signal
+import argparse
+import platform
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+WATCHER = os.path.join(ROOT, 'watcher.py')
+sys.path.insert(0, ROOT)
+import watcher  # noqa: E402
+
+# appends "<filename> <start time>" to the marks file, bash giving the time without forking
+MARK_COMMAND = "bash -c 'echo \"$$1 $$EPOCHREALTIME\" >> {marks}' mark $filename"
+
+
+class Watcher(object):
+    """ watcher.py run in debug mode on a config generated for `jobs`, a list of (name, options). """
+    def __init__(self, workdir, jobs, engine='threaded'):
+        self.workdir = workdir
+        self.ini = os.path.join(workdir, 'watcher.ini')
+        self.spec = 'unix:' + os.path.join(workdir, 'metrics.sock')
+        lines = ['[DEFAULT]',
+                 'logfile=' + os.path.join(workdir, 'watcher.log'),
+                 'pidfile=' + os.path.join(workdir, 'watcher.pid'),
+                 'engine=' + engine,
+                 'metrics=' + self.spec]
+        for name, opts in jobs:
+            lines.append('[{0}]'.format(name))
+            lines.extend('{0}={1}'.format(key, value) for key, value in sorted(opts.items()))
+        with open(self.ini, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        self.process = None
+
+    def start(self, watches, timeout=600):
+        """ Start the daemon, return the seconds it took to watch `watches` directories. """
+        self.log = open(os.path.join(self.workdir, 'watcher.out'), 'ab')
+        start = time.time()
+        self.process = subprocess.Popen([sys.executable, WATCHER, '-c', self.ini, 'debug'],
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        self.wait(lambda: self.value('watcher_watches_total') >= watches, timeout, 0.01)
+        return time.time() - start
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        deadline = time.time() + 10
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.log.close()
+
+    def metrics(self):
+        """ Return the samples of the metrics endpoint, as {(name, labels): value}. """
+        family, address = watcher.metrics_address(self.spec)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(10)
+            sock.connect(address)
+            sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''.join(iter(lambda: sock.recv(65536), b''))
+        finally:
+            sock.close()
+        samples = {}
+        for line in response.partition(b'\r\n\r\n')[2].decode('utf-8').splitlines():
+            if line and not line.startswith('#'):
+                key, _, value = line.rpartition(' ')
+                name, _, labels = key.partition('{')
+                samples[(name, labels.rstrip('}'))] = float(value)
+        return samples
+
+    def value(self, name, job=None):
+        """ Return the sum of the samples of metric `name` (of `job` if set), 0 if it is not served yet. """
+        if self.process.poll() is not None:
+            raise RuntimeError("watcher exited, see {0}".format(os.path.join(self.workdir, 'watcher.out')))
+        try:
+            samples = self.metrics()
+        except (IOError, OSError):
+            return 0
+        label = 'job="{0}"'.format(job) if job else None
+        return sum(value for (key, labels), value in samples.items()
+                   if key == name and (label is None or label in labels.split(',')))
+
+    def wait(self, predicate, timeout, interval=0.05):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:
+                raise RuntimeError("timed out after {0}s, see {1}".format(
+                    timeout, os.path.join(self.workdir, 'watcher.out')))
+            time.sleep(interval)
+
+    def rss(self):
+        """ Return the resident memory of the daemon, in bytes. """
+        with open('/proc/{0}/status'.format(self.process.pid)) as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """ Return the nearest-rank percentiles of `values`, and their max, in milliseconds. """
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {'p{0}_ms'.format(point): round(1000 * values[min(len(values) - 1, len(values) * point // 100)], 3)
+              for point in points}
+    result['max_ms'] = round(1000 * values[-1], 3)
+    return result
+
+
+def read_marks(path):
+    """ Return {filename: start time} of the commands recorded in `path`. """
+    marks = {}
+    if os.path.exists(path):
+        with open(path) as fh:
+            for line in fh:
+                filename, _, started = line.rstrip('\n').rpartition(' ')
+                if filename and started:
+                    marks.setdefault(filename, float(started.replace(',', '.')))
+    return marks
+
+
+def wait_marks(path, count, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        marks = read_marks(path)
+        if len(marks) >= count:
+            return marks
+        time.sleep(0.05)
+    return read_marks(path)
+
+
+def write_files(paths, rate=None):
+    """ Create `paths`, `rate` per second (at once if None); return {path: time it was closed}. """
+    closed = {}
+    start = time.time()
+    for i, path in enumerate(paths):
+        if rate:
+            ahead = start + i / rate - time.time()
+            if ahead > 0:
+                time.sleep(ahead)
+        with open(path, 'wb') as fh:
+            fh.write(b'x')
+        closed[path] = time.time()
+    return closed
+
+
+def make_tree(top, count, fanout=8):
+    """ Create `count` directories under `top`, `fanout` per directory, breadth first (depth ~ log(count)). """
+    parents = [top]
+    created = 0
+    while created < count:
+        children = []
+        for parent in parents:
+            for i in range(fanout):
+                if created == count:
+                    break
+                path = os.path.join(parent, 'd{0}'.format(i))
+                os.mkdir(path)
+                children.append(path)
+                created += 1
+        parents = children
+
+
+def child_start(samples=20):
+    """ Median seconds from spawning the mark command to the time it records. """
+    delays = []
+    for _ in range(samples):
+        start = time.time()
+        output = subprocess.check_output(['bash', '-c', 'echo "$EPOCHREALTIME"'])
+        delays.append(float(output.decode('ascii').strip().replace(',', '.')) - start)
+    return sorted(delays)[len(delays) // 2]
+
+
+def mark_job(top, marks, **opts):
+    opts.update(watch=top, command=MARK_COMMAND.format(marks=marks), log_rate='100')
+    return opts
+
+
+def scenario_create(workdir, engine, args):
+    top = os.path.join(workdir, 'tree')
+    marks = os.path.join(workdir, 'marks')
+    os.mkdir(top)
+    daemon = Watcher(workdir, [('create', mark_job(top, marks, events='write_close', background='true'))], engine)
+    try:
+        daemon.start(1)
+        paths = [os.path.join(top, 'f{0}'.format(i)) for i in range(args.files)]
+        closed = write_files(paths, args.rate)
+        started = wait_marks(marks, len(paths), args.timeout)
+    finally:
+        daemon.stop()
+    result = {'files': len(paths), 'rate': args.rate, 'commands': len(started)}
+    result.update(percentiles([started[path] - closed[path] for path in started if path in closed]))
+    return result
+
+
+def scenario_spawn(workdir, engine, args):
+    top = os.path.join(workdir, 'tree')
+    marks = os.path.join(workdir, 'marks')
+    os.mkdir(top)
+    daemon = Watcher(workdir, [('spawn', mark_job(top, marks, events='write_close', background='true'))], engine)
+    try:
+        daemon.start(1)
+        paths = [os.path.join(top, 'f{0}'.format(i)) for i in range(args.files)]
+        closed = write_files(paths)
+        started = wait_marks(marks, len(paths), args.timeout)
+    finally:
+        daemon.stop()
+    elapsed = max(started.values()) - min(closed.values()) if started else 0
+    return {'files': len(paths), 'commands': len(started),
+            'spawns_per_s': round(len(started) / elapsed, 1) if elapsed else 0}
+
+
+def scenario_storm(workdir, engine, args):
+    """ Modify `args.storm_files` files round-robin (so that the kernel does not merge the events) at
+        increasing rates, until the queue overflows or the daemon falls behind. The events are filtered
+        out, measuring the intake of events rather than the commands.
+        """
+    top = os.path.join(workdir, 'tree')
+    os.mkdir(top)
+    fds = [os.open(os.path.join(top, 'f{0}'.format(i)), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+           for i in range(args.storm_files)]
+    daemon = Watcher(workdir, [('storm', {'watch': top, 'events': 'modify', 'include_glob': '*.none',
+                                          'command': 'true'})], engine)
+    steps = []
+    sustained = 0
+    try:
+        daemon.start(1)
+        rate = args.storm_rate
+        while rate <= args.storm_max_rate:
+            before = daemon.value('watcher_events_received_total')
+            overflows = daemon.value('watcher_queue_overflows_total')
+            written = 0
+            start = time.time()
+            while time.time() - start < args.storm_seconds:
+                # write in slices of 10ms to keep to the rate
+                due = int((time.time() - start + 0.01) * rate) - written
+                for _ in range(due):
+                    os.write(fds[written % len(fds)], b'x')
+                    written += 1
+                time.sleep(0.01)
+            achieved = written / (time.time() - start)
+            last = [-1]
+
+            def drained():
+                received = daemon.value('watcher_events_received_total')
+                done, last[0] = received == last[0], received
+                return done
+            daemon.wait(drained, args.timeout, 0.5)
+            received = last[0] - before
+            overflowed = daemon.value('watcher_queue_overflows_total') > overflows
+            steps.append({'rate': rate, 'written_per_s': round(achieved, 1), 'received': int(received),
+                          'written': written, 'overflowed': overflowed})
+            if overflowed or received < 0.99 * written:
+                break
+            sustained = achieved
+            rate *= 2
+    finally:
+        daemon.stop()
+        for fd in fds:
+            os.close(fd)
+    return {'sustained_events_per_s': round(sustained, 1), 'steps': steps}
+
+
+def scenario_tree(workdir, engine, args):
+    limit = watcher.WatchBudget().limit
+    results = []
+    baseline = None
+    for size in [0] + args.tree_sizes:
+        if limit and size > 0.9 * limit:
+            results.append({'dirs': size, 'skipped': 'fs.inotify.max_user_watches is {0}'.format(limit)})
+            continue
+        top = os.path.join(workdir, 'tree{0}'.format(size))
+        os.mkdir(top)
+        make_tree(top, size)
+        daemon = Watcher(workdir, [('tree', {'watch': top, 'events': 'create', 'command': 'true',
+                                             'overflow_rescan': 'false'})], engine)
+        try:
+            startup = daemon.start(size + 1, args.timeout)
+            rss = daemon.rss()
+        finally:
+            daemon.stop()
+            shutil.rmtree(top)
+        if baseline is None:
+            baseline = rss
+            continue
+        results.append({'dirs': size, 'startup_s': round(startup, 3), 'rss_mb': round(rss / 1048576, 1),
+                        'rss_mb_per_100k_watches': round((rss - baseline) / 1048576 * 100000 / size, 1)})
+    return {'baseline_rss_mb': round(baseline / 1048576, 1), 'sizes': results}
+
+
+def scenario_rename(workdir, engine, args):
+    top = os.path.join(workdir, 'tree')
+    marks = os.path.join(workdir, 'marks')
+    os.mkdir(top)
+    sources = [os.path.join(top, 'f{0}'.format(i)) for i in range(args.files)]
+    write_files(sources)
+    daemon = Watcher(workdir, [('rename', mark_job(top, marks, events='move', rename_wait='1',
+                                                   background='true'))], engine)
+    try:
+        daemon.start(1)
+        renamed = {}
+        for i, source in enumerate(sources):
+            target = os.path.join(top, 'r{0}'.format(i))
+            os.rename(source, target)
+            renamed[target] = time.time()
+        started = wait_marks(marks, len(sources), args.timeout)
+        # unpaired moves would show up as marks of the former names
+        time.sleep(1.5)
+        started = read_marks(marks)
+    finally:
+        daemon.stop()
+    paired = [path for path in started if path in renamed]
+    elapsed = max(started[path] for path in paired) - min(renamed.values()) if paired else 0
+    result = {'files': len(sources), 'commands': len(started), 'paired': len(paired),
+              'renames_per_s': round(len(paired) / elapsed, 1) if elapsed else 0}
+    result.update(percentiles([started[path] - renamed[path] for path in paired]))
+    return result
+
+
+SCENARIOS = [('create', scenario_create), ('spawn', scenario_spawn), ('storm', scenario_storm),
+             ('tree', scenario_tree), ('rename', scenario_rename)]
+
+
+def flatten(results, prefix=''):
+    """ Return {'scenario.key': number} of the numbers of `results`, for comparisons. """
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                if isinstance(item, dict):
+                    label = item.get('dirs', item.get('rate', i))
+                    flat.update(flatten(item, '{0}[{1}].'.format(name, label)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(old, new):
+    old, new = flatten(old['results']), flatten(new['results'])
+    for name in sorted(set(old) & set(new)):
+        change = (new[name] - old[name]) / old[name] * 100 if old[name] else 0
+        print("{0:<50} {1:>14,.3f} {2:>14,.3f} {3:>+8.1f}%".format(name, old[name], new[name], change),
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the daemon end to end against a synthetic load.')
+    parser.add_argument('--dir', default='/dev/shm' if os.path.isdir('/dev/shm') else None,
+                        help='directory (tmpfs) of the generated trees (default: %(default)s)')
+    parser.add_argument('--engine', default='threaded', help='engine of the daemon (default: %(default)s)')
+    parser.add_argument('--scenarios', default=','.join(name for name, _ in SCENARIOS),
+                        help='comma separated scenarios to run (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=2000, help='files of create, spawn and rename (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=200, help='files created per second by create (default: %(default)s)')
+    parser.add_argument('--storm-files', type=int, default=1000, help='files modified by storm (default: %(default)s)')
+    parser.add_argument('--storm-rate', type=float, default=5000, help='first rate of storm (default: %(default)s)')
+    parser.add_argument('--storm-max-rate', type=float, default=640000, help='last rate of storm (default: %(default)s)')
+    parser.add_argument('--storm-seconds', type=float, default=2, help='seconds of each rate of storm (default: %(default)s)')
+    parser.add_argument('--tree-sizes', default='1000,10000,40000', help='directories of the trees (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for each step (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true', help='run smaller loads')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file (default: stdout)')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+    if args.quick:
+        args.files = min(args.files, 300)
+        args.storm_seconds = min(args.storm_seconds, 1)
+        args.tree_sizes = '1000,5000'
+    args.tree_sizes = [int(size) for size in args.tree_sizes.split(',') if size]
+
+    results = {}
+    for name, scenario in SCENARIOS:
+        if name not in args.scenarios.split(','):
+            continue
+        workdir = tempfile.mkdtemp(prefix='watcher-bench-', dir=args.dir)
+        try:
+            start = time.time()
+            results[name] = scenario(workdir, args.engine, args)
+            print("{0:>8}: {1} ({2:.1f}s)".format(name, json.dumps(results[name], sort_keys=True),
+                                                  time.time() - start), file=sys.stderr)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'kernel': platform.release(),
+                       'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                       'engine': args.engine,
+                       'child_start_ms': round(1000 * child_start(), 3),
+                       'args': {key: value for key, value in vars(args).items()
+                                if key not in ('output', 'compare')}},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(json.load(fh), report)
+
+
+if __name__ == "__main__":
+    main()
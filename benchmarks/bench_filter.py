@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+##
+#   Micro-benchmark of the compiled file filters of a job.
+#
+#   Run `python benchmarks/bench_filter.py [-n EVENTS]` from the repository root.
+##
+
+import os
+import sys
+import re
+import argparse
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import watcher  # noqa: E402
+
+NAMES = ('movie', 'episode.s01e02', 'holiday', 'notes', 'backup', 'IMG_2041', 'track01', '.hidden')
+EXTENSIONS = ('.mkv', '.avi', '.mp4', '.txt', '.part', '.jpg', '.srt', '.mp3', '~', '.nfo')
+
+
+def synthetic_paths(count, seed=0):
+    """ Pathnames spread over a few directories, names and extensions. """
+    rnd = random.Random(seed)
+    dirs = ['/srv/media/{0}/{1}'.format(rnd.choice(('tv', 'movies', 'incoming')), i) for i in range(64)]
+    return ['{0}/{1}{2}'.format(rnd.choice(dirs), rnd.choice(NAMES), rnd.choice(EXTENSIONS))
+            for _ in range(count)]
+
+
+def legacy_filter(include_extensions, exclude_extensions, exclude_re):
+    """ The filters as they were checked for each event before being compiled. """
+    exclude_re = re.compile(exclude_re)
+
+    def accepts(pathname):
+        if include_extensions and all(not pathname.endswith(ext) for ext in include_extensions):
+            return False
+        if exclude_extensions and any(pathname.endswith(ext) for ext in exclude_extensions):
+            return False
+        if exclude_re and exclude_re.search(os.path.basename(pathname)):
+            return False
+        return True
+    return accepts
+
+
+def run(name, accepts, paths):
+    start = time.time()
+    accepted = sum(1 for pathname in paths if accepts(pathname))
+    elapsed = time.time() - start
+    print("{0:>10}: {1:>12,.0f} events/s ({2} of {3} accepted, {4:.3f}s)".format(
+        name, len(paths) / elapsed, accepted, len(paths), elapsed))
+    return accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the events/s the file filters of a job can handle.')
+    parser.add_argument('-n', '--events', type=int, default=1000000, help='number of synthetic events (default: %(default)s)')
+    args = parser.parse_args()
+
+    include_extensions = set(watcher.VIDEO_EXTENSIONS)
+    exclude_extensions = set(['.part'])
+    exclude_re = r'^\.'
+
+    paths = synthetic_paths(args.events)
+    legacy = run('legacy', legacy_filter(include_extensions, exclude_extensions, exclude_re), paths)
+    compiled = run('compiled', watcher.compile_filter(include_extensions=include_extensions,
+                                                      exclude_extensions=exclude_extensions,
+                                                      exclude_re=exclude_re), paths)
+    if legacy != compiled:
+        sys.exit("compiled filter accepted {0} events instead of {1}".format(compiled, legacy))
+
+
+if __name__ == "__main__":
+    main()
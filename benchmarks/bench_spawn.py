@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+##
+#   Micro-benchmark of the preparation and the start of the commands of a job.
+#
+#   Run `python benchmarks/bench_spawn.py [-n COMMANDS] [--command COMMAND]` from the repository root.
+##
+
+import os
+import sys
+import string
+import shlex
+import argparse
+import subprocess
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import watcher  # noqa: E402
+
+FIELDS = {'job': 'job1',
+          'folder': '/srv/media',
+          'watched': '/srv/media/tv/1',
+          'filename': "/srv/media/tv/1/It's an episode.mkv",
+          'filenames': ["/srv/media/tv/1/It's an episode.mkv"],
+          'tflags': 'IN_CLOSE_WRITE',
+          'nflags': 8,
+          'cookie': 0}
+
+
+def legacy_prepare(command, fields):
+    """ The argv as it was built for each event before the command was compiled. """
+    t = string.Template(command)
+    return shlex.split(t.substitute(job=watcher.shellquote(fields['job']),
+                                    folder=watcher.shellquote(fields['folder']),
+                                    watched=watcher.shellquote(fields['watched']),
+                                    filename=watcher.shellquote(fields['filename']),
+                                    filenames=' '.join(watcher.shellquote(p) for p in fields['filenames']),
+                                    tflags=watcher.shellquote(fields['tflags']),
+                                    nflags=watcher.shellquote(fields['nflags']),
+                                    cookie=watcher.shellquote(fields['cookie'])))
+
+
+def legacy_spawn(args):
+    return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def run(name, what, count, step):
+    start = time.time()
+    for _ in range(count):
+        step()
+    elapsed = time.time() - start
+    print("{0:>10}: {1:>12,.0f} {2}/s ({3} in {4:.3f}s)".format(name, count / elapsed, what, count, elapsed))
+
+
+def wait(spawn, args):
+    def step():
+        process = spawn(args)
+        process.stdout.read()
+        process.stdout.close()
+        process.wait()
+    return step
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the commands/s a job can prepare and start.')
+    parser.add_argument('-n', '--commands', type=int, default=2000, help='number of commands started (default: %(default)s)')
+    parser.add_argument('--command', default='/bin/true $filename $tflags',
+                        help='command of the job (default: %(default)s)')
+    args = parser.parse_args()
+
+    template = watcher.CommandTemplate(args.command)
+    if template.fill(FIELDS) != legacy_prepare(args.command, FIELDS):
+        sys.exit("compiled command gives {0!r} instead of {1!r}".format(template.fill(FIELDS),
+                                                                        legacy_prepare(args.command, FIELDS)))
+
+    run('legacy', 'prepares', args.commands * 50, lambda: legacy_prepare(args.command, FIELDS))
+    run('compiled', 'prepares', args.commands * 50, lambda: template.fill(FIELDS))
+    argv = template.fill(FIELDS)
+    run('popen', 'spawns', args.commands, wait(legacy_spawn, argv))
+    run('spawn', 'spawns', args.commands, wait(watcher.spawn_command, argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import watcher  # noqa: E402
+
+
+def make_event(pathname, mask, cookie=0, isdir=False):
+    """ A pyinotify event of `pathname`, as the notifier builds it. """
+    path, name = os.path.split(pathname)
+    return watcher.pyinotify.Event({'wd': 1, 'mask': mask, 'path': path, 'name': name, 'dir': isdir,
+                                    'cookie': cookie})
+
+
+def make_config(text):
+    """ A config read from `text`, as by `watcher.read_config`. """
+    config = watcher.configparser.ConfigParser(watcher.CONFIG_DEFAULTS, allow_no_value=True)
+    config.read_string(text)
+    return config
+
+
+@pytest.fixture
+def handlers():
+    """ Build the `EventHandler` of a job (section `job`) from its options, and close it after the test. """
+    built = []
+    scheduler = watcher.Scheduler(None)
+    reaper = watcher.Reaper(scheduler)
+
+    def build(runner=None, job='job', **options):
+        options.setdefault('watch', '/t')
+        options.setdefault('events', 'all')
+        options.setdefault('command', 'true $filename')
+        options.setdefault('overflow_rescan', 'false')
+        config = make_config('[{0}]\n'.format(job) +
+                             ''.join('{0}={1}\n'.format(key, value) for key, value in options.items()))
+        handler = watcher.make_handler(config, job, scheduler, reaper, runner)
+        built.append(handler)
+        return handler
+    yield build
+    for handler in built:
+        handler.close()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+from conftest import make_event
+import watcher
+
+IN_CLOSE_WRITE = watcher.pyinotify.IN_CLOSE_WRITE
+
+
+def submitted_by(handler):
+    """ The (argv, stdin) of the background commands of `handler`, taken from its scheduler. """
+    submitted = []
+    handler.opts['scheduler'].submit = lambda handler, key, args, command, stdindata, event: submitted.append(
+        (args, stdindata))
+    return submitted
+
+
+def wait_for(submitted, count):
+    deadline = time.time() + 5
+    while len(submitted) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return submitted
+
+
+def test_runs_a_batch_once_it_holds_batch_size_files(handlers):
+    handler = handlers(background='true', batch_size='3', batch_wait='60', command='true $filenames')
+    submitted = submitted_by(handler)
+    for name in ('a', 'b', 'a', 'c', 'd'):
+        handler.dispatch(make_event('/t/' + name, IN_CLOSE_WRITE), "Close write")
+    assert wait_for(submitted, 1) == [(['true', '/t/a', '/t/b', '/t/c'], None)]
+    assert handler.batcher.coalesced == 1
+    # the last files are run at close
+    handler.close()
+    assert submitted[1:] == [(['true', '/t/d'], None)]
+
+
+def test_runs_a_batch_batch_wait_seconds_after_its_first_file(handlers):
+    handler = handlers(background='true', batch_size='100', batch_wait='0.1', command='true --files=$filenames')
+    submitted = submitted_by(handler)
+    start = time.time()
+    handler.dispatch(make_event('/t/a', IN_CLOSE_WRITE), "Close write")
+    handler.dispatch(make_event('/t/b c', IN_CLOSE_WRITE), "Close write")
+    assert wait_for(submitted, 1) == [(['true', '--files=/t/a', '/t/b c'], None)]
+    assert time.time() - start >= 0.1
+
+
+def test_passes_the_files_of_large_batches_on_stdin(handlers):
+    handler = handlers(background='true', batch_size='3', batch_wait='60', batch_stdin='2',
+                       command='xargs -0 true $filenames')
+    submitted = submitted_by(handler)
+    for name in ('a', 'b', 'c', 'd', 'e'):
+        handler.dispatch(make_event('/t/' + name, IN_CLOSE_WRITE), "Close write")
+    handler.close()
+    assert submitted == [(['xargs', '-0', 'true'], b'/t/a\0/t/b\0/t/c\0'),
+                         (['xargs', '-0', 'true', '/t/d', '/t/e'], None)]
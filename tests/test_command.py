@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import shlex
+import string
+
+import pytest
+
+from conftest import make_event
+import watcher
+
+FIELDS = {'job': 'job1',
+          'folder': '/t',
+          'watched': '/t/a b',
+          'filename': "/t/a b;touch /tmp/PWNED",
+          'filenames': ["/t/it's", '/t/a b'],
+          'tflags': 'IN_CLOSE_WRITE',
+          'nflags': 8,
+          'cookie': 0,
+          'src': '',
+          'dst': ''}
+
+
+def shell_split(command, fields):
+    """ The argv of `command` as split with the values shell-quoted, for each event. """
+    quoted = dict((name, watcher.shellquote(value)) for name, value in fields.items() if name != 'filenames')
+    quoted['filenames'] = ' '.join(watcher.shellquote(pathname) for pathname in fields['filenames'])
+    return shlex.split(string.Template(command).substitute(quoted))
+
+
+@pytest.mark.parametrize('command', [
+    'true $filename $tflags',
+    'true ${filename} --flags=$nflags $$',
+    'true $filenames',
+    'true --files=$filenames',
+    'sh -c "echo $filename"',
+    "sh -c 'echo $filename'",
+    'true "$filename" a\\ b',
+])
+def test_fills_the_values_as_if_shell_quoted(command):
+    assert watcher.CommandTemplate(command).fill(FIELDS) == shell_split(command, FIELDS)
+
+
+def test_keeps_the_values_quoted_inside_quotes():
+    argv = watcher.CommandTemplate('sh -c "echo $filename"').fill(FIELDS)
+    assert argv == ['sh', '-c', "echo '/t/a b;touch /tmp/PWNED'"]
+
+
+def test_compiles_the_lines_without_quotes_once():
+    template = watcher.CommandTemplate('true $filename --job=$job')
+    assert template.template is None
+    assert template.fill(FIELDS) == ['true', '/t/a b;touch /tmp/PWNED', '--job=job1']
+
+
+@pytest.mark.parametrize('command', ['', 'true $unknown', 'sh -c "echo $unknown"', 'sh -c "unbalanced'])
+def test_rejects_invalid_commands(command):
+    with pytest.raises((ValueError, KeyError)):
+        watcher.CommandTemplate(command)
+
+
+def test_logs_the_values_unbalancing_the_quotes_and_finishes_their_command(tmpdir, handlers):
+    directory = str(tmpdir.join('journal'))
+    handler = handlers(command="sh -c 'echo $filename'", journal=directory)
+    handler.recover_journal()
+    handler.execute(make_event("/t/it's", watcher.pyinotify.IN_CLOSE_WRITE))
+    handler.journal.close()
+    journal = watcher.Journal(directory)
+    assert journal.recover() == []
+    journal.close()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+from conftest import make_event
+import watcher
+
+IN_MODIFY = watcher.pyinotify.IN_MODIFY
+IN_ATTRIB = watcher.pyinotify.IN_ATTRIB
+
+
+def executed_by(handler):
+    executed = []
+    handler.execute = lambda event: executed.append((time.time(), event.pathname, event.mask))
+    return executed
+
+
+def test_coalesces_the_events_of_a_path_until_it_is_quiet(handlers):
+    handler = handlers(debounce='0.1')
+    executed = executed_by(handler)
+    for mask in (IN_MODIFY, IN_ATTRIB, IN_MODIFY):
+        handler.dispatch(make_event('/t/a', mask), "Event")
+    handler.dispatch(make_event('/t/b', IN_MODIFY), "Event")
+    assert executed == []
+    time.sleep(0.3)
+    assert [(pathname, mask) for (when, pathname, mask) in executed] == [('/t/a', IN_MODIFY | IN_ATTRIB),
+                                                                         ('/t/b', IN_MODIFY)]
+    assert handler.debouncer.coalesced == 2
+
+
+def test_runs_a_path_never_quiet_every_max_wait(handlers):
+    handler = handlers(debounce='0.2', debounce_max_wait='0.3')
+    executed = executed_by(handler)
+    start = time.time()
+    while time.time() - start < 1:
+        handler.dispatch(make_event('/t/a', IN_MODIFY), "Event")
+        time.sleep(0.02)
+    # run during the storm, but not more often than every max wait
+    times = [start] + [when for (when, pathname, mask) in executed]
+    assert 2 <= len(executed) <= 4
+    assert all(later - earlier >= 0.25 for (earlier, later) in zip(times, times[1:]))
+
+
+def test_keeps_the_masks_apart_with_debounce_per_mask(handlers):
+    handler = handlers(debounce='0.05', debounce_per_mask='true')
+    executed = executed_by(handler)
+    for mask in (IN_MODIFY, IN_ATTRIB, IN_MODIFY):
+        handler.dispatch(make_event('/t/a', mask), "Event")
+    handler.close()
+    assert sorted((pathname, mask) for (when, pathname, mask) in executed) == [('/t/a', IN_MODIFY),
+                                                                              ('/t/a', IN_ATTRIB)]
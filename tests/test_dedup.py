@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+
+from conftest import make_event
+import watcher
+
+IN_CLOSE_WRITE = watcher.pyinotify.IN_CLOSE_WRITE
+
+
+def write(pathname, data):
+    with open(pathname, 'w') as fh:
+        fh.write(data)
+
+
+def deduplicated(handlers, **options):
+    """ A job skipping unchanged files, whose commands succeed unless `failing` holds their file. """
+    handler = handlers(dedup='true', **options)
+    handler.executed = []
+    handler.failing = set()
+
+    def execute(event):
+        handler.executed.append(event.pathname)
+        handler.finished(event, succeeded=event.pathname not in handler.failing)
+    handler.execute = execute
+    return handler
+
+
+def test_skips_the_files_whose_contents_did_not_change(tmpdir, handlers):
+    pathname = str(tmpdir.join('a'))
+    handler = deduplicated(handlers)
+    write(pathname, 'one')
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    # written again with the same contents
+    write(pathname, 'one')
+    os.utime(pathname, (0, 0))
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    assert handler.executed == [pathname]
+    write(pathname, 'two')
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    assert handler.executed == [pathname] * 2
+    assert (handler.dedup.hits, handler.dedup.misses) == (2, 2)
+
+
+def test_runs_again_the_files_whose_command_failed(tmpdir, handlers):
+    pathname = str(tmpdir.join('a'))
+    handler = deduplicated(handlers)
+    handler.failing.add(pathname)
+    write(pathname, 'one')
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    handler.failing.clear()
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    assert handler.executed == [pathname] * 3
+
+
+def test_keeps_the_digests_in_dedup_file(tmpdir, handlers):
+    pathnames = [str(tmpdir.join(name)) for name in ('a', 'b')]
+    dedup_file = str(tmpdir.join('dedup'))
+    handler = deduplicated(handlers, dedup_file=dedup_file)
+    for pathname in pathnames:
+        write(pathname, 'one')
+        handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    handler.save_state()
+    write(pathnames[1], 'two')
+    handler = deduplicated(handlers, dedup_file=dedup_file)
+    for pathname in pathnames:
+        handler.submit(make_event(pathname, IN_CLOSE_WRITE))
+    assert handler.executed == pathnames[1:]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+from conftest import make_event
+import watcher
+
+IN_CLOSE_WRITE = watcher.pyinotify.IN_CLOSE_WRITE
+
+
+def posted_by(monkeypatch):
+    """ The (output, stdin) of the post actions run. """
+    posted = []
+    monkeypatch.setattr(watcher, 'post_action', lambda cmd, job, output, runner=None, stdindata=None: posted.append(
+        (output, stdindata)))
+    return posted
+
+
+def wait_for(posted, count):
+    deadline = time.time() + 5
+    while len(posted) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return posted
+
+
+def fail(handler, name, returncode):
+    watcher.post_outcome(handler.opts, 'action_on_failure', 'error of {0}\n'.format(name).encode('utf-8'),
+                         make_event('/t/' + name, IN_CLOSE_WRITE), returncode=returncode)
+
+
+def test_runs_the_action_once_with_a_summary_and_the_list_on_stdin(monkeypatch, handlers):
+    posted = posted_by(monkeypatch)
+    handler = handlers(action_on_failure='notify $output', digest='0.2')
+    for (name, returncode) in (('a', 1), ('b', 2), ('c', 1)):
+        fail(handler, name, returncode)
+    assert posted == []
+    [(summary, stdindata)] = wait_for(posted, 1)
+    assert summary.startswith(b'3 commands failed from ')
+    assert summary.endswith(b' (return codes: 1 x2, 2 x1)')
+    lines = stdindata.decode('utf-8').splitlines()
+    assert [line.split(' ', 2)[2] for line in lines[::2]] == ['/t/a (return code 1)', '/t/b (return code 2)',
+                                                               '/t/c (return code 1)']
+    assert lines[1::2] == ['    error of a', '    error of b', '    error of c']
+
+
+def test_runs_the_action_at_digest_size(monkeypatch, handlers):
+    posted = posted_by(monkeypatch)
+    handler = handlers(action_on_failure='notify $output', digest='60', digest_size='2')
+    for name in ('a', 'b'):
+        fail(handler, name, 1)
+    assert len(wait_for(posted, 1)) == 1
+    # a single outcome gets its own output
+    fail(handler, 'c', 1)
+    handler.close()
+    assert posted[1][0] == b'error of c\n'
+
+
+def test_runs_the_action_for_the_first_outcome_at_once_with_digest_first(monkeypatch, handlers):
+    posted = posted_by(monkeypatch)
+    handler = handlers(action_on_failure='notify $output', digest='0.3', digest_first='true')
+    start = time.time()
+    fail(handler, 'a', 1)
+    assert wait_for(posted, 1)[0][0] == b'error of a\n'
+    assert time.time() - start < 0.2
+    for name in ('b', 'c'):
+        fail(handler, name, 1)
+    wait_for(posted, 2)
+    assert time.time() - start >= 0.3
+    assert [output.split(b' from ')[0] for (output, stdindata) in posted] == [b'error of a\n', b'2 commands failed']
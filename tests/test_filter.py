@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import itertools
+import os
+import re
+
+import pytest
+
+import watcher
+
+PATHNAMES = ['/t/a.mp4', '/t/a.MP4', '/t/a.mkv', '/t/.a.mkv.part', '/t/b.txt', '/t/sub.mp4/c', '/t/tmp_d.mkv',
+             '/t/x.mp4.tmp', '/t/e']
+
+
+def former_filter(pathname, include_extensions, exclude_extensions, exclude_re):
+    """ The checks of the events done by watcher before the filters were compiled. """
+    if include_extensions and all(not pathname.endswith(ext) for ext in include_extensions):
+        return False
+    if exclude_extensions and any(pathname.endswith(ext) for ext in exclude_extensions):
+        return False
+    if exclude_re and re.compile(exclude_re).search(os.path.basename(pathname)):
+        return False
+    return True
+
+
+@pytest.mark.parametrize('include_extensions,exclude_extensions,exclude_re', list(itertools.product(
+    [None, ['.mp4'], ['.mp4', '.mkv']], [None, ['.part'], ['.mkv', '.tmp']], [None, '^tmp_', r'\.part$|^x'])))
+def test_accepts_the_files_the_former_checks_accepted(include_extensions, exclude_extensions, exclude_re):
+    accepts = watcher.compile_filter(include_extensions, exclude_extensions, exclude_re=exclude_re)
+    for pathname in PATHNAMES:
+        assert accepts(pathname) == former_filter(pathname, include_extensions, exclude_extensions, exclude_re), \
+            pathname
+
+
+def test_matches_the_globs_and_include_re_on_the_file_name():
+    accepts = watcher.compile_filter(include_re=r'^a\.', include_glob=['*.txt'], exclude_glob=['*.MP4'])
+    assert [pathname for pathname in PATHNAMES if accepts(pathname)] == ['/t/a.mp4', '/t/a.mkv', '/t/b.txt']
+
+
+DIRS = ['/t', '/t/cache', '/t/cache/a', '/t/cached', '/t/a/cache', '/t/a/.git', '/t/b/.git/objects']
+
+
+@pytest.mark.parametrize('excluded', [None, ['/t/cache'], ['/t/cache/', '/t/a']])
+def test_excludes_the_dirs_the_former_prefixes_excluded(excluded):
+    is_excluded = watcher.compile_exclusion(excluded)
+    assert [path for path in DIRS if is_excluded(path)] == [
+        path for path in DIRS if excluded and any(path.startswith(prefix) for prefix in excluded)]
+
+
+def test_excludes_the_dirs_matching_globs_and_excluded_re():
+    is_excluded = watcher.compile_exclusion(['/t/*/.git'], excluded_re=r'/cache$')
+    # the subdirectories of an excluded dir are not walked
+    assert [path for path in DIRS if is_excluded(path)] == ['/t/cache', '/t/a/cache', '/t/a/.git']
+
+
+def test_does_not_watch_the_excluded_dirs(tmpdir):
+    top = str(tmpdir)
+    for path in ('a', 'a/b', 'cache', 'cache/c', 'd'):
+        os.mkdir(os.path.join(top, path))
+    wm = watcher.watch_manager()
+    wdd = watcher.watch_tree(wm, top, watcher.pyinotify.IN_CREATE, rec=True,
+                             exclude_filter=watcher.compile_exclusion([os.path.join(top, 'cache')]))
+    assert sorted(wdd) == [top] + [os.path.join(top, path) for path in ('a', 'a/b', 'd')]
+    assert len(wm.watches) == 4
+    wm.close()
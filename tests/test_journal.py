@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+from conftest import make_event
+import watcher
+
+IN_CLOSE_WRITE = watcher.pyinotify.IN_CLOSE_WRITE
+
+
+def reopen(directory):
+    journal = watcher.Journal(directory)
+    return journal, journal.recover()
+
+
+def test_recovering_twice_counts_the_interrupted_attempts(tmpdir):
+    directory = str(tmpdir.join('journal'))
+    journal, entries = reopen(directory)
+    id = journal.add(watcher.dump_event(make_event('/t/a', IN_CLOSE_WRITE)))
+    journal.retry(id, 2)
+    journal.close()
+    journal, entries = reopen(directory)
+    assert [(entry[0], entry[2]) for entry in entries] == [(id, 2)]
+    journal.close()
+    journal, entries = reopen(directory)
+    assert [(entry[0], entry[2]) for entry in entries] == [(id, 3)]
+    journal.done(id)
+    journal.close()
+    journal, entries = reopen(directory)
+    assert entries == []
+    journal.close()
+
+
+def test_gives_up_the_commands_interrupted_beyond_max_attempts(tmpdir, handlers):
+    directory = str(tmpdir.join('journal'))
+    journal, entries = reopen(directory)
+    journal.add(watcher.dump_event(make_event('/t/a', IN_CLOSE_WRITE)))
+    journal.add(watcher.dump_event(make_event('/t/b', IN_CLOSE_WRITE)), attempt=2)
+    journal.close()
+    for expected in ([('/t/a', 1), ('/t/b', 2)], [('/t/a', 2)], []):
+        handler = handlers(journal=directory, max_attempts='2')
+        executed = []
+        handler.execute = lambda event: executed.append((event.pathname, event.attempt))
+        handler.recover_journal()
+        deadline = time.time() + 5
+        while len(executed) < len(expected) and time.time() < deadline:
+            time.sleep(0.01)
+        assert executed == expected
+        handler.journal.close()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import watcher
+
+
+def capture(**opts):
+    return watcher.OutputCapture(dict({'output_limit': 10, 'log_output': False, 'outfile': None}, **opts))
+
+
+def test_keeps_the_whole_output_within_the_limit():
+    output = capture()
+    for chunk in (b'0123', b'4567', b'89'):
+        output.write(chunk)
+    assert output.output() == b'0123456789'
+
+
+def test_keeps_a_bounded_head_and_tail_of_a_long_output():
+    output = capture()
+    for i in range(100):
+        output.write('{0:02d}|'.format(i).encode('ascii'))
+        assert len(output.head) <= 5 and len(output.tail) <= 2 * 5
+    assert output.total == 300
+    assert output.output() == b'00|01\n[... 290 bytes skipped ...]\n8|99|'
+
+
+def test_writes_the_whole_output_to_outfile(tmpdir):
+    outfile = tmpdir.join('out')
+    output = capture(log_output=True, outfile=str(outfile))
+    for i in range(100):
+        output.write(b'0123456789')
+    output.close()
+    assert outfile.read_binary() == b'0123456789' * 100
+    assert output.output() == b'01234\n[... 990 bytes skipped ...]\n56789'
+
+
+def test_keeps_everything_without_output_limit():
+    output = capture(output_limit=0)
+    for i in range(100):
+        output.write(b'0123456789')
+    assert output.output() == b'0123456789' * 100
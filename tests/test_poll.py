@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import time
+
+import watcher
+
+
+def wait_for(dispatched, count):
+    deadline = time.time() + 5
+    while len(dispatched) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return dispatched
+
+
+def test_polls_the_changes_of_a_local_directory(tmpdir, handlers):
+    top = str(tmpdir)
+    pathname = os.path.join(top, 'file')
+    handler = handlers(watch=top, backend='poll', poll_interval='0.05', poll_max_interval='0.05',
+                       events='create,modify,delete')
+    dispatched = []
+    handler.dispatch = lambda event, label: dispatched.append((event.maskname, event.pathname))
+    handler.poller.start()
+    # the tree is scanned once before the first changes are looked for
+    deadline = time.time() + 5
+    while not handler.poller.snapshot.dirs and time.time() < deadline:
+        time.sleep(0.01)
+    with open(pathname, 'w') as fh:
+        fh.write('a')
+    assert wait_for(dispatched, 1) == [('IN_CREATE', pathname)]
+    with open(pathname, 'w') as fh:
+        fh.write('ab')
+    assert wait_for(dispatched, 2)[1:] == [('IN_MODIFY', pathname)]
+    os.unlink(pathname)
+    assert wait_for(dispatched, 3)[2:] == [('IN_DELETE', pathname)]
+    time.sleep(0.2)
+    assert len(dispatched) == 3
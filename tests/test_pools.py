@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import sys
+import threading
+import time
+
+import pytest
+
+from conftest import make_event
+import watcher
+
+
+class Runner(object):
+    """ The part of `AsyncRunner` used by the handlers, as called from its loop. """
+    def __init__(self):
+        self.paused = set()
+
+    def in_loop(self):
+        return threading.current_thread().name == 'MainThread'
+
+    def call(self, func, *args):
+        func(*args)
+
+    def pause(self, holder):
+        self.paused.add(holder)
+
+    def resume(self, holder):
+        self.paused.discard(holder)
+
+
+def test_asyncio_engine_does_not_wait_for_a_dead_coprocess(monkeypatch, handlers):
+    monkeypatch.setattr(watcher, 'COPROCESS_MAX_RESTART_DELAY', 0.1)
+    handler = handlers(runner=Runner(), mode='coprocess', command='/nonexistent/cmd')
+    finished = []
+    handler.finished = lambda event, **kwargs: finished.append(event)
+    start = time.time()
+    for i in range(3):
+        handler.execute(make_event('/t/{0}'.format(i), watcher.pyinotify.IN_CLOSE_WRITE))
+    assert time.time() - start < 1
+    assert finished == []
+    closing = threading.Thread(target=handler.close)
+    closing.start()
+    closing.join(5)
+    assert not closing.is_alive()
+    assert [event.pathname for event in finished] == ['/t/0', '/t/1', '/t/2']
+
+
+def test_asyncio_engine_stops_reading_the_events_beyond_the_backlog(monkeypatch, handlers):
+    monkeypatch.setattr(watcher, 'POOL_BACKLOG', 2)
+    runner = Runner()
+    handler = handlers(runner=runner, mode='coprocess', command='/nonexistent/cmd')
+    submitted = []
+    room = threading.Event()
+
+    def submit(event, fields):
+        room.wait()
+        submitted.append(event.pathname)
+    handler.pool.submit = submit
+    handler.spawned = lambda event: None
+    for i in range(4):
+        handler.execute(make_event('/t/{0}'.format(i), watcher.pyinotify.IN_CLOSE_WRITE))
+    # the first one is taken by the feed thread, waiting for the pool
+    assert runner.paused == set([handler])
+    room.set()
+    deadline = time.time() + 5
+    while len(submitted) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert submitted == ['/t/0', '/t/1', '/t/2', '/t/3']
+    assert runner.paused == set()
+
+
+COPROCESS = '''
+import json, sys
+out = open(sys.argv[1], 'a')
+for line in sys.stdin:
+    fields = json.loads(line)
+    out.write('{0} {1} {2}\\n'.format(fields['job'], fields['tflags'], fields['filename']))
+    out.flush()
+    sys.stdout.write('fail\\n' if fields['filename'].endswith('bad') else '{"ok": true}\\n')
+    sys.stdout.flush()
+'''
+
+
+def test_coprocesses_reply_to_the_events_streamed_as_json_lines(tmpdir, handlers):
+    script = tmpdir.join('coprocess.py')
+    script.write(COPROCESS)
+    received = tmpdir.join('received')
+    handler = handlers(mode='coprocess', pool_size='2',
+                       command='{0} {1} {2}'.format(sys.executable, script, received))
+    finished = []
+    handler.finished = lambda event, **kwargs: finished.append((event.pathname, kwargs.get('succeeded', False)))
+    pathnames = ['/t/{0}'.format(i) for i in range(10)] + ['/t/bad']
+    for pathname in pathnames:
+        handler.execute(make_event(pathname, watcher.pyinotify.IN_CLOSE_WRITE))
+    # the coprocesses exit once they replied to all the events
+    handler.close()
+    deadline = time.time() + 5
+    while len(finished) < len(pathnames) and time.time() < deadline:
+        time.sleep(0.01)
+    assert sorted(finished) == sorted((pathname, pathname != '/t/bad') for pathname in pathnames)
+    assert sorted(received.read().splitlines()) == sorted('job IN_CLOSE_WRITE ' + pathname for pathname in pathnames)
+
+
+def action(fields):
+    """ The handler function of the tests: fails for the files named 'bad', raises for those named 'error'. """
+    name = fields['filename'].rpartition('/')[2]
+    if name == 'error':
+        raise RuntimeError('no ' + name)
+    return name != 'bad' and '{0} in {1}'.format(fields['filename'], fields['job'])
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_calls_the_handler_function_in_a_pool(pool, handlers):
+    handler = handlers(handler='test_pools:action', handler_pool=pool, pool_size='2')
+    calls = []
+    handler.report_call = lambda event, succeeded, output: calls.append((event.pathname, succeeded, output))
+    for name in ('a', 'bad', 'error', 'b'):
+        handler.execute(make_event('/t/' + name, watcher.pyinotify.IN_CLOSE_WRITE))
+    deadline = time.time() + 10
+    while len(calls) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    calls = dict((pathname, (succeeded, output)) for (pathname, succeeded, output) in calls)
+    assert calls['/t/a'] == (True, b'/t/a in job') and calls['/t/b'] == (True, b'/t/b in job')
+    assert calls['/t/bad'] == (False, b'')
+    assert calls['/t/error'][0] is False and b'RuntimeError: no error' in calls['/t/error'][1]
+
+
+def test_rejects_a_handler_function_which_cannot_be_imported(handlers):
+    for spec in ('test_pools', 'test_pools:missing', 'no_such_module:action'):
+        with pytest.raises((ValueError, ImportError, AttributeError)):
+            handlers(handler=spec)
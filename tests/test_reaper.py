@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import signal
+
+import pytest
+
+import watcher
+
+OPTS = {'job': 'job', 'output_limit': 1000, 'log_output': False, 'outfile': None}
+
+
+class Scheduler(object):
+    """ The part of `Scheduler` used by the reaper. """
+    def __init__(self):
+        self.done_jobs = []
+
+    def done(self, job):
+        self.done_jobs.append(job)
+
+
+def timeout(signum, frame):
+    raise RuntimeError("children not reaped")
+
+
+@pytest.mark.parametrize('use_pidfd', [True, False])
+def test_reaps_the_children_with_their_output(use_pidfd):
+    if use_pidfd and not watcher.pidfd_supported():
+        pytest.skip("no pidfd")
+    scheduler = Scheduler()
+    reaper = watcher.Reaper(scheduler)
+    reaper.use_pidfd = use_pidfd
+    reported = {}
+
+    def report(process, capture):
+        reported[process.returncode] = capture.output()
+        if len(reported) == 3:
+            # as on SIGTERM
+            raise SystemExit()
+    # the one exiting at once may be gone before it is registered
+    for (code, delay) in ((0, 0), (3, 0.1), (4, 0.3)):
+        process = watcher.spawn_command(['sh', '-c', 'echo {0}; sleep {1}; exit {0}'.format(code, delay)])
+        reaper.add(process, OPTS, report)
+    previous = signal.signal(signal.SIGALRM, timeout)
+    signal.alarm(5)
+    try:
+        with pytest.raises(SystemExit):
+            reaper.run()
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    assert reported == {0: b'0\n', 3: b'3\n', 4: b'4\n'}
+    assert scheduler.done_jobs == ['job'] * 3
+    assert reaper.children == {} and reaper.fds == {}
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import io
+import os
+import re
+
+from conftest import make_event
+import watcher
+
+IN_CLOSE_WRITE = watcher.pyinotify.IN_CLOSE_WRITE
+
+README = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'README.md')
+
+
+def test_readme_lists_the_options_a_reload_does_not_apply():
+    with io.open(README, encoding='utf-8') as fh:
+        section = fh.read().split('## Configuration')[1].split('\n## ')[0]
+    restart = section.split('still need a restart:')[1].split('\n\n')[1]
+    assert set(re.findall(r'`(\w+)`', restart)) == set(watcher.RESTART_OPTIONS)
+    watch = section.split('watch options (')[1].split(')')[0]
+    assert set(re.findall(r'`(\w+)`', watch)) == set(watcher.WATCH_OPTIONS)
+
+
+def test_supervisor_starts_workers_again_with_the_reloaded_jobs(tmpdir, monkeypatch):
+    path = tmpdir.join('watcher.conf')
+    path.write('[DEFAULT]\nworkers=2\n\n[a]\nwatch=/tmp\ncommand=true\n\n[b]\nwatch=/tmp\ncommand=true\n')
+    supervisor = watcher.Supervisor(watcher.read_config([str(path)]), 2)
+    monkeypatch.setattr(supervisor, 'signal', lambda signum: None)
+    path.write('[DEFAULT]\nworkers=3\n\n[a]\nwatch=/tmp\ncommand=true\n\n[b]\nwatch=/tmp\ncommand=true\n\n'
+               '[c]\nwatch=/tmp\ncommand=true\n')
+    supervisor.reload()
+    assert supervisor.config.get('DEFAULT', 'workers') == '2'
+    # a worker started again gets the share its running peer reloaded to
+    peer = watcher.shard_config(watcher.read_config([str(path)]), 0, 2)
+    assert watcher.shard_config(supervisor.config, 0, 2).sections() == peer.sections() == ['a', 'c']
+
+
+def test_reload_journals_the_commands_of_the_replaced_handler(tmpdir, monkeypatch):
+    directory = str(tmpdir.join('journal'))
+    folder = tmpdir.mkdir('w')
+    path = tmpdir.join('watcher.conf')
+    job = '[job]\nwatch={0}\nevents=close_write\nbackground=true\njournal={1}\ndebounce=60\ncommand=true {2}\n'
+    path.write(job.format(folder, directory, 'first'))
+    config = watcher.read_config([str(path)])
+    # the commands are started but the test completes them, as the reaper does
+    started = []
+    monkeypatch.setattr(watcher.EventHandler, 'spawn',
+                        lambda handler, args, command, stdindata, waited, event: started.append((handler, event)))
+    scheduler = watcher.Scheduler(None)
+    reaper = watcher.Reaper(scheduler)
+    budget = watcher.WatchBudget()
+    handlers = [watcher.make_handler(config, 'job', scheduler, reaper, None)]
+    notifiers, add_watches, attach = watcher.threaded_notifiers(handlers, budget)
+    for notifier in notifiers.values():
+        notifier.start()
+    handlers[0].recover_journal()
+    old = handlers[0]
+    old.execute(make_event(str(folder.join('running')), IN_CLOSE_WRITE))
+    old.dispatch(make_event(str(folder.join('pending')), IN_CLOSE_WRITE), "Close write")
+    assert [event.pathname for (handler, event) in started] == [str(folder.join('running'))]
+
+    path.write(job.format(folder, directory, 'second'))
+    reloader = watcher.Reloader(config, handlers, notifiers, attach, scheduler, reaper, None, budget)
+    reloader.reload()
+    new = handlers[0]
+    assert new is not old and new.journal is old.journal
+    # the pending event was flushed by the close of the former handler
+    assert [event.pathname for (handler, event) in started] == [str(folder.join(name))
+                                                                for name in ('running', 'pending')]
+    for (handler, event) in started:
+        assert handler is old
+        handler.finished(event, succeeded=True)
+    new.close()
+    for notifier in notifiers.values():
+        notifier.stop()
+    journal = watcher.Journal(directory)
+    assert journal.recover() == []
+    journal.close()
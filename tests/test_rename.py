@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+from conftest import make_event
+import watcher
+
+IN_MOVED_FROM = watcher.pyinotify.IN_MOVED_FROM
+IN_MOVED_TO = watcher.pyinotify.IN_MOVED_TO
+
+
+def collect():
+    events = []
+    return events, lambda event, label: events.append((event, label))
+
+
+def test_pairs_moves_sharing_a_cookie():
+    events, callback = collect()
+    pairer = watcher.MovePairer(callback, 10, 100)
+    pairer.add(make_event('/t/a.mkv', IN_MOVED_FROM, cookie=7), "Moved from")
+    pairer.add(make_event('/t/b.mkv', IN_MOVED_TO, cookie=7), "Moved to")
+    pairer.close()
+    assert len(events) == 1
+    event, label = events[0]
+    assert label == "Renamed"
+    assert event.pathname == '/t/b.mkv'
+    assert event.renamed_from == '/t/a.mkv'
+    assert event.mask == IN_MOVED_FROM | IN_MOVED_TO
+    assert pairer.paired == 1
+
+
+def test_releases_unpaired_moves():
+    events, callback = collect()
+    pairer = watcher.MovePairer(callback, 0.05, 100)
+    pairer.add(make_event('/t/a.mkv', IN_MOVED_FROM, cookie=1), "Moved from")
+    pairer.add(make_event('/t/c.mkv', IN_MOVED_TO, cookie=2), "Moved to")
+    time.sleep(0.3)
+    pairer.close()
+    assert sorted((event.pathname, label) for event, label in events) == [('/t/a.mkv', "Moved from"),
+                                                                           ('/t/c.mkv', "Moved to")]
+    assert not any(hasattr(event, 'renamed_from') for event, label in events)
+
+
+def test_releases_the_oldest_moves_beyond_size():
+    events, callback = collect()
+    pairer = watcher.MovePairer(callback, 10, 2)
+    for cookie in (1, 2, 3):
+        pairer.add(make_event('/t/{0}'.format(cookie), IN_MOVED_FROM, cookie=cookie), "Moved from")
+    assert [event.pathname for event, label in events] == ['/t/1']
+    pairer.close()
+    assert [event.pathname for event, label in events] == ['/t/1', '/t/2', '/t/3']
+
+
+def test_passes_other_events_at_once():
+    events, callback = collect()
+    pairer = watcher.MovePairer(callback, 10, 100)
+    pairer.add(make_event('/t/a', watcher.pyinotify.IN_CLOSE_WRITE), "Close write")
+    assert [event.pathname for event, label in events] == ['/t/a']
+    pairer.close()
+
+
+def test_filters_a_move_pyinotify_paired_by_its_destination(handlers):
+    # without rename_wait, the src_pathname pyinotify sets does not make a rename
+    handler = handlers(events='move', include_extensions='.mp4')
+    event = make_event('/t/a.txt', IN_MOVED_TO, cookie=3)
+    event.src_pathname = '/t/a.mp4'
+    executed = []
+    handler.execute = lambda event: executed.append(event)
+    handler.dispatch(event, "Moved to")
+    assert executed == []
+    assert handler.metrics.filtered == 1
+
+
+def test_runs_a_rename_if_either_path_passes_the_filters(handlers):
+    handler = handlers(events='move', include_extensions='.mp4', rename_wait='10')
+    executed = []
+    handler.execute = lambda event: executed.append(event)
+    handler.pairer.add(make_event('/t/a.mp4', IN_MOVED_FROM, cookie=3), "Moved from")
+    handler.pairer.add(make_event('/t/a.txt', IN_MOVED_TO, cookie=3), "Moved to")
+    assert [(event.renamed_from, event.pathname) for event in executed] == [('/t/a.mp4', '/t/a.txt')]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import logging
+import time
+
+import watcher
+
+
+class Exited(object):
+    pid = 1234
+
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+def summaries(caplog):
+    return [record.getMessage() for record in caplog.records if 'not logged' in record.getMessage()]
+
+
+def test_failures_are_logged_as_errors_and_rate_limited(handlers, caplog):
+    handler = handlers(log_rate='1')
+    with caplog.at_level(logging.INFO, logger=watcher.logger.name):
+        for i in range(3):
+            watcher.process_report(Exited(1), handler.opts, watcher.OutputCapture(handler.opts))
+    failures = [record for record in caplog.records if 'failed' in record.getMessage()]
+    assert [record.levelno for record in failures] == [logging.ERROR]
+    assert handler.opts['log_limiter'].suppressed == 2
+
+
+def test_failures_to_retry_are_logged_as_warnings(handlers, caplog):
+    handler = handlers()
+    with caplog.at_level(logging.INFO, logger=watcher.logger.name):
+        watcher.process_report(Exited(1), handler.opts, watcher.OutputCapture(handler.opts), retry=True)
+    assert [record.levelno for record in caplog.records if 'failed' in record.getMessage()] == [logging.WARNING]
+
+
+def test_suppressed_records_are_summed_up_once_the_job_logs_no_more(caplog):
+    limiter = watcher.LogLimiter(2, 'job')
+    with caplog.at_level(logging.INFO, logger=watcher.logger.name):
+        assert [limiter.allow() for i in range(5)] == [True, True, False, False, False]
+        deadline = time.time() + 5
+        while not summaries(caplog) and time.time() < deadline:
+            time.sleep(0.01)
+    assert summaries(caplog) == [
+        "job: 3 records about events and commands not logged (more than 2 per second)"]
+    assert limiter.timer is None
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+import watcher
+
+
+def test_exports_the_wait_of_queued_commands(handlers):
+    handler = handlers(background='true', max_concurrency='1')
+    spawned = []
+    handler.spawn = lambda args, command, stdindata, waited, event: spawned.append(waited)
+    scheduler = handler.opts['scheduler']
+    scheduler.submit(handler, None, ['true'], 'true', None, None)
+    scheduler.submit(handler, None, ['true'], 'true', None, None)
+    time.sleep(0.02)
+    scheduler.done('job')
+    assert spawned[0] is None and spawned[1] >= 0.02
+    metrics = watcher.render_metrics([handler], scheduler, watcher.WatchBudget())
+    assert 'watcher_queue_wait_seconds_count{job="job"} 2' in metrics
+    assert 'watcher_queue_wait_seconds_bucket{job="job",le="0.005"} 1' in metrics
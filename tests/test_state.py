@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+
+import watcher
+
+
+def write(pathname, data):
+    with open(pathname, 'w') as fh:
+        fh.write(data)
+
+
+def indexed(handlers, top, state_file):
+    """ A job of `top` with its index built as at startup, and the events it sent meanwhile. """
+    handler = handlers(watch=top, recursive='true', state_file=state_file)
+    dispatched = []
+    handler.dispatch = lambda event, label: dispatched.append((event.maskname, event.pathname))
+    handler.build_index()
+    return handler, dispatched
+
+
+def test_catches_up_with_the_changes_made_while_down(tmpdir, handlers):
+    top = str(tmpdir.mkdir('tree'))
+    state_file = str(tmpdir.join('state'))
+    os.mkdir(os.path.join(top, 'sub'))
+    for name in ('a', 'b', os.path.join('sub', 'c')):
+        write(os.path.join(top, name), name)
+    handler, dispatched = indexed(handlers, top, state_file)
+    # without a state file, there is nothing to catch up with
+    assert dispatched == []
+    handler.save_state()
+
+    write(os.path.join(top, 'b'), 'bb')
+    os.unlink(os.path.join(top, 'a'))
+    write(os.path.join(top, 'd'), 'd')
+    write(os.path.join(top, 'sub', 'e'), 'e')
+    handler, dispatched = indexed(handlers, top, state_file)
+    assert sorted(dispatched) == [('IN_CREATE', os.path.join(top, 'd')),
+                                  ('IN_CREATE', os.path.join(top, 'sub', 'e')),
+                                  ('IN_MODIFY', os.path.join(top, 'b'))]
+    handler.save_state()
+
+    handler, dispatched = indexed(handlers, top, state_file)
+    assert dispatched == []
+
+
+def test_saves_the_state_records_of_the_files(tmpdir):
+    state = watcher.StateFile(str(tmpdir.join('state')))
+    assert state.load() is None
+    records = [(watcher.path_hash('/t/a'), (1.5, 10, 7)), (watcher.path_hash('/t/b'), (2.0, 0, 8))]
+    state.save(records)
+    assert state.load() == dict(records)
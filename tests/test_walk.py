@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+
+from conftest import make_event
+import watcher
+
+IN_OPEN = watcher.pyinotify.IN_OPEN
+IN_ISDIR = watcher.pyinotify.IN_ISDIR
+
+
+def test_drops_the_events_of_its_own_walk(tmpdir, handlers):
+    top = str(tmpdir)
+    os.mkdir(os.path.join(top, 'sub'))
+    handler = handlers(watch=top, events='open')
+    dispatched = []
+    handler.dispatch = lambda event, label: dispatched.append(event.pathname)
+    assert watcher.scan_subdirs(top, lambda path: False) == [os.path.join(top, 'sub')]
+    handler.runCommand(make_event(top, IN_OPEN | IN_ISDIR, isdir=True), "Open")
+    handler.runCommand(make_event(os.path.join(top, 'sub'), IN_OPEN | IN_ISDIR, isdir=True), "Open")
+    handler.runCommand(make_event(os.path.join(top, 'file'), IN_OPEN), "Open")
+    assert dispatched == [os.path.join(top, 'sub'), os.path.join(top, 'file')]
+
+
+def test_passes_the_events_after_the_grace_delay(monkeypatch, tmpdir, handlers):
+    monkeypatch.setattr(watcher, 'OWN_LISTING_GRACE', 0)
+    top = str(tmpdir)
+    handler = handlers(watch=top, events='open')
+    dispatched = []
+    handler.dispatch = lambda event, label: dispatched.append(event.pathname)
+    watcher.scan_subdirs(top, lambda path: False)
+    handler.runCommand(make_event(top, IN_OPEN | IN_ISDIR, isdir=True), "Open")
+    assert dispatched == [top]
+    assert top not in watcher.own_listings.listed
+
+
+def test_drops_the_events_of_its_own_index_scans(tmpdir, handlers):
+    top = str(tmpdir)
+    handler = handlers(watch=top, events='open', overflow_rescan='true')
+    dispatched = []
+    handler.dispatch = lambda event, label: dispatched.append(event.pathname)
+    handler.index.scan()
+    handler.runCommand(make_event(top, IN_OPEN | IN_ISDIR, isdir=True), "Open")
+    assert dispatched == []
+
+
+def test_does_not_index_the_trees_by_default(handlers):
+    handler = handlers(overflow_rescan=watcher.CONFIG_DEFAULTS['overflow_rescan'])
+    assert handler.index is None
+
+
+def test_counts_the_watches_of_the_jobs_sharing_an_inotify_instance(tmpdir, handlers):
+    top = str(tmpdir)
+    for name in ('a', 'b', os.path.join('b', 'c')):
+        os.mkdir(os.path.join(top, name))
+    whole = handlers(job='whole', watch=top, recursive='true')
+    part = handlers(job='part', watch=os.path.join(top, 'b'), recursive='true')
+    table, add_watches, attach = watcher.shared_watches([whole, part], watcher.WatchBudget())
+    add_watches()
+    assert (whole.watch_count(), part.watch_count()) == (4, 2)
+    assert len(table.handlers) == 4
+    table.forget(table.wm.get_wd(os.path.join(top, 'b', 'c')))
+    assert (whole.watch_count(), part.watch_count()) == (3, 1)
+    whole.unwatch()
+    assert (whole.watch_count(), part.watch_count()) == (0, 1)
+    assert len(table.handlers) == 1
+    table.wm.close()
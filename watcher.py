@@ -17,6 +17,19 @@ import argparse
 import string
 import logging
 import time
+import stat
+import struct
+import mmap
+import hashlib
+import heapq
+import json
+import select
+import fcntl
+import threading
+import collections
+import array
+import copy
+import functools
 import daemon
 try:
     from daemon.pidlockfile import PIDLockFile
@@ -25,16 +38,48 @@ except (NameError, ImportError):
     from lockfile.pidlockfile import PIDLockFile
     from lockfile import AlreadyLocked
 import re
+import fnmatch
+import glob
 import subprocess
 import shlex
 import socket
+import bisect
+import codecs
 import chardet
+import importlib
+import traceback
+import multiprocessing
+import tempfile
+import shutil
 
 try:
     import configparser
 except ImportError:  # python 2 and configparser from pip not installed
     import ConfigParser as configparser
 
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    import concurrent.futures
+except ImportError:  # python 2 without the futures backport from pip
+    concurrent = None
+
+try:
+    import asyncio
+except ImportError:  # python 2
+    asyncio = None
+
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 try:
     basestring
 except NameError:  # python 3 compatibility
@@ -54,6 +99,72 @@ VIDEO_EXTENSIONS = ('.3g2', '.3gp', '.3gp2', '.3gpp', '.60d', '.ajp', '.asf', '.
                     '.qt', '.ram', '.rm', '.rmvb', '.swf', '.ts', '.vfw', '.vid', '.video', '.viv', '.vivo', '.vob',
                     '.vro', '.wm', '.wmv', '.wmx', '.wrap', '.wvx', '.wx', '.x264', '.xvid')
 
+# Size of the output sample used to guess its encoding
+OUTPUT_SAMPLE = 4096
+
+# Seconds between two progress messages of the initial walk of a tree
+WALK_PROGRESS = 10
+
+# Seconds after the daemon listed a directory during which its open, access and close events are taken for its own
+OWN_LISTING_GRACE = 1
+
+# Share of fs.inotify.max_user_watches in use from which to warn
+WATCHES_WARNING = 0.9
+
+# Layout of the state files: header, then one record per file (path hash, mtime, size, inode)
+STATE_MAGIC = b'WATCHIDX'
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct('<8sII')
+STATE_RECORD = struct.Struct('<QdQQ')
+STATE_HASH = struct.Struct('<Q')
+
+# Files of the dedup caches, as state files of records (path hash, mtime, size, inode, digest)
+DEDUP_MAGIC = b'WATCHDUP'
+DEDUP_RECORD = struct.Struct('<QdQQ16s')
+# Size of the reads hashing the files
+DEDUP_CHUNK = 1048576
+
+# Maximum number of events sent to a coprocess and waiting for its reply
+COPROCESS_PIPELINE = 16
+# Seconds before starting an exited coprocess again, doubled while it keeps exiting, up to the maximum
+COPROCESS_RESTART_DELAY = 1
+COPROCESS_MAX_RESTART_DELAY = 30
+
+# Maximum number of events waiting for each worker of an in-process handler
+HANDLER_PIPELINE = 16
+
+# Number of events of a job waiting for its coprocesses or handler workers with engine 'asyncio' from which
+# the loop stops reading the events, until half of them went to the workers
+POOL_BACKLOG = 10000
+
+# Seconds the output of an exited child is still read while its stdout is open (engine 'asyncio')
+CHILD_OUTPUT_GRACE = 1
+
+# Number of bytes of the output of each command kept in the digests of the post actions
+DIGEST_TAIL = 1024
+
+# Maximum number of log records waiting for the log writer thread, and written at once
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH = 512
+
+# Upper bounds (seconds) of the buckets of the latency and duration histograms of the metrics
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+# Seconds between two heartbeats of a worker process, and without heartbeat before it is killed and started again
+WORKER_HEARTBEAT = 1
+WORKER_TIMEOUT = 30
+# Seconds before starting an exited worker again, doubled while it keeps exiting, up to the maximum
+WORKER_RESTART_DELAY = 1
+WORKER_MAX_RESTART_DELAY = 30
+# Seconds the workers have to stop before being killed
+WORKER_STOP_TIMEOUT = 10
+
+# Signals ignored by python, restored to their default for the commands
+SPAWN_DEFAULT_SIGNALS = tuple(getattr(signal, name) for name in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ') if hasattr(signal, name))
+
+# $host of the post actions
+HOSTNAME = socket.gethostname()
+
 
 class DaemonRunnerError(Exception):
     """ Abstract base class for errors from DaemonRunner. """
@@ -71,12 +182,17 @@ class DaemonRunnerStopFailureError(RuntimeError, DaemonRunnerError):
     """ Raised when failure stopping DaemonRunner. """
 
 
+class DaemonRunnerReloadFailureError(RuntimeError, DaemonRunnerError):
+    """ Raised when failure reloading DaemonRunner. """
+
+
 class DaemonRunner(object):
     """ Controller for a callable running in a separate background process.
 
         * 'start': Become a daemon and call `run()`.
         * 'stop': Exit the daemon process specified in the PID file.
         * 'restart': Call `stop()`, then `start()`.
+        * 'reload': Send SIGHUP to the daemon process specified in the PID file.
         * 'run': Run `func(func_arg)`
         """
     def __init__(self, func, func_arg=None, pidfile=None, stdin=None, stdout=None, stderr=None, uid=None, gid=None, umask=None, working_directory=None, signal_map=None, files_preserve=None):
@@ -112,6 +228,19 @@ class DaemonRunner(object):
         self.stop()
         self.start()
 
+    def reload(self):
+        """ Make the daemon process specified in the PID file reload its config.
+            """
+        if not self.pidfile.is_locked() or is_pidfile_stale(self.pidfile):
+            pidfile_path = self.pidfile.path
+            raise DaemonRunnerReloadFailureError("No daemon to reload, PID file %(pidfile_path)r not locked" % vars())
+        pid = self.pidfile.read_pid()
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError as exc:
+            raise DaemonRunnerReloadFailureError("Failed to reload %(pid)d: %(exc)s" % vars())
+        logger.info("Daemon %(pid)d reloading its config", vars())
+
     def run(self):
         """ Run the application.
             """
@@ -165,14 +294,19 @@ class DaemonRunner(object):
             raise DaemonRunnerStopFailureError(
                 "Failed to terminate %(pid)d: %(exc)s" % vars())
 
-        time.sleep(0.2)
-        try:
-            os.kill(pid, 0)
-        except OSError as exc:
-            if exc.errno == errno.ESRCH:
-                # The specified PID does not exist
-                logger.info("Pid %(pid)d terminated.", vars())
-                return
+        # the supervisor of workers stops them first
+        deadline = time.time() + WORKER_STOP_TIMEOUT + 1
+        while True:
+            time.sleep(0.2)
+            try:
+                os.kill(pid, 0)
+            except OSError as exc:
+                if exc.errno == errno.ESRCH:
+                    # The specified PID does not exist
+                    logger.info("Pid %(pid)d terminated.", vars())
+                    return
+            if time.time() > deadline:
+                break
 
         raise DaemonRunnerStopFailureError(
             "Failed to terminate %(pid)d" % vars())
@@ -210,6 +344,462 @@ def is_pidfile_stale(pidfile):
     return result
 
 
+def masknames(mask):
+    """ Textual flags of `mask`, which may hold several events (e.g. 'IN_MODIFY|IN_CLOSE_WRITE').
+        """
+    names = [name for (value, name) in sorted(pyinotify.EventsCodes.ALL_VALUES.items())
+             if value & mask and value & (value - 1) == 0]
+    return '|'.join(names)
+
+
+def combine_patterns(regexp=None, globs=None):
+    """ Compile a regular expression and file name globs into the `search` method of a single regexp.
+
+        Return None if there is no pattern.
+        """
+    patterns = []
+    if regexp:
+        patterns.append(regexp)
+    for pattern in globs or ():
+        patterns.append('^' + fnmatch.translate(pattern.strip()))
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{0})'.format(p) for p in patterns)).search
+
+
+def compile_filter(include_extensions=None, exclude_extensions=None, include_re=None, exclude_re=None,
+                   include_glob=None, exclude_glob=None):
+    """ Compile the file filters of a job into a predicate on event pathnames.
+
+        Extensions are checked with a single `endswith` over a tuple of
+        suffixes, regexps and globs with one regexp search on the file name
+        for the included ones and one for the excluded ones.
+        """
+    include_suffixes = tuple(include_extensions) if include_extensions else None
+    exclude_suffixes = tuple(exclude_extensions) if exclude_extensions else None
+    include = combine_patterns(include_re, include_glob)
+    exclude = combine_patterns(exclude_re, exclude_glob)
+
+    if include_suffixes is None and exclude_suffixes is None and include is None and exclude is None:
+        return lambda pathname: True
+
+    def accepts(pathname):
+        if include_suffixes is not None and not pathname.endswith(include_suffixes):
+            return False
+        if exclude_suffixes is not None and pathname.endswith(exclude_suffixes):
+            return False
+        if include is None and exclude is None:
+            return True
+        name = pathname.rpartition(os.sep)[2]
+        if include is not None and include(name) is None:
+            return False
+        return exclude is None or exclude(name) is None
+    return accepts
+
+
+def compile_exclusion(excluded=None, excluded_re=None):
+    """ Compile the excluded dirs of a job into a predicate on directory paths.
+
+        `excluded` items are path prefixes, or globs if they hold wildcards,
+        `excluded_re` is a regexp searched in the path.
+        """
+    prefixes = tuple(d for d in excluded or () if not glob.has_magic(d))
+    match = combine_patterns(excluded_re, [d for d in excluded or () if glob.has_magic(d)])
+    if not prefixes and match is None:
+        return lambda path: False
+
+    def is_excluded(path):
+        try:
+            if prefixes and path.startswith(prefixes):
+                return True
+        except UnicodeDecodeError as ex:
+            logger.exception("Failed to check exclude for %r (decoding error)", path)
+            return False
+        return match is not None and match(path) is not None
+    return is_excluded
+
+
+def compile_shard(folder, shard, shards):
+    """ Compile the part of the tree `folder` watched by shard `shard` of `shards` of a job.
+
+        Return a predicate on event pathnames telling whether the shard runs
+        their commands, and one on directory paths telling whether it leaves
+        them out. The subdirectories of `folder` are spread over the shards by
+        a hash of their name, the entries of `folder` itself belong to the
+        first shard (all the shards watch `folder`).
+        """
+    prefix = folder.rstrip(os.sep) + os.sep
+
+    def owns(pathname):
+        if not pathname.startswith(prefix):
+            return shard == 0
+        top, sep, _ = pathname[len(prefix):].partition(os.sep)
+        if not sep:
+            return shard == 0
+        return path_hash(top) % shards == shard
+
+    def leaves_out(path):
+        if not path.startswith(prefix):
+            return False
+        top, sep, _ = path[len(prefix):].partition(os.sep)
+        return not sep and path_hash(top) % shards != shard
+    return owns, leaves_out
+
+
+class OwnListings(object):
+    """ Directories listed by the daemon itself, whose IN_OPEN, IN_ACCESS and
+        IN_CLOSE_NOWRITE events are not passed to the jobs.
+
+        Listing a watched directory makes inotify report these events for it,
+        on its own watch and on its parent's. The notifier may read them after
+        the listing is over, so they are still dropped `OWN_LISTING_GRACE`
+        seconds later (those of another process meanwhile as well).
+        """
+    MASK = pyinotify.IN_OPEN | pyinotify.IN_ACCESS | pyinotify.IN_CLOSE_NOWRITE
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listing = collections.Counter()  # path -> listings in progress
+        self.listed = collections.OrderedDict()  # path -> end of its last listing, oldest first
+
+    def start(self, path):
+        with self.lock:
+            self.listing[path] += 1
+
+    def end(self, path):
+        now = time.time()
+        with self.lock:
+            self.listing[path] -= 1
+            if not self.listing[path]:
+                del self.listing[path]
+            self.listed.pop(path, None)
+            self.listed[path] = now
+            while self.listed and now - next(iter(self.listed.values())) >= OWN_LISTING_GRACE:
+                self.listed.popitem(last=False)
+
+    def caused(self, event):
+        """ Tell whether `event` may come from a listing of the daemon. """
+        if not event.dir or not event.mask & self.MASK:
+            return False
+        with self.lock:
+            if event.pathname in self.listing:
+                return True
+            end = self.listed.get(event.pathname)
+            return end is not None and time.time() - end < OWN_LISTING_GRACE
+
+
+own_listings = OwnListings()
+
+
+def scan_subdirs(path, exclude_filter):
+    """ Return the subdirectories of `path` which are not excluded, without following symlinks. """
+    subdirs = []
+    own_listings.start(path)
+    try:
+        try:
+            entries = scandir(path)
+        except OSError:  # vanished or unreadable, like os.walk
+            return subdirs
+        try:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False) and not exclude_filter(entry.path):
+                        subdirs.append(entry.path)
+                except OSError:
+                    pass
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+    finally:
+        own_listings.end(path)
+    return subdirs
+
+
+def parallel_subdirs(top, exclude_filter, workers):
+    """ Yield the subdirectories of `top` as `workers` threads scan the subtrees.
+
+        Parents are yielded before their children.
+        """
+    pending = queue.Queue()
+    scanned = queue.Queue()
+
+    def scan():
+        while True:
+            path = pending.get()
+            if path is None:
+                return
+            scanned.put(scan_subdirs(path, exclude_filter))
+
+    threads = [threading.Thread(target=scan, name='walk-{0}'.format(i)) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        pending.put(top)
+        unscanned = 1
+        while unscanned:
+            subdirs = scanned.get()
+            unscanned -= 1
+            for path in subdirs:
+                yield path
+                pending.put(path)
+                unscanned += 1
+    finally:
+        for thread in threads:
+            pending.put(None)
+
+
+def walk_dirs(top, rec, exclude_filter, workers=1):
+    """ Yield `top` and, if `rec`, its subdirectories, not descending into the excluded ones.
+
+        Like pyinotify, symlinks are not followed.
+        """
+    yield top
+    if not rec or os.path.islink(top) or not os.path.isdir(top):
+        return
+    if scandir is None:
+        for root, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if not exclude_filter(os.path.join(root, d))]
+            for d in dirs:
+                yield os.path.join(root, d)
+    elif workers > 1:
+        for path in parallel_subdirs(top, exclude_filter, workers):
+            yield path
+    else:
+        stack = [top]
+        while stack:
+            for path in scan_subdirs(stack.pop(), exclude_filter):
+                yield path
+                stack.append(path)
+
+
+def watch_tree(wm, path, mask, rec=False, auto_add=False, exclude_filter=lambda path: False,
+               workers=1, added=None, budget=None, name=None):
+    """ Add watches like `WatchManager.add_watch`, but skip excluded subtrees without walking them.
+
+        Directories are watched as they are walked, `added` being called with the {path: wd}
+        dict of each of them. If `name` is set, the progress of the walk is logged under it.
+        A failure to watch a directory is logged, and ends the walk if the inotify watches
+        are exhausted (ENOSPC).
+        """
+    wdd = {}
+    start = logged = time.time()
+    for count, dirpath in enumerate(walk_dirs(path, rec, exclude_filter, workers), 1):
+        try:
+            watched = wm.add_watch(dirpath, mask, auto_add=auto_add, exclude_filter=exclude_filter, quiet=False)
+        except pyinotify.WatchManagerError as err:
+            watched = err.wmd
+            if 'ENOSPC' in str(err):
+                logger.error("%s: out of inotify watches, '%s' and the directories left are not watched (%s); "
+                             "raise fs.inotify.max_user_watches", name or path, dirpath,
+                             budget or '{0} watches'.format(len(wm.watches)))
+                wdd.update(watched)
+                break
+            logger.warning("%s", err)
+        wdd.update(watched)
+        if added is not None:
+            added(watched)
+        if count % 1000 == 0:
+            if budget is not None:
+                budget.check()
+            if name and time.time() - logged >= WALK_PROGRESS:
+                logged = time.time()
+                logger.info("%s: %d directories watched so far (%s)", name, count,
+                            budget or '{0} watches'.format(len(wm.watches)))
+    if name:
+        logger.info("%s: %d directories watched in %.1fs", name, len([wd for wd in wdd.values() if wd > 0]),
+                    time.time() - start)
+    if budget is not None:
+        budget.check()
+    return wdd
+
+
+class WatchBudget(object):
+    """ Count the watches of the daemon against fs.inotify.max_user_watches,
+        warning when they are about to run out.
+        """
+    def __init__(self):
+        self.wms = []
+        try:
+            self.limit = pyinotify.max_user_watches.value
+        except (IOError, OSError):
+            self.limit = None
+        self.warned = False
+
+    def count(self):
+        return sum(len(wm.watches) for wm in self.wms)
+
+    def check(self):
+        count = self.count()
+        if self.limit and not self.warned and count >= self.limit * WATCHES_WARNING:
+            self.warned = True
+            logger.warning("%s, new directories may soon not be watched: raise fs.inotify.max_user_watches", self)
+        return count
+
+    def __str__(self):
+        count = self.count()
+        if not self.limit:
+            return "{0} watches".format(count)
+        return "{0} of {1} watches ({2:.0%} of fs.inotify.max_user_watches)".format(count, self.limit,
+                                                                                   count / self.limit)
+
+
+def merge_event(merged, event):
+    """ Add the flags of `event` to `merged`. """
+    merged.mask |= event.mask
+    merged.maskname = masknames(merged.mask)
+
+
+def feed_stdin(process, data):
+    """ Write `data` to the stdin of a background `process` without blocking the caller.
+        """
+    def feed():
+        try:
+            process.stdin.write(data)
+            process.stdin.close()
+        except (IOError, OSError) as err:
+            logger.warning("Failed to write stdin of child %s: %s", process.pid, err)
+    thread = threading.Thread(target=feed, name="stdin-{0}".format(process.pid))
+    thread.daemon = True
+    thread.start()
+
+
+class CommandTemplate(object):
+    """ The argv of a command line for the values of the wildcards: the values are
+        shell-quoted into the line, which is then split as a shell would.
+
+        A line without quotes nor backslashes is split once into argument
+        templates, filled for each event without parsing the values (which
+        gives the same argv): a word which is only a wildcard ($filename,
+        ${filename}, ...) is the value itself, and $filenames alone expands to
+        one argument per file. Other lines are substituted and split for each
+        event, so that the values inside quotes stay quoted, e.g. for a shell
+        (`sh -c "process.sh $filename"`).
+        """
+    FIELDS = ('job', 'folder', 'watched', 'filename', 'filenames', 'tflags', 'nflags', 'cookie', 'src', 'dst')
+
+    def __init__(self, command):
+        self.command = command
+        self.template = None  # of the line, if it is split for each event
+        self.words = []  # (static word, wildcard name, or None) or (None, None, template)
+        if not any(char in command for char in '\'"\\'):
+            for word in shlex.split(command):
+                if '$' not in word:
+                    self.words.append((word, None, None))
+                    continue
+                template = string.Template(word)
+                match = template.pattern.match(word)
+                name = match.group('named') or match.group('braced') if match and match.end() == len(word) else None
+                if name in self.FIELDS:
+                    self.words.append((None, name, None))
+                elif 'filenames' in word:
+                    # its file names would be split into several arguments
+                    self.words = []
+                    break
+                else:
+                    self.words.append((None, None, template))
+        if not self.words:
+            self.template = string.Template(command)
+        # checked now rather than for each event
+        if not self.fill(dict(dict((field, '') for field in self.FIELDS), filenames=[''])):
+            raise ValueError("empty command")
+
+    def fill(self, fields):
+        """ Return the argv of the command for the values of `fields`. """
+        if self.template is not None:
+            quoted = dict((name, shellquote(value)) for (name, value) in fields.items() if name != 'filenames')
+            quoted['filenames'] = ' '.join(shellquote(pathname) for pathname in fields['filenames'])
+            return shlex.split(self.template.substitute(quoted))
+        argv = []
+        strings = None
+        for (word, name, template) in self.words:
+            if word is not None:
+                argv.append(word)
+            elif name == 'filenames':
+                argv.extend(fields['filenames'])
+            elif name is not None:
+                value = fields[name]
+                argv.append(value if isinstance(value, basestring) else '{0}'.format(value))
+            else:
+                if strings is None:
+                    strings = dict(fields, filenames=' '.join(fields['filenames']))
+                argv.append(template.substitute(strings))
+        return argv
+
+
+class SpawnedProcess(object):
+    """ The part of `subprocess.Popen` used for the children started by `spawn_command`. """
+    def __init__(self, pid, stdin, stdout):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.returncode = None
+
+    def set_status(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.set_status(status)
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, 0)
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    raise
+                continue
+            self.set_status(status)
+        return self.returncode
+
+
+def spawn_command(args, stdin=False):
+    """ Start `args` with stdout and stderr to a pipe (and stdin from a pipe if `stdin`).
+
+        With python < 3.10, `subprocess.Popen` forks, copying the memory of the daemon:
+        posix_spawn (python 3.8 and 3.9) starts the child without it. From python 3.10,
+        Popen uses vfork and is faster. Return a Popen-like object.
+        """
+    if not hasattr(os, 'posix_spawnp') or sys.version_info >= (3, 10):
+        return subprocess.Popen(args, stdin=subprocess.PIPE if stdin else None, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    # the pipes are close-on-exec, the child only gets the copies made by dup2
+    stdout_r, stdout_w = os.pipe()
+    actions = [(os.POSIX_SPAWN_DUP2, stdout_w, 1), (os.POSIX_SPAWN_DUP2, stdout_w, 2)]
+    stdin_r = stdin_w = None
+    if stdin:
+        stdin_r, stdin_w = os.pipe()
+        actions.append((os.POSIX_SPAWN_DUP2, stdin_r, 0))
+    try:
+        # restore the signals python ignores, as Popen does
+        pid = os.posix_spawnp(args[0], args, os.environ, file_actions=actions, setsigdef=SPAWN_DEFAULT_SIGNALS)
+    except Exception:
+        for fd in (stdout_r, stdin_w):
+            if fd is not None:
+                os.close(fd)
+        raise
+    finally:
+        for fd in (stdout_w, stdin_r):
+            if fd is not None:
+                os.close(fd)
+    return SpawnedProcess(pid, os.fdopen(stdin_w, 'wb') if stdin else None, os.fdopen(stdout_r, 'rb'))
+
+
+def watch_manager():
+    """ A `pyinotify.WatchManager` whose inotify fd is not inherited by the commands. """
+    wm = pyinotify.WatchManager()
+    fd = wm.get_fd()
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return wm
+
+
 # from http://stackoverflow.com/questions/35817/how-to-escape-os-system-calls-in-python
 def shellquote(s):
     # prevent converting unicode to str on python2 (causes UnicodeEncodeError)
@@ -218,249 +808,3740 @@ def shellquote(s):
     return "'" + s.replace("'", "'\\''") + "'"
 
 
-def post_action(cmd, job, output):
+def decode_output(output):
+    """ Convert command output to unicode, guessing its encoding from a sample.
+        """
+    sample = output[:OUTPUT_SAMPLE]
+    try:
+        # fast path: the sample is valid UTF-8, but for a character cut at its end
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        enc = 'utf-8'
+    except UnicodeDecodeError:
+        enc = chardet.detect(sample)['encoding']
+    return output.decode(enc, 'replace')
+
+
+def post_action(cmd, job, output, runner=None, stdindata=None):
     if not cmd:
         return
     try:
         # convert output to unicode
-        enc = chardet.detect(output)['encoding']
-        output = output.decode(enc)
+        output = decode_output(output)
     except Exception as err:
         logger.exception("Failed to convert output:")
         output = "unparsable output"
 
     t = string.Template(cmd)
     command = t.substitute(job=shellquote(job),
-                           host=shellquote(socket.gethostname()),
+                           host=shellquote(HOSTNAME),
                            output=shellquote(output))
+    if runner is not None:
+        runner.post_action(command)
+        return
     try:
-        output = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
+        process = subprocess.Popen(command, stdin=subprocess.PIPE if stdindata is not None else None,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
+        output = process.communicate(stdindata)[0]
+    except (IOError, OSError) as err:
+        logger.error("post action failed: %s", err)
+        return
+    if process.returncode == 0:
         logger.debug("post action succeed: '%s'", output)
-    except subprocess.CalledProcessError as err:
-        logger.error("post action failed, return code was %s: '%s'", err.returncode, err.output)
+    else:
+        logger.error("post action failed, return code was %s: '%s'", process.returncode, output)
 
 
-def process_report(process, opts, stdoutdata):
-    prefix = "Child {0}".format(process.pid) if opts['background'] else "Command"
-    if process.returncode == 0:
-        post_action(opts['action_on_success'], opts['job'], stdoutdata)
-        msg = "{0} finished successfully".format(prefix)
+def post_outcome(opts, action, output, event=None, returncode=None):
+    """ Run the post `action` ('action_on_success' or 'action_on_failure') of a job for the
+        `output` of the command of `event`, or add the outcome to the digest of the action.
+        """
+    digest = opts['digests'].get(action)
+    if digest is None:
+        post_action(opts[action], opts['job'], output, runner=opts.get('runner'))
+        return
+    pathname = None
+    if event is not None:
+        pathname = event.pathname
+        others = len(getattr(event, 'pathnames', ())) - 1
+        if others > 0:
+            pathname = "{0} and {1} other files".format(pathname, others)
+    digest.add((time.time(), pathname, returncode, output[-DIGEST_TAIL:]))
+
+
+class Digest(object):
+    """ Collect the outcomes of the commands of a job so that a post action runs once for several of them.
+
+        The outcomes, (time, pathname, return code, output) tuples, are passed
+        to `callback` as a list `wait` seconds after the first one, or once
+        `size` of them are collected. If `first` is set, an outcome coming
+        `wait` seconds or more after the last list is passed alone at once,
+        the next ones being collected until `wait` seconds after it.
+        """
+    def __init__(self, callback, wait, size, first=False, name=None):
+        self.callback = callback
+        self.wait = wait
+        self.size = size
+        self.first = first
+        self.cond = threading.Condition()
+        self.outcomes = []
+        self.due = None
+        self.last = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, outcome):
+        with self.cond:
+            if not self.closed:
+                self.outcomes.append(outcome)
+                if len(self.outcomes) == 1:
+                    now = time.time()
+                    if not self.first:
+                        self.due = now + self.wait
+                    elif self.last is None:
+                        self.due = now
+                    else:
+                        self.due = max(now, self.last + self.wait)
+                    self.cond.notify()
+                elif len(self.outcomes) >= self.size:
+                    self.cond.notify()
+                return
+        # a command started before the digest was closed
+        self.callback([outcome])
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.outcomes:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                    continue
+                remaining = self.due - time.time()
+                if len(self.outcomes) < self.size and remaining > 0 and not self.closed:
+                    self.cond.wait(remaining)
+                    continue
+                outcomes, self.outcomes = self.outcomes, []
+                self.last = time.time()
+            try:
+                self.callback(outcomes)
+            except Exception:
+                logger.exception("Failed to run digest:")
+
+    def close(self):
+        """ Pass the pending outcomes to `callback` at once, and stop the thread. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+def post_digest(opts, action, outcomes):
+    """ Run the post `action` of a job once for the `outcomes` of a `Digest`.
+
+        A single outcome gets its output as $output, several get a summary;
+        the list of the outcomes is written to the stdin of the action.
+        """
+    lines = []
+    for when, pathname, returncode, output in outcomes:
+        lines.append("{0} {1}{2}".format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)),
+                                         pathname or "-",
+                                         " (return code {0})".format(returncode) if returncode is not None else ""))
+        try:
+            output = decode_output(output)
+        except Exception:
+            output = "unparsable output"
+        lines.extend("    " + line for line in output.rstrip().splitlines())
+    if len(outcomes) == 1:
+        summary = outcomes[0][3]
     else:
-        post_action(opts['action_on_failure'], opts['job'], stdoutdata)
-        msg = "{0} failed, return code was {1}".format(prefix, process.returncode)
-    logger.info(msg)
-
-    if opts['log_output']:
-        if opts['outfile']:
-            with open(opts['outfile'], 'a+b') as fh:
-                fh.write(stdoutdata)
-        else:
-            logger.info("Output was: '%s'", stdoutdata)
+        summary = "{0} commands {1} from {2} to {3}".format(
+            len(outcomes), 'succeeded' if action == 'action_on_success' else 'failed',
+            time.strftime('%H:%M:%S', time.localtime(outcomes[0][0])),
+            time.strftime('%H:%M:%S', time.localtime(outcomes[-1][0])))
+        codes = collections.Counter(outcome[2] for outcome in outcomes if outcome[2] is not None)
+        if codes and action == 'action_on_failure':
+            summary += " (return codes: {0})".format(', '.join(
+                "{0} x{1}".format(code, count) for code, count in sorted(codes.items())))
+        summary = summary.encode('utf-8')
+    logger.info("%s: running %s for a digest of %d commands", opts['job'], action, len(outcomes))
+    # from the thread of the digest, the engine being possibly stopped
+    post_action(opts[action], opts['job'], summary, stdindata='\n'.join(lines).encode('utf-8') + b'\n')
 
 
-class EventHandler(pyinotify.ProcessEvent):
-    def __init__(self, **opts):
-        pyinotify.ProcessEvent.__init__(self)
-        self.opts = opts
+class AsyncLogHandler(logging.Handler):
+    """ Hand the records to a thread writing them with `target` in batches, flushed once per
+        batch, so that the threads handling events never wait for the log file.
 
-    def runCommand(self, event):
-        # if specified, exclude extensions, or include extensions.
-        if self.opts['include_extensions'] and all(not event.pathname.endswith(ext) for ext in self.opts['include_extensions']):
-            logger.debug("File '%s' excluded because its extension is not in the included extensions %r", event.pathname, self.opts['include_extensions'])
-            return
-        if self.opts['exclude_extensions'] and any(event.pathname.endswith(ext) for ext in self.opts['exclude_extensions']):
-            logger.debug("File '%s' excluded because its extension is in the excluded extensions %r", event.pathname, self.opts['exclude_extensions'])
-            return
-        if self.opts['exclude_re'] and self.opts['exclude_re'].search(os.path.basename(event.pathname)):
-            logger.debug("File '%s' excluded because its name matched exclude regexp '%s'", event.pathname, self.opts['exclude_re'].pattern)
-            return
+        Records are written directly until `start()` is called, as the daemon forks after
+        logging is set up. The queue holds up to `size` records: when it is full, records
+        below WARNING are dropped and counted, the others wait for room.
+        """
+    def __init__(self, target, size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log')
+        self.thread.daemon = True
+        self.thread.start()
 
-        t = string.Template(self.opts['command'])
-        command = t.substitute(job=shellquote(self.opts['job']),
-                               folder=shellquote(self.opts['folder']),
-                               watched=shellquote(event.path),
-                               filename=shellquote(event.pathname),
-                               tflags=shellquote(event.maskname),
-                               nflags=shellquote(event.mask),
-                               cookie=shellquote(event.cookie if hasattr(event, "cookie") else 0))
+    def emit(self, record):
+        if self.thread is None:
+            self.target.handle(record)
+            return
         try:
-            args = shlex.split(command)
-            if not self.opts['background']:
-                # sync exec
-                logger.info("Running command: '%s'", command)
-                process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                stdoutdata, _ = process.communicate()
-                process_report(process, self.opts, stdoutdata)
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
             else:
-                # async exec
-                process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                logger.info("Executed child (%s): '%s'", process.pid, command)
-                processes[process] = self.opts
-        except Exception as err:
-            logger.exception("Failed to run command '%s':", command)
+                self.queue.put(record)
 
-    def process_IN_ACCESS(self, event):
-        # print "Access: %s"%(event.pathname)
-        logger.info("Access: %s", event.pathname)
-        self.runCommand(event)
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < LOG_BATCH:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            self.write([record for record in records if record is not None])
+            if None in records:
+                return
 
-    def process_IN_ATTRIB(self, event):
-        # print "Attrib: %s"%(event.pathname)
-        logger.info("Attrib: %s", event.pathname)
-        self.runCommand(event)
+    def write(self, records):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(logging.LogRecord(logger.name, logging.WARNING, __file__, 0,
+                                             "%d log records dropped, the log queue was full", (dropped,), None))
+        terminator = getattr(self.target, 'terminator', '\n')
+        self.target.acquire()
+        try:
+            for record in records:
+                try:
+                    self.target.stream.write(self.target.format(record) + terminator)
+                except Exception:
+                    self.target.handleError(record)
+            self.target.flush()
+        finally:
+            self.target.release()
 
-    def process_IN_CLOSE_WRITE(self, event):
-        # print "Close write: %s"%(event.pathname)
-        logger.info("Close write: %s", event.pathname)
-        self.runCommand(event)
+    def close(self):
+        """ Write the queued records and stop the thread. """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        logging.Handler.close(self)
 
-    def process_IN_CLOSE_NOWRITE(self, event):
-        # print "Close nowrite: %s"%(event.pathname)
-        logger.info("Close nowrite: %s", event.pathname)
-        self.runCommand(event)
 
-    def process_IN_CREATE(self, event):
-        # print "Creating: %s"%(event.pathname)
-        logger.info("Creating: %s", event.pathname)
-        self.runCommand(event)
+class LogLimiter(object):
+    """ Let at most `rate` records per second through (no limit if None), counting the others.
 
-    def process_IN_DELETE(self, event):
-        # print "Deleting: %s"%(event.pathname)
-        logger.info("Deleting: %s", event.pathname)
-        self.runCommand(event)
+        Their number is logged by the first record let through in the next second, or by `flush()`,
+        called by a timer at the end of the second if the job logs nothing more.
+        """
+    def __init__(self, rate, name):
+        self.rate = rate
+        self.name = name
+        self.window = 0
+        self.count = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+        self.timer = None  # flushing the records suppressed in the current second
 
-    def process_IN_MODIFY(self, event):
-        # print "Modify: %s"%(event.pathname)
-        logger.info("Modify: %s", event.pathname)
-        self.runCommand(event)
+    def allow(self):
+        if not self.rate:
+            return True
+        now = time.time()
+        if now - self.window >= 1:
+            self.flush()
+            self.window = now
+            self.count = 0
+        self.count += 1
+        if self.count > self.rate:
+            with self.lock:
+                self.suppressed += 1
+                if self.timer is None:
+                    self.timer = threading.Timer(max(self.window + 1 - now, 0), self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+            return False
+        return True
 
-    def process_IN_MOVE_SELF(self, event):
-        # print "Move self: %s"%(event.pathname)
-        logger.info("Move self: %s", event.pathname)
-        self.runCommand(event)
+    def flush(self):
+        with self.lock:
+            suppressed, self.suppressed = self.suppressed, 0
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if suppressed:
+            logger.info("%s: %d records about events and commands not logged (more than %g per second)",
+                        self.name, suppressed, self.rate)
 
-    def process_IN_MOVED_FROM(self, event):
-        # print "Moved from: %s"%(event.pathname)
-        logger.info("Moved from: %s", event.pathname)
-        self.runCommand(event)
 
-    def process_IN_MOVED_TO(self, event):
-        # print "Moved to: %s"%(event.pathname)
-        logger.info("Moved to: %s", event.pathname)
-        self.runCommand(event)
+def log_event(opts, msg, *args, **kwargs):
+    """ Log a record about an event or a command of a job, unless the job logged too many lately.
 
-    def process_IN_OPEN(self, event):
-        # print "Opened: %s"%(event.pathname)
-        logger.info("Opened: %s", event.pathname)
-        self.runCommand(event)
+        Logged at level `level` (keyword argument), INFO by default.
+        """
+    limiter = opts.get('log_limiter')
+    if limiter is None or limiter.allow():
+        logger.log(kwargs.get('level', logging.INFO), msg, *args)
 
 
-def watcher(config):
-    wdds = dict()
-    notifiers = dict()
+class OutputCapture(object):
+    """ Output of a command, written to the job `outfile` (or logged) as it comes.
 
-    # read jobs from config file
-    for section in config.sections():
-        # mandatory opts
-        mask = parseMask(config.get(section, 'events').split(','))
-        folder = config.get(section, 'watch')
-        command = config.get(section, 'command')
-        # optional opts (i.e. with default values)
-        recursive = config.getboolean(section, 'recursive')
-        autoadd = config.getboolean(section, 'autoadd')
-        excluded = None if not config.get(section, 'excluded') else set(config.get(section, 'excluded').split(','))
-        include_extensions = None if not config.get(section, 'include_extensions') else set(config.get(section, 'include_extensions').split(','))
-        exclude_extensions = None if not config.get(section, 'exclude_extensions') else set(config.get(section, 'exclude_extensions').split(','))
-        exclude_re = None if not config.get(section, 'exclude_re') else re.compile(config.get(section, 'exclude_re'))
-        background = config.getboolean(section, 'background')
-        log_output = config.getboolean(section, 'log_output')
-
-        outfile = config.get(section, 'outfile')
-        if outfile:
-            t = string.Template(outfile)
-            outfile = t.substitute(job=section)
-            if log_output:
-                logger.debug("logging '%s' output to '%s'", section, outfile)
-        elif log_output:
-            logger.debug("logging '%s' output to daemon log", section)
-
-        action_on_success = config.get(section, 'action_on_success')
-        action_on_failure = config.get(section, 'action_on_failure')
-
-        logger.info("%s: watching '%s'", section, folder)
-
-        # parse include_extensions
-        if include_extensions and 'video' in include_extensions:
-            include_extensions.discard('video')
-            include_extensions |= set(VIDEO_EXTENSIONS)
-
-        wm = pyinotify.WatchManager()
-        handler = EventHandler(job=section,
-                               folder=folder,
-                               command=command,
-                               log_output=log_output,
-                               include_extensions=include_extensions,
-                               exclude_extensions=exclude_extensions,
-                               exclude_re=exclude_re,
-                               background=background,
-                               action_on_success=action_on_success,
-                               action_on_failure=action_on_failure,
-                               outfile=outfile
-                               )
-
-        wdds[section] = wm.add_watch(folder, mask, rec=recursive, auto_add=autoadd)
-        # Remove watch about excluded dir.
-        if excluded:
-            for excluded_dir in excluded:
-                for (k, v) in wdds[section].items():
-                    try:
-                        if k.startswith(excluded_dir):
-                            wm.rm_watch(v)
-                            wdds[section].pop(k)
-                    except UnicodeDecodeError as ex:
-                        logger.exception("Failed to check exclude for %r (decoding error)", k)
-                logger.debug("Excluded dirs : %s", excluded_dir)
-        # Create ThreadNotifier so that each job has its own thread
-        notifiers[section] = pyinotify.ThreadedNotifier(wm, handler)
-        notifiers[section].setName(section)
+        Only its first and last `output_limit` / 2 bytes are kept in memory,
+        for the $output of the post actions.
+        """
+    def __init__(self, opts):
+        self.opts = opts
+        self.size = opts['output_limit'] // 2 if opts['output_limit'] else None
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self.fh = None
+        if opts['log_output'] and opts['outfile']:
+            try:
+                self.fh = open(opts['outfile'], 'a+b')
+            except (IOError, OSError) as err:
+                logger.error("Failed to open '%s': %s", opts['outfile'], err)
+
+    def write(self, chunk):
+        if self.opts['log_output']:
+            if self.fh:
+                self.fh.write(chunk)
+            elif not self.opts['outfile']:
+                logger.info("Output was: '%s'", chunk)
+        self.total += len(chunk)
+        if self.size is None:
+            self.head += chunk
+            return
+        room = self.size - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        self.tail += chunk
+        # trim the tail once in a while rather than on every chunk
+        if len(self.tail) > 2 * self.size:
+            del self.tail[:-self.size]
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def output(self):
+        """ Captured output, with a mark in place of its skipped middle part. """
+        skipped = self.total - len(self.head) - self.size if self.size is not None else 0
+        if skipped <= 0:
+            return bytes(self.head + self.tail)
+        mark = "\n[... {0} bytes skipped ...]\n".format(skipped).encode('ascii')
+        return bytes(self.head) + mark + bytes(self.tail[-self.size:])
+
+
+def process_report(process, opts, capture, retry=False, event=None):
+    capture.close()
+    stdoutdata = capture.output()
+    prefix = "Child {0}".format(process.pid) if opts['background'] else "Command"
+    if process.returncode == 0:
+        post_outcome(opts, 'action_on_success', stdoutdata, event, process.returncode)
+        log_event(opts, "%s finished successfully", prefix)
+        return
+    elif retry:
+        # 'action_on_failure' is kept for the last attempt
+        log_event(opts, "%s failed, return code was %s, it will be retried", prefix, process.returncode,
+                  level=logging.WARNING)
+    else:
+        post_outcome(opts, 'action_on_failure', stdoutdata, event, process.returncode)
+        log_event(opts, "%s failed, return code was %s", prefix, process.returncode, level=logging.ERROR)
+
+
+def set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
 
-    # Start all the notifiers.
-    for (name, notifier) in notifiers.items():
-        try:
-            notifier.start()
-            logger.debug('Notifier for %s is instanciated', name)
-        except pyinotify.NotifierError as err:
-            logger.warning('%r %r', sys.stderr, err)
 
-    # Wait for SIGTERM
+def pidfd_supported():
+    """ Tell whether the running Python and kernel provide pidfds (Python>=3.9, Linux>=5.3). """
     try:
-        while 1:
+        os.close(os.pidfd_open(os.getpid()))
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+class Reaper(object):
+    """ Collect the output and exit status of the background children as they come.
+
+        The stdout pipes of the children are polled so that their output is
+        drained as it is written. Their exits are notified by a pidfd per child
+        when the kernel supports it, or else by SIGCHLD through a wakeup pipe.
+        `run()` must be called from the main thread.
+        """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.poller = select.poll()
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            set_nonblocking(fd)
+        self.poller.register(self.wakeup[0], select.POLLIN)
+        self.new = collections.deque()  # (process, opts, report) spawned by other threads
+        self.children = {}  # process -> [opts, OutputCapture, stdout fd, pidfd, report]
+        self.fds = {}  # polled fd -> process
+        self.use_pidfd = pidfd_supported()
+
+    def add(self, process, opts, report):
+        """ Collect a new child, can be called from any thread.
+
+            `report(process, capture)` is called once it exited.
+            """
+        self.new.append((process, opts, report))
+        try:
+            os.write(self.wakeup[1], b'\0')
+        except OSError:
+            pass  # the pipe is full, the poll loop is already woken up
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup[0], 4096):
+                pass
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def watch(self, fd, process):
+        self.fds[fd] = process
+        self.poller.register(fd, select.POLLIN)
+
+    def unwatch(self, fd):
+        if self.fds.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+
+    def register(self):
+        while self.new:
+            process, opts, report = self.new.popleft()
+            stdout = process.stdout.fileno()
+            set_nonblocking(stdout)
+            pidfd = os.pidfd_open(process.pid) if self.use_pidfd else None
+            self.children[process] = [opts, OutputCapture(opts), stdout, pidfd, report]
+            self.watch(stdout, process)
+            if pidfd is not None:
+                self.watch(pidfd, process)
+            elif process.poll() is not None:
+                # exited before being registered, its SIGCHLD is gone
+                self.finish(process)
+
+    def read(self, process):
+        """ Drain the available output of `process`, return False at end of file. """
+        entry = self.children[process]
+        while True:
             try:
-                # build new list as we want to change dict on-fly
-                for process, opts in list(processes.items()):
-                    if process.poll() is not None:
-                        stdoutdata = process.stdout.read()
-                        process_report(process, opts, stdoutdata)
-                        del processes[process]
-            except Exception as err:
-                logger.exception("Failed to collect children:")
-            time.sleep(0.1)
-    except:
-        cleanup_notifiers(notifiers)
+                chunk = os.read(entry[2], 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                raise
+            if not chunk:
+                return False
+            entry[1].write(chunk)
 
+    def finish(self, process):
+        self.read(process)
+        opts, capture, stdout, pidfd, report = self.children.pop(process)
+        self.unwatch(stdout)
+        if pidfd is not None:
+            self.unwatch(pidfd)
+            os.close(pidfd)
+        process.stdout.close()
+        process.wait()
+        try:
+            report(process, capture)
+        finally:
+            self.scheduler.done(opts['job'])
 
-def cleanup_notifiers(notifiers):
-    """Close notifiers instances when the process is killed
-    """
-    for notifier in notifiers.values():
-        notifier.stop()
+    def run(self):
+        if not self.use_pidfd:
+            signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+            signal.siginterrupt(signal.SIGCHLD, False)
+            signal.set_wakeup_fd(self.wakeup[1])
+        while True:
+            for (fd, event) in self.poller.poll():
+                try:
+                    if fd == self.wakeup[0]:
+                        self.drain_wakeup()
+                        self.register()
+                        if not self.use_pidfd:
+                            for process in [p for p in self.children if p.poll() is not None]:
+                                self.finish(process)
+                        continue
+                    process = self.fds.get(fd)
+                    if process is None:
+                        continue  # finished earlier in this round
+                    if fd == self.children[process][3]:
+                        self.finish(process)
+                    elif not self.read(process):
+                        self.unwatch(fd)
+                        if not self.use_pidfd and process.poll() is not None:
+                            self.finish(process)
+                except OSError as err:
+                    if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        logger.exception("Failed to collect children:")
+                except Exception as err:
+                    logger.exception("Failed to collect children:")
 
 
-def parseMask(masks):
-    ret = False
+class ChildProtocol(asyncio.SubprocessProtocol if asyncio is not None else object):
+    """ Output and exit of a child of the event loop: `done(returncode)` is called once it exited
+        and its output was read, or `CHILD_OUTPUT_GRACE` seconds after it exited if its
+        stdout is still open (e.g. by a child of its own).
+        """
+    def __init__(self, loop, write, done):
+        self.loop = loop
+        self.write = write
+        self.done = done
+        self.transport = None
+        self.exited = False
+        self.closed = False
+        self.reported = False
 
-    for mask in masks:
-        mask = mask.strip()
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pipe_data_received(self, fd, data):
+        self.write(data)
+
+    def pipe_connection_lost(self, fd, exc):
+        if fd == 1:
+            self.closed = True
+            self.finish()
+
+    def process_exited(self):
+        self.exited = True
+        if not self.closed:
+            self.loop.call_later(CHILD_OUTPUT_GRACE, self.finish, True)
+        self.finish()
+
+    def finish(self, late=False):
+        if self.reported or not self.exited or not (self.closed or late):
+            return
+        self.reported = True
+        self.transport.close()
+        self.done(self.transport.get_returncode())
+
+
+class AsyncRunner(object):
+    """ Run the commands of the jobs as children of an asyncio event loop (engine 'asyncio').
+
+        The output of the children is read as it comes and their exits are
+        reported from the loop, with neither a thread nor a poll loop per
+        child. The commands of the jobs without 'background' run one at a time
+        per job, in order, without delaying the events of the other jobs.
+        Methods can be called from any thread; `run()` runs the loop, from the
+        main thread.
+        """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.serial = {}  # job -> deque of the (handler, args, command, stdindata, event) of its commands
+        self.intake = None  # fd of the notifier and its reader, paused while queues are full
+        self.paused = set()  # the scheduler and the handlers whose queue is full
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def call(self, func, *args):
+        """ Call `func(*args)` from the loop. """
+        if self.in_loop():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def run(self):
+        self.thread = threading.current_thread()
+        asyncio.set_event_loop(self.loop)
+        # the default child watcher of python < 3.12 waits for each child from a thread of its own
+        if sys.version_info < (3, 12) and hasattr(asyncio, 'PidfdChildWatcher') and pidfd_supported():
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(self.loop)
+            asyncio.set_child_watcher(watcher)
+        self.loop.run_forever()
+
+    def pause(self, holder):
+        """ Stop reading the events until `holder` resumes, as blocking the loop until room is made
+            in its queue would prevent it.
+            """
+        if self.intake is not None and holder not in self.paused:
+            if not self.paused:
+                self.loop.remove_reader(self.intake[0])
+                logger.debug("Queues full, events are read again once commands complete")
+            self.paused.add(holder)
+
+    def resume(self, holder):
+        if self.intake is not None and holder in self.paused:
+            self.paused.discard(holder)
+            if not self.paused:
+                self.loop.add_reader(*self.intake)
+
+    def start(self, handler, args, command, stdindata, report):
+        """ Start `args`, calling `report(process, capture)` once it exited, or None if it could not start. """
+        capture = OutputCapture(handler.opts)
+        process = SpawnedProcess(None, None, None)
+
+        def done(returncode):
+            process.returncode = returncode
+            report(process, capture)
+
+        def started(future):
+            try:
+                transport, protocol = future.result()
+            except Exception:
+                logger.exception("Failed to run command '%s':", command)
+                capture.close()
+                report(None, capture)
+                return
+            process.pid = transport.get_pid()
+            if stdindata is not None:
+                stdin = transport.get_pipe_transport(0)
+                stdin.write(stdindata)
+                stdin.close()
+            if handler.opts['background']:
+                log_event(handler.opts, "Executed child (%s): '%s'", process.pid, command)
+
+        future = self.loop.create_task(self.loop.subprocess_exec(
+            lambda: ChildProtocol(self.loop, capture.write, done), *args,
+            stdin=subprocess.PIPE if stdindata is not None else None, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT))
+        future.add_done_callback(started)
+
+    def run_command(self, handler, args, command, stdindata, event):
+        """ Queue the command of `event` of a job without 'background'. """
+        self.call(self.enqueue, (handler, args, command, stdindata, event))
+
+    def enqueue(self, task):
+        queue = self.serial.setdefault(task[0].opts['job'], collections.deque())
+        queue.append(task)
+        if len(queue) == 1:
+            self.next(queue)
+        else:
+            logger.debug("%s: %d commands waiting for the running one", task[0].opts['job'], len(queue) - 1)
+
+    def next(self, queue):
+        handler, args, command, stdindata, event = queue[0]
+
+        def report(process, capture):
+            try:
+                if process is None:
+                    handler.finished(event, retry=handler.can_retry(event))
+                else:
+                    handler.report(process, capture, event)
+            finally:
+                queue.popleft()
+                if queue:
+                    self.next(queue)
+
+        log_event(handler.opts, "Running command: '%s'", command)
+        handler.spawned(event)
+        self.start(handler, args, command, stdindata, report)
+
+    def spawn(self, handler, args, command, stdindata, waited, event):
+        """ Start the background command of `event`, its slot being taken from the scheduler. """
+        if waited is not None:
+            logger.debug("Command waited %.3fs in queue: '%s'", waited, command)
+
+        def report(process, capture):
+            try:
+                if process is None:
+                    handler.finished(event, retry=handler.can_retry(event))
+                else:
+                    handler.report(process, capture, event)
+            finally:
+                self.scheduler.done(handler.opts['job'])
+
+        self.call(self.start, handler, args, command, stdindata, report)
+
+    def post_action(self, command):
+        """ Run the post action `command` through the shell, logging its result. """
+        output = bytearray()
+
+        def done(returncode):
+            if returncode == 0:
+                logger.debug("post action succeed: '%s'", bytes(output))
+            else:
+                logger.error("post action failed, return code was %s: '%s'", returncode, bytes(output))
+
+        def started(future):
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Failed to run post action '%s':", command)
+
+        def run():
+            future = self.loop.create_task(self.loop.subprocess_shell(
+                lambda: ChildProtocol(self.loop, output.extend, done), command,
+                stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+            future.add_done_callback(started)
+        self.call(run)
+
+
+class JobQueue(object):
+    """ Background commands of a job waiting for a free slot, and their counters. """
+    def __init__(self, handler):
+        self.handler = handler
+        self.tasks = collections.deque()  # [key, args, command, stdindata, submit time, event]
+        self.keys = {}  # key -> queued task, for the 'coalesce' policy
+        self.running = 0
+        self.started = 0
+        self.wait = Histogram()  # of the time spent in queue by the started commands
+        self.dropped = 0
+        self.coalesced = 0
+
+    def pop(self):
+        task = self.tasks.popleft()
+        if self.keys.get(task[0]) is task:
+            del self.keys[task[0]]
+        return task
+
+
+class Scheduler(object):
+    """ Start the background commands of the jobs within concurrency limits.
+
+        A job runs at most `max_concurrency` commands at once, all the jobs at
+        most `max_children`. Commands beyond those limits wait in the FIFO queue
+        of their job and are started as running children complete, the jobs
+        being served in turn. When the queue of a job holds `queue_size`
+        commands, its `queue_policy` tells what happens to a new one:
+          * 'block': wait for room in the queue (default)
+          * 'drop_oldest': drop the oldest queued command
+          * 'drop_newest': drop the new command
+          * 'coalesce': replace the queued command of the same file, if any,
+            otherwise wait for room in the queue
+        """
+    POLICIES = ('block', 'drop_oldest', 'drop_newest', 'coalesce')
+
+    def __init__(self, max_children=None):
+        self.max_children = max_children
+        self.cond = threading.Condition()
+        self.running = 0
+        self.queues = collections.OrderedDict()  # job -> JobQueue
+        self.runner = None  # the AsyncRunner of engine 'asyncio', whose loop must not block
+
+    def queue(self, handler):
+        queue = self.queues.get(handler.opts['job'])
+        if queue is None:
+            queue = self.queues[handler.opts['job']] = JobQueue(handler)
+        return queue
+
+    def replace(self, old, new):
+        """ Start the queued commands of the job of `old` with `new`, within the limits of `new`. """
+        with self.cond:
+            queue = self.queues.get(old.opts['job'])
+            if queue is not None and queue.handler is old:
+                queue.handler = new
+
+    def can_start(self, queue):
+        max_concurrency = queue.handler.opts['max_concurrency']
+        return ((not self.max_children or self.running < self.max_children) and
+                (not max_concurrency or queue.running < max_concurrency))
+
+    def full(self, queue):
+        size = queue.handler.opts['queue_size']
+        return size and len(queue.tasks) >= size
+
+    def reserve(self, queue):
+        self.running += 1
+        queue.running += 1
+        queue.started += 1
+
+    def submit(self, handler, key, args, command, stdindata, event):
+        """ Start a command, or queue it until the limits allow it.
+
+            `key` identifies the file of the command for the 'coalesce' policy.
+            Commands dropped or replaced are reported to `handler.finished`.
+            """
+        task = [key, args, command, stdindata, time.time(), event]
+        with self.cond:
+            queue = self.queue(handler)
+            size = handler.opts['queue_size']
+            policy = handler.opts['queue_policy']
+            while True:
+                if not queue.tasks and self.can_start(queue):
+                    self.reserve(queue)
+                    queue.wait.observe(0.0)
+                    break
+                if policy == 'coalesce' and key is not None and key in queue.keys:
+                    replaced = queue.keys[key][5]
+                    queue.keys[key][1:4] = task[1:4]
+                    queue.keys[key][5] = event
+                    queue.coalesced += 1
+                    handler.finished(replaced)
+                    logger.debug("Coalesced queued command for '%s'", key)
+                    return
+                if not size or len(queue.tasks) < size:
+                    queue.tasks.append(task)
+                    if key is not None:
+                        queue.keys[key] = task
+                    logger.debug("Queued command '%s' (%d queued)", command, len(queue.tasks))
+                    return
+                if policy == 'drop_oldest':
+                    queue.dropped += 1
+                    dropped = queue.pop()
+                    logger.warning("Queue of %s is full, dropped command '%s'", handler.opts['job'], dropped[2])
+                    handler.finished(dropped[5])
+                elif policy == 'drop_newest':
+                    queue.dropped += 1
+                    logger.warning("Queue of %s is full, dropped command '%s'", handler.opts['job'], command)
+                    handler.finished(event)
+                    return
+                elif self.runner is not None and self.runner.in_loop():
+                    # the completions making room come from the loop: queue it, and stop reading events instead
+                    queue.tasks.append(task)
+                    if key is not None:
+                        queue.keys[key] = task
+                    self.runner.pause(self)
+                    return
+                else:
+                    self.cond.wait()
+        handler.spawn(args, command, stdindata, None, event)
+
+    def done(self, job):
+        """ Release the slot of a completed command of `job` and start the queued ones it allows.
+            """
+        started = []
+        with self.cond:
+            self.running -= 1
+            self.queues[job].running -= 1
+            # serve the jobs in turn: the job just served goes to the end of the line
+            for name in list(self.queues):
+                queue = self.queues[name]
+                while queue.tasks and self.can_start(queue):
+                    self.reserve(queue)
+                    task = queue.pop()
+                    waited = time.time() - task[4]
+                    queue.wait.observe(waited)
+                    started.append((queue.handler, task, waited))
+                    self.queues[name] = self.queues.pop(name)
+                    break
+            self.cond.notify_all()
+            if self.runner is not None and not any(self.full(queue) for queue in self.queues.values()):
+                self.runner.call(self.runner.resume, self)
+        for (handler, task, waited) in started:
+            handler.spawn(task[1], task[2], task[3], waited, task[5])
+
+    def stats(self):
+        """ Running and queued commands of each job, and their wait time in queue.
+            """
+        with self.cond:
+            return dict((job, {'running': queue.running,
+                               'queued': len(queue.tasks),
+                               'started': queue.started,
+                               'dropped': queue.dropped,
+                               'coalesced': queue.coalesced,
+                               'wait': queue.wait})
+                        for (job, queue) in self.queues.items())
+
+
+class Debouncer(object):
+    """ Coalesce the events of a job on a same path until the path is quiet.
+
+        Events for a pending path (and mask, if `per_mask`) are merged into one
+        entry carrying the OR of their masks. The entry is passed to `callback`
+        once no event came for `quiet` seconds, or `max_wait` seconds after its
+        first event if set, from a thread of its own.
+        """
+    def __init__(self, callback, quiet, max_wait=None, per_mask=False, name=None):
+        self.callback = callback
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self.per_mask = per_mask
+        self.cond = threading.Condition()
+        # {key: [event, first seen, last seen]}, by last and first seen times
+        self.by_last = collections.OrderedDict()
+        self.by_first = collections.OrderedDict()
+        self.coalesced = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, event):
+        key = (event.pathname, event.mask) if self.per_mask else event.pathname
+        now = time.time()
+        with self.cond:
+            entry = self.by_last.pop(key, None)
+            if entry is None:
+                entry = [copy.copy(event), now, now]
+                self.by_first[key] = entry
+                self.cond.notify()
+            else:
+                merge_event(entry[0], event)
+                entry[2] = now
+                self.coalesced += 1
+                logger.debug("Coalesced %s on '%s'", event.maskname, event.pathname)
+            self.by_last[key] = entry
+
+    def pop_due(self, now):
+        """ Remove the entries due at `now`, return their events and the next deadline. """
+        due = []
+        while self.by_last:
+            key, entry = next(iter(self.by_last.items()))
+            if entry[2] + self.quiet > now:
+                break
+            due.append(self.by_last.pop(key)[0])
+            del self.by_first[key]
+        while self.max_wait is not None and self.by_first:
+            key, entry = next(iter(self.by_first.items()))
+            if entry[1] + self.max_wait > now:
+                break
+            due.append(self.by_first.pop(key)[0])
+            del self.by_last[key]
+
+        deadlines = []
+        if self.by_last:
+            deadlines.append(next(iter(self.by_last.values()))[2] + self.quiet)
+        if self.max_wait is not None and self.by_first:
+            deadlines.append(next(iter(self.by_first.values()))[1] + self.max_wait)
+        return due, min(deadlines) if deadlines else None
+
+    def run(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                # once closed, all the entries are due
+                due, deadline = self.pop_due(float('inf') if self.closed else now)
+                if not due:
+                    if self.closed:
+                        return
+                    self.cond.wait(None if deadline is None else deadline - now)
+                    continue
+            for event in due:
+                try:
+                    self.callback(event)
+                except Exception as err:
+                    logger.exception("Failed to process '%s':", event.pathname)
+
+    def close(self):
+        """ Pass the pending events to `callback` at once, and stop the thread. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+class Batcher(object):
+    """ Collect the events of a job so that its command runs once for several files.
+
+        A batch is passed to `callback` when it holds `size` files or `wait`
+        seconds after its first event, as a single event whose `pathnames`
+        attribute lists its files (`size` at most, the next ones starting a
+        new batch).
+        """
+    def __init__(self, callback, size, wait, name=None):
+        self.callback = callback
+        self.size = size
+        self.wait = wait
+        self.cond = threading.Condition()
+        self.events = collections.OrderedDict()  # pathname -> event
+        self.first = None
+        self.coalesced = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, event):
+        with self.cond:
+            merged = self.events.get(event.pathname)
+            if merged is not None:
+                merge_event(merged, event)
+                self.coalesced += 1
+                return
+            self.events[event.pathname] = copy.copy(event)
+            if len(self.events) == 1:
+                self.first = time.time()
+                self.cond.notify()
+            elif len(self.events) >= self.size:
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.events:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                    continue
+                remaining = self.first + self.wait - time.time()
+                if len(self.events) < self.size and remaining > 0 and not self.closed:
+                    self.cond.wait(remaining)
+                    continue
+                # more files may have come before the thread woke up
+                events = [self.events.popitem(last=False)[1] for i in range(min(len(self.events), self.size))]
+                if self.events:
+                    self.first = time.time()
+            batch = events[0]
+            for event in events[1:]:
+                merge_event(batch, event)
+            batch.pathnames = [event.pathname for event in events]
+            logger.debug("Running batch of %d files", len(events))
+            try:
+                self.callback(batch)
+            except Exception as err:
+                logger.exception("Failed to process batch:")
+
+    def close(self):
+        """ Pass the pending batch to `callback` at once, and stop the thread. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+class MovePairer(object):
+    """ Pair the IN_MOVED_FROM and IN_MOVED_TO events of a job sharing a cookie into rename events.
+
+        IN_MOVED_FROM events are held up to `wait` seconds, `size` at most (the
+        oldest are released first when more come). An IN_MOVED_TO of a held
+        cookie is passed to `callback` as a single event of the destination,
+        with both flags and the source path as its `renamed_from` attribute
+        (unlike the `src_pathname` pyinotify sets on any IN_MOVED_TO it paired).
+        The events not paired are passed as they are, with their label.
+        """
+    MOVES = pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+
+    def __init__(self, callback, wait, size, name=None):
+        self.callback = callback
+        self.wait = wait
+        self.size = size
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()  # cookie -> [event, label, time held], oldest first
+        self.paired = 0
+        self.unpaired = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, event, label):
+        cookie = getattr(event, 'cookie', 0)
+        if not cookie or not event.mask & self.MOVES:
+            self.callback(event, label)
+            return
+        released = []
+        moved_from = None
+        with self.cond:
+            if event.mask & pyinotify.IN_MOVED_FROM:
+                self.pending[cookie] = [event, label, time.time()]
+                if len(self.pending) == 1:
+                    self.cond.notify()
+                while len(self.pending) > self.size:
+                    released.append(self.pending.popitem(last=False)[1])
+            else:
+                moved_from = self.pending.pop(cookie, None)
+            self.unpaired += len(released)
+            if moved_from is not None:
+                self.paired += 1
+        for (held, held_label, _) in released:
+            self.callback(held, held_label)
+        if not event.mask & pyinotify.IN_MOVED_TO:
+            return
+        if moved_from is None:
+            self.callback(event, label)
+            return
+        renamed = copy.copy(event)
+        merge_event(renamed, moved_from[0])
+        renamed.renamed_from = moved_from[0].pathname
+        self.callback(renamed, "Renamed")
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.pending:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                    continue
+                remaining = next(iter(self.pending.values()))[2] + self.wait - time.time()
+                if remaining > 0 and not self.closed:
+                    self.cond.wait(remaining)
+                    continue
+                held, label, _ = self.pending.popitem(last=False)[1]
+                self.unpaired += 1
+            try:
+                self.callback(held, label)
+            except Exception as err:
+                logger.exception("Failed to process '%s':", held.pathname)
+
+    def close(self):
+        """ Pass the held events to `callback` at once, and stop the thread. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+class TreeIndex(object):
+    """ Modification time, size and inode of the files of a job's tree, as last seen.
+
+        When events were lost (the inotify queue overflowed), scanning the tree
+        again finds the files created, modified or deleted meanwhile. Only the
+        directories whose mtime changed are listed again, the files of the
+        others are only stat'ed. The events of the job keep the index current
+        between two scans.
+        """
+    def __init__(self, top, rec, exclude_filter, accepts):
+        self.top = top
+        self.rec = rec
+        self.exclude_filter = exclude_filter
+        self.accepts = accepts
+        self.dirs = {}  # path -> [mtime (None to list it again), {name: (mtime, size, inode)}, [subdirs]]
+        self.lock = threading.Lock()
+
+    def scan_dir(self, path, indexed):
+        """ Return the index entry of directory `path`, or None if it is gone. """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        files = {}
+        if indexed is not None and indexed[0] == mtime:
+            # same entries as last time, only their contents may have changed
+            for name in list(indexed[1]):
+                try:
+                    st = os.lstat(os.path.join(path, name))
+                except OSError:
+                    continue
+                files[name] = (st.st_mtime, st.st_size, st.st_ino)
+            return [mtime, files, indexed[2]]
+        subdirs = []
+        own_listings.start(path)
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return None
+        finally:
+            own_listings.end(path)
+        for name in names:
+            pathname = os.path.join(path, name)
+            try:
+                st = os.lstat(pathname)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if not self.exclude_filter(pathname):
+                    subdirs.append(pathname)
+            elif self.accepts(pathname):
+                files[name] = (st.st_mtime, st.st_size, st.st_ino)
+        return [mtime, files, subdirs]
+
+    def scan(self):
+        """ Scan the tree, replacing the index.
+
+            Return the (pathname, change) of the files which changed since the
+            last scan, `change` being 'created', 'modified' or 'deleted', and
+            the directories which were not indexed.
+            """
+        dirs = {}
+        changes = []
+        new_dirs = []
+        stack = [self.top] if os.path.isdir(self.top) else []
+        while stack:
+            path = stack.pop()
+            indexed = self.dirs.get(path)
+            entry = self.scan_dir(path, indexed)
+            if entry is None:
+                continue
+            dirs[path] = entry
+            if indexed is None:
+                new_dirs.append(path)
+            files = dict(indexed[1]) if indexed is not None else {}
+            for name, state in entry[1].items():
+                before = files.pop(name, None)
+                if before is None:
+                    changes.append((os.path.join(path, name), 'created'))
+                elif before != state:
+                    changes.append((os.path.join(path, name), 'modified'))
+            changes.extend((os.path.join(path, name), 'deleted') for name in files)
+            if self.rec:
+                stack.extend(entry[2])
+        with self.lock:
+            for path, entry in self.dirs.items():
+                if path not in dirs:
+                    changes.extend((os.path.join(path, name), 'deleted') for name in entry[1])
+            self.dirs = dirs
+        return changes, new_dirs
+
+    def state(self, pathname):
+        """ Return the indexed (mtime, size, inode) of file `pathname`, or None. """
+        entry = self.dirs.get(os.path.dirname(pathname))
+        return entry[1].get(os.path.basename(pathname)) if entry is not None else None
+
+    def files(self):
+        """ Yield the (pathname, (mtime, size, inode)) of the indexed files. """
+        with self.lock:
+            dirs = [(path, list(entry[1].items())) for path, entry in self.dirs.items()]
+        for path, files in dirs:
+            for name, state in files:
+                yield os.path.join(path, name), state
+
+    def update(self, event):
+        """ Record the change notified by `event`. """
+        if event.dir:
+            with self.lock:
+                if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                    prefix = event.pathname + os.sep
+                    for path in [p for p in self.dirs if p == event.pathname or p.startswith(prefix)]:
+                        del self.dirs[path]
+                elif event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                    self.dirs.setdefault(event.pathname, [None, {}, []])
+            return
+        entry = self.dirs.get(event.path)
+        if entry is None or not self.accepts(event.pathname):
+            return
+        if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            entry[1].pop(event.name, None)
+            return
+        try:
+            st = os.lstat(event.pathname)
+        except OSError:
+            entry[1].pop(event.name, None)
+        else:
+            entry[1][event.name] = (st.st_mtime, st.st_size, st.st_ino)
+
+
+class StatLimiter(object):
+    """ Pace the stat calls of a scan to `rate` per second (no limit if None). """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.start = time.time()
+
+    def take(self):
+        """ Count a stat call, sleeping first if the scan is ahead of its rate. """
+        self.calls += 1
+        if self.rate:
+            ahead = self.calls / self.rate - (time.time() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class TreeSnapshot(object):
+    """ Compact copy of a job's tree, as last polled.
+
+        Each directory keeps its mtime, its subdirectories, and the sorted
+        names of its files with their mtime, size and inode in arrays. A
+        directory whose mtime did not change is not listed again; its files
+        are only stat'ed if `stat_files`, as their modifications are not seen
+        otherwise.
+        """
+    def __init__(self, top, rec, exclude_filter, accepts, stat_files=True, limiter=None):
+        self.top = top
+        self.rec = rec
+        self.exclude_filter = exclude_filter
+        self.accepts = accepts
+        self.stat_files = stat_files
+        self.limiter = limiter or StatLimiter()
+        self.dirs = {}  # path -> (mtime, names, mtimes, sizes, inodes, subdirs)
+
+    def list_dir(self, path):
+        """ Return the sorted names of the accepted files and the subdirectories of `path`, or None if it is gone. """
+        files = []
+        subdirs = []
+        try:
+            if scandir is not None:
+                entries = scandir(path)
+                try:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if is_dir:
+                            if not self.exclude_filter(entry.path):
+                                subdirs.append(entry.path)
+                        elif self.accepts(entry.path):
+                            files.append(entry.name)
+                finally:
+                    if hasattr(entries, 'close'):
+                        entries.close()
+            else:
+                for name in os.listdir(path):
+                    pathname = os.path.join(path, name)
+                    if os.path.isdir(pathname) and not os.path.islink(pathname):
+                        if not self.exclude_filter(pathname):
+                            subdirs.append(pathname)
+                    elif self.accepts(pathname):
+                        files.append(name)
+        except OSError:
+            return None
+        return sorted(files), tuple(sorted(subdirs))
+
+    def scan_dir(self, path, before, changes):
+        """ Return the snapshot of directory `path` (None if it is gone), adding its changes since `before` to `changes`.
+            """
+        self.limiter.take()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if before is not None and before[0] == mtime:
+            if not self.stat_files:
+                return before
+            names, subdirs = before[1], before[5]
+        else:
+            listed = self.list_dir(path)
+            if listed is None:
+                return None
+            names, subdirs = listed
+        previous = dict((name, i) for i, name in enumerate(before[1])) if before is not None else {}
+        kept = []
+        mtimes = array.array('d')
+        sizes = array.array('l')
+        inodes = array.array('L')
+        for name in names:
+            pathname = os.path.join(path, name)
+            self.limiter.take()
+            try:
+                st = os.lstat(pathname)
+            except OSError:
+                continue
+            kept.append(name)
+            mtimes.append(st.st_mtime)
+            sizes.append(st.st_size)
+            inodes.append(st.st_ino)
+            i = previous.pop(name, None)
+            if i is None:
+                changes.append((pathname, 'created'))
+            elif (before[2][i], before[3][i], before[4][i]) != (st.st_mtime, st.st_size, st.st_ino):
+                changes.append((pathname, 'modified'))
+        changes.extend((os.path.join(path, name), 'deleted') for name in previous)
+        return (mtime, tuple(kept), mtimes, sizes, inodes, subdirs)
+
+    def scan(self):
+        """ Scan the tree, replacing the snapshot.
+
+            Return the (pathname, change) of the files which changed since the
+            last scan, `change` being 'created', 'modified' or 'deleted'.
+            """
+        self.limiter.reset()
+        dirs = {}
+        changes = []
+        stack = [self.top] if os.path.isdir(self.top) else []
+        while stack:
+            path = stack.pop()
+            entry = self.scan_dir(path, self.dirs.get(path), changes)
+            if entry is None:
+                continue
+            dirs[path] = entry
+            if self.rec:
+                stack.extend(entry[5])
+        for path, entry in self.dirs.items():
+            if path not in dirs:
+                changes.extend((os.path.join(path, name), 'deleted') for name in entry[1])
+        self.dirs = dirs
+        return changes
+
+
+class Poller(object):
+    """ Send the events of the changes found by scanning a job's tree periodically, where inotify does not work.
+
+        The delay between two scans doubles from `interval` up to
+        `max_interval` while they find no change, and is back to `interval`
+        after a change. It is never shorter than the last scan took.
+        """
+    def __init__(self, handler, interval, max_interval, stat_rate=None):
+        opts = handler.opts
+        self.handler = handler
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.limiter = StatLimiter(stat_rate)
+        self.snapshot = TreeSnapshot(opts['folder'], opts['recursive'], handler.is_excluded, handler.accepts,
+                                     stat_files=bool(opts['mask'] & (pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE)),
+                                     limiter=self.limiter)
+        self.scans = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="{0}-poll".format(opts['job']))
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """ Stop polling, after the scan in progress if any. """
+        self.stopped.set()
+
+    def run(self):
+        job = self.handler.opts['job']
+        start = time.time()
+        self.snapshot.scan()
+        elapsed = time.time() - start
+        logger.info("%s: polling '%s', %d directories scanned in %.1fs (%d stat calls)",
+                    job, self.handler.opts['folder'], len(self.snapshot.dirs), elapsed, self.limiter.calls)
+        delay = self.interval
+        while not self.stopped.wait(max(delay, elapsed)):
+            start = time.time()
+            try:
+                changes = self.snapshot.scan()
+            except Exception:
+                logger.exception("%s: failed to poll '%s':", job, self.handler.opts['folder'])
+                changes = []
+            elapsed = time.time() - start
+            self.scans += 1
+            delay = self.interval if changes else min(delay * 2, self.max_interval)
+            logger.debug("%s: %d changes found in %.1fs (%d directories, %d stat calls), next scan in %.1fs",
+                         job, len(changes), elapsed, len(self.snapshot.dirs), self.limiter.calls, max(delay, elapsed))
+            if changes and not self.stopped.is_set():
+                self.handler.replay(changes)
+
+
+def path_hash(pathname):
+    """ 64-bit hash of `pathname`, as stored in state files. """
+    if not isinstance(pathname, bytes):
+        pathname = pathname.encode(sys.getfilesystemencoding() or 'utf-8')
+    return STATE_HASH.unpack(hashlib.sha1(pathname).digest()[:STATE_HASH.size])[0]
+
+
+class StateFile(object):
+    """ On-disk copy of a `TreeIndex`, to catch up with the changes made while watcher was down.
+
+        The file is a header followed by fixed-size records of the hash of the
+        path, mtime, size and inode of each file, read and written through mmap.
+        Other per-file states are saved the same way with their own `magic` and `record`.
+        """
+    def __init__(self, path, magic=STATE_MAGIC, record=STATE_RECORD):
+        self.path = path
+        self.magic = magic
+        self.record = record
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Return the {path hash: (mtime, size, inode)} dict of the file, or None if there is none. """
+        try:
+            with open(self.path, 'rb') as fh:
+                size = os.fstat(fh.fileno()).st_size
+                if size < STATE_HEADER.size:
+                    raise ValueError("truncated header")
+                data = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                logger.warning("Failed to read state file '%s': %s", self.path, err)
+            return None
+        except ValueError as err:
+            logger.warning("Ignoring state file '%s': %s", self.path, err)
+            return None
+        try:
+            magic, version, count = STATE_HEADER.unpack_from(data, 0)
+            if magic != self.magic or version != STATE_VERSION:
+                logger.warning("Ignoring state file '%s': not a state file of this version", self.path)
+                return None
+            if size < STATE_HEADER.size + count * self.record.size:
+                logger.warning("Ignoring state file '%s': truncated", self.path)
+                return None
+            files = {}
+            for offset in range(STATE_HEADER.size, STATE_HEADER.size + count * self.record.size, self.record.size):
+                record = self.record.unpack_from(data, offset)
+                files[record[0]] = record[1:]
+            return files
+        finally:
+            data.close()
+
+    def save(self, records):
+        """ Replace the file with the (path hash, state) `records`. """
+        size = STATE_HEADER.size + len(records) * self.record.size
+        tmp = "{0}.tmp".format(self.path)
+        with self.lock:
+            with open(tmp, 'w+b') as fh:
+                fh.truncate(size)
+                data = mmap.mmap(fh.fileno(), size)
+                try:
+                    STATE_HEADER.pack_into(data, 0, self.magic, STATE_VERSION, len(records))
+                    offset = STATE_HEADER.size
+                    for key, state in records:
+                        self.record.pack_into(data, offset, key, *state)
+                        offset += self.record.size
+                    data.flush()
+                finally:
+                    data.close()
+                os.fsync(fh.fileno())
+            os.rename(tmp, self.path)
+        logger.debug("Saved %d files to state file '%s'", len(records), self.path)
+
+
+def file_digest(pathname):
+    """ 128-bit BLAKE2 digest (MD5 if unavailable) of the contents of file `pathname`. """
+    digest = hashlib.blake2b(digest_size=16) if hasattr(hashlib, 'blake2b') else hashlib.md5()
+    # reads into a single buffer rather than mmap, which a writer truncating the file turns into a SIGBUS
+    buf = bytearray(DEDUP_CHUNK)
+    view = memoryview(buf)
+    with open(pathname, 'rb') as fh:
+        while True:
+            count = fh.readinto(buf)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.digest()
+
+
+class DedupCache(object):
+    """ Digests of the files a job's command last succeeded for, to skip it for files whose contents did not change.
+
+        A file whose mtime, size and inode are those of its last digest is not
+        hashed again. The `size` files used last are kept, by path hash, and
+        saved to the state file `path` if set.
+        """
+    def __init__(self, size, path=None):
+        self.size = size
+        self.files = collections.OrderedDict()  # path hash -> (mtime, size, inode, digest), least recently used first
+        self.pending = collections.OrderedDict()  # path hash -> state of the files whose command runs
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.state = StateFile(path, DEDUP_MAGIC, DEDUP_RECORD) if path else None
+        if self.state is not None:
+            for key, state in (self.state.load() or {}).items():
+                self.files[key] = state
+            self.trim(self.files)
+
+    def trim(self, files):
+        while len(files) > self.size:
+            files.popitem(last=False)
+
+    def check(self, pathname):
+        """ Tell whether the command must run for file `pathname`, i.e. unless it did not change. """
+        key = path_hash(pathname)
+        try:
+            st = os.stat(pathname)
+            if not stat.S_ISREG(st.st_mode):
+                return True
+            with self.lock:
+                cached = self.files.get(key)
+                if cached is not None and cached[:3] == (st.st_mtime, st.st_size, st.st_ino):
+                    self.files[key] = self.files.pop(key)
+                    self.hits += 1
+                    return False
+            digest = file_digest(pathname)
+        except (IOError, OSError) as err:
+            logger.debug("Failed to hash '%s': %s", pathname, err)
+            return True
+        state = (st.st_mtime, st.st_size, st.st_ino, digest)
+        with self.lock:
+            cached = self.files.pop(key, None)
+            if cached is not None and cached[3] == digest:
+                self.files[key] = state
+                self.hits += 1
+                return False
+            if cached is not None:
+                self.files[key] = cached
+            self.pending[key] = state
+            self.trim(self.pending)
+            self.misses += 1
+            return True
+
+    def commit(self, pathnames):
+        """ Record the digests of `pathnames`, whose command succeeded. """
+        with self.lock:
+            for pathname in pathnames:
+                key = path_hash(pathname)
+                state = self.pending.pop(key, None)
+                if state is not None:
+                    self.files.pop(key, None)
+                    self.files[key] = state
+            self.trim(self.files)
+
+    def forget(self, pathname):
+        key = path_hash(pathname)
+        with self.lock:
+            self.files.pop(key, None)
+            self.pending.pop(key, None)
+
+    def save(self):
+        with self.lock:
+            records = list(self.files.items())
+        self.state.save(records)
+
+
+def dump_event(event):
+    """ The fields of `event` needed to run its command, as a dict for the journal. """
+    record = {'mask': event.mask, 'path': event.path, 'name': event.name, 'dir': event.dir,
+              'cookie': getattr(event, 'cookie', 0)}
+    if hasattr(event, 'pathnames'):
+        record['pathnames'] = event.pathnames
+    if hasattr(event, 'renamed_from'):
+        record['renamed_from'] = event.renamed_from
+    return record
+
+
+def load_event(record):
+    """ The event dumped by `dump_event`. """
+    event = pyinotify.Event({'wd': -1, 'mask': record['mask'], 'path': record['path'], 'name': record['name'],
+                             'dir': record['dir'], 'cookie': record['cookie']})
+    if 'pathnames' in record:
+        event.pathnames = record['pathnames']
+    if 'renamed_from' in record:
+        event.renamed_from = record['renamed_from']
+    return event
+
+
+class Retrier(object):
+    """ Run the commands which failed again, once their backoff delay is over. """
+    def __init__(self, callback, name=None):
+        self.callback = callback
+        self.cond = threading.Condition()
+        self.due = []  # heap of (time, sequence, event)
+        self.sequence = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, event, delay):
+        with self.cond:
+            self.sequence += 1
+            heapq.heappush(self.due, (time.time() + delay, self.sequence, event))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.due:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                    continue
+                remaining = self.due[0][0] - time.time()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                event = heapq.heappop(self.due)[2]
+            try:
+                self.callback(event)
+            except Exception as err:
+                logger.exception("Failed to retry command:")
+
+    def close(self):
+        """ Stop the thread once the pending retries ran. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+class Journal(object):
+    """ Write-ahead journal of the commands of a job, so that those which did not
+        complete run again after a crash.
+
+        Records are JSON lines appended to the segment files ('<number>.journal')
+        of a directory: {"add": id, "event": {...}}, {"retry": id, "attempt": n}
+        and {"done": id}. A thread writes them, and fsyncs at most every `sync`
+        seconds so that many records share an fsync: a crash loses the records
+        of the last `sync` seconds at most. A new segment is started when the
+        current one holds `segment_size` bytes, and the older segments are
+        deleted once all their commands completed.
+        """
+    SUFFIX = '.journal'
+
+    def __init__(self, directory, sync=0.1, segment_size=4194304, name=None):
+        self.directory = directory
+        self.sync = sync
+        self.segment_size = segment_size
+        self.cond = threading.Condition()
+        self.lock = threading.Lock()  # serializes the writes of the thread and of `close`
+        self.records = []  # waiting to be written
+        self.next_id = 1
+        self.pending = {}  # id -> segment holding its 'add' record
+        self.segments = collections.OrderedDict()  # segment -> number of pending ids
+        self.segment = 0
+        self.fh = None
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+    def path(self, segment):
+        return os.path.join(self.directory, "{0:08d}{1}".format(segment, self.SUFFIX))
+
+    def recover(self):
+        """ Read the segments left by the last run, and start the journal.
+
+            Return the (id, event dict, attempt) of the commands which did not complete,
+            which are copied to a new segment. The copies count the attempt run again
+            as interrupted, so that a command crashing the daemon is not run forever.
+            """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        segments = sorted(int(name[:-len(self.SUFFIX)]) for name in os.listdir(self.directory)
+                          if name.endswith(self.SUFFIX) and name[:-len(self.SUFFIX)].isdigit())
+        entries = collections.OrderedDict()  # id -> [event, attempt]
+        for segment in segments:
+            with open(self.path(segment), 'rb') as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue  # torn write of the last record before a crash
+                    if 'add' in record:
+                        entries[record['add']] = [record['event'], record.get('attempt', 1)]
+                        self.next_id = max(self.next_id, record['add'] + 1)
+                    elif 'retry' in record and record['retry'] in entries:
+                        entries[record['retry']][1] = record['attempt']
+                    elif 'done' in record:
+                        entries.pop(record['done'], None)
+        self.segment = segments[-1] + 1 if segments else 1
+        self.fh = open(self.path(self.segment), 'ab')
+        self.segments[self.segment] = 0
+        self.write([{'add': id, 'event': event, 'attempt': attempt + 1} for id, (event, attempt) in entries.items()])
+        self.flush()
+        for segment in segments:
+            os.remove(self.path(segment))
+        self.thread.start()
+        return [(id, event, attempt) for id, (event, attempt) in entries.items()]
+
+    def add(self, event, attempt=1):
+        """ Record a new command for the event dict `event`, return its id. """
+        with self.cond:
+            id = self.next_id
+            self.next_id += 1
+            self.records.append({'add': id, 'event': event, 'attempt': attempt})
+            self.cond.notify()
+        return id
+
+    def retry(self, id, attempt):
+        with self.cond:
+            self.records.append({'retry': id, 'attempt': attempt})
+            self.cond.notify()
+
+    def done(self, id):
+        with self.cond:
+            self.records.append({'done': id})
+            self.cond.notify()
+
+    def write(self, records):
+        for record in records:
+            if self.fh.tell() >= self.segment_size:
+                self.flush()
+                self.fh.close()
+                self.drop_segments()
+                self.segment += 1
+                self.fh = open(self.path(self.segment), 'ab')
+                self.segments[self.segment] = 0
+            self.fh.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+            if 'add' in record:
+                self.pending[record['add']] = self.segment
+                self.segments[self.segment] += 1
+            elif 'done' in record:
+                segment = self.pending.pop(record['done'], None)
+                if segment is not None:
+                    self.segments[segment] -= 1
+
+    def flush(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def drop_segments(self):
+        """ Delete the segments before the current one whose commands all completed. """
+        for segment, count in list(self.segments.items()):
+            if segment != self.segment and not count:
+                del self.segments[segment]
+                os.remove(self.path(segment))
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.records:
+                    self.cond.wait()
+                records, self.records = self.records, []
+            try:
+                with self.lock:
+                    self.write(records)
+                    self.flush()
+                    self.drop_segments()
+            except (IOError, OSError) as err:
+                logger.error("Failed to write journal '%s': %s", self.directory, err)
+            # let the records of the next `sync` seconds share an fsync
+            time.sleep(self.sync)
+
+    def close(self):
+        """ Write the remaining records, before exiting. """
+        if self.fh is None:
+            return
+        with self.cond:
+            records, self.records = self.records, []
+        with self.lock:
+            self.write(records)
+            self.flush()
+
+
+def coprocess_succeeded(reply):
+    """ Tell whether the `reply` line of a coprocess is a success: 'ok', or a JSON object with a true 'ok'. """
+    reply = reply.strip()
+    if reply.lower() == b'ok':
+        return True
+    if reply.startswith(b'{'):
+        try:
+            reply = json.loads(reply.decode('utf-8'))
+        except ValueError:
+            return False
+        return isinstance(reply, dict) and bool(reply.get('ok'))
+    return False
+
+
+class Coprocess(object):
+    """ One of the long-lived commands of a `CoprocessPool`.
+
+        Its thread starts the command, reads its replies, and starts it again
+        when it exits, waiting longer each time it exits quickly.
+        """
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.number = number
+        self.process = None
+        self.alive = False
+        self.inflight = collections.deque()  # events written, waiting for their reply
+        self.write_lock = threading.Lock()  # keeps `inflight` in the order the events are written
+        self.thread = threading.Thread(target=self.run, name="{0}-coprocess-{1}".format(pool.handler.opts['job'], number))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, event, line):
+        """ Send `event` to the command, return False if it is not running. """
+        with self.write_lock:
+            with self.pool.cond:
+                if not self.alive:
+                    return False
+                self.inflight.append(event)
+                process = self.process
+            try:
+                process.stdin.write(line)
+                process.stdin.flush()
+            except (IOError, OSError) as err:
+                # the event is failed with the other pending ones once the exit is seen
+                logger.debug("Failed to write to coprocess %d: %s", process.pid, err)
+        return True
+
+    def log_stderr(self, process):
+        capture = OutputCapture(self.pool.handler.opts)
+        for line in iter(process.stderr.readline, b''):
+            capture.write(line)
+        capture.close()
+
+    def run(self):
+        opts = self.pool.handler.opts
+        delay = COPROCESS_RESTART_DELAY
+        while True:
+            started = time.time()
+            try:
+                process = subprocess.Popen(self.pool.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+            except Exception as err:
+                logger.error("%s: failed to start coprocess '%s': %s", opts['job'], self.pool.command, err)
+            else:
+                logger.info("%s: started coprocess %d (%s): '%s'", opts['job'], self.number, process.pid,
+                            self.pool.command)
+                stderr = threading.Thread(target=self.log_stderr, args=(process,), name=self.thread.name + '-stderr')
+                stderr.daemon = True
+                stderr.start()
+                with self.pool.cond:
+                    self.process = process
+                    self.alive = True
+                    self.pool.cond.notify_all()
+                for line in iter(process.stdout.readline, b''):
+                    with self.pool.cond:
+                        event = self.inflight.popleft() if self.inflight else None
+                        self.pool.cond.notify_all()
+                    if event is None:
+                        logger.warning("%s: unexpected reply of coprocess %d: %r", opts['job'], process.pid, line)
+                    else:
+                        self.pool.handler.report_reply(event, line)
+                with self.pool.cond:
+                    self.alive = False
+                    lost = list(self.inflight)
+                    self.inflight.clear()
+                process.stdin.close()
+                process.stdout.close()
+                process.wait()
+                stderr.join()
+                logger.warning("%s: coprocess %d exited with return code %s, failing %d pending events",
+                               opts['job'], process.pid, process.returncode, len(lost))
+                for event in lost:
+                    self.pool.handler.report_reply(event, None)
+            if self.pool.closed:
+                return
+            # restart at once a command which ran for a while, back off from one which keeps failing
+            if time.time() - started > COPROCESS_MAX_RESTART_DELAY:
+                delay = COPROCESS_RESTART_DELAY
+            time.sleep(delay)
+            delay = min(delay * 2, COPROCESS_MAX_RESTART_DELAY)
+
+
+class CoprocessPool(object):
+    """ Long-lived commands serving the events of a job, written to their stdin as JSON lines.
+
+        Each event gets a reply line on the stdout of the command it was sent
+        to, in order. Events go to the command with the fewest pending events,
+        a command holding at most COPROCESS_PIPELINE of them.
+        """
+    def __init__(self, handler, size):
+        self.handler = handler
+        self.command = string.Template(handler.opts['command']).safe_substitute(
+            job=shellquote(handler.opts['job']), folder=shellquote(handler.opts['folder']))
+        self.args = shlex.split(self.command)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.coprocesses = [Coprocess(self, number) for number in range(size)]
+
+    def submit(self, event, fields):
+        """ Send `event`, whose `fields` are written as JSON, waiting for a coprocess to take it. """
+        line = json.dumps(fields, separators=(',', ':')).encode('utf-8') + b'\n'
+        while True:
+            with self.cond:
+                if self.closed:
+                    raise ValueError("the coprocesses of the job were stopped")
+                ready = [coprocess for coprocess in self.coprocesses
+                         if coprocess.alive and len(coprocess.inflight) < COPROCESS_PIPELINE]
+                if not ready:
+                    self.cond.wait()
+                    continue
+                coprocess = min(ready, key=lambda coprocess: len(coprocess.inflight))
+            if coprocess.write(event, line):
+                return
+
+    def close(self):
+        """ Close the stdin of the commands, which exit once they replied to their pending events. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for coprocess in self.coprocesses:
+            with coprocess.write_lock:
+                if coprocess.process is not None:
+                    try:
+                        coprocess.process.stdin.close()
+                    except (IOError, OSError):
+                        pass
+
+
+def load_function(spec):
+    """ Import the function named by `spec` ('package.module:function'). """
+    module, _, name = spec.partition(':')
+    if not module or not name:
+        raise ValueError("{0!r} is not of the form 'package.module:function'".format(spec))
+    function = importlib.import_module(module)
+    for attr in name.split('.'):
+        function = getattr(function, attr)
+    if not callable(function):
+        raise ValueError("{0!r} is not callable".format(spec))
+    return function
+
+
+def call_function(spec, fields):
+    """ Call the function named by `spec` with `fields`, in a worker process. """
+    return load_function(spec)(fields)
+
+
+class FunctionPool(object):
+    """ Run a Python function for each event of a job, in a pool of threads or processes.
+
+        The function gets a dict of the fields of the event (those of the
+        coprocesses). It failed if it raised or returned False; its return
+        value, or the traceback, is the output of the call.
+        """
+    def __init__(self, handler, spec, kind, size):
+        self.handler = handler
+        self.spec = spec
+        # imported once at startup, also to report errors early
+        self.function = load_function(spec)
+        if concurrent is None:
+            raise ValueError("the futures backport is needed to run 'handler' with python 2")
+        if kind == 'process':
+            kwargs = {'max_workers': size}
+            if sys.version_info >= (3, 7):
+                # the workers import the function at startup, and do not inherit the threads of the daemon
+                kwargs.update(mp_context=multiprocessing.get_context('forkserver'),
+                              initializer=load_function, initargs=(spec,))
+            self.executor = concurrent.futures.ProcessPoolExecutor(**kwargs)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(size)
+        self.kind = kind
+        self.slots = threading.BoundedSemaphore(size * HANDLER_PIPELINE)
+
+    def submit(self, event, fields):
+        """ Run the function for `event`, waiting for room in the pool. """
+        self.slots.acquire()
+        try:
+            if self.kind == 'process':
+                future = self.executor.submit(call_function, self.spec, fields)
+            else:
+                future = self.executor.submit(self.function, fields)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.done(event, future))
+
+    def done(self, event, future):
+        self.slots.release()
+        try:
+            result = future.result()
+        except Exception:
+            succeeded = False
+            output = traceback.format_exc()
+        else:
+            succeeded = result is not False
+            output = '' if result is None or isinstance(result, bool) else result
+        if not isinstance(output, bytes):
+            output = '{0}'.format(output).encode('utf-8')
+        self.handler.report_call(event, succeeded, output)
+
+    def close(self):
+        """ Let the pending calls complete, and stop the workers after them. """
+        self.executor.shutdown(wait=False)
+
+
+class Histogram(object):
+    """ Counts of the observed values by bucket of `METRICS_BUCKETS`, and their sum. """
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+
+
+class JobMetrics(object):
+    """ Counters of a job, updated without lock by the threads of the job (an increment may
+        rarely be lost to a race, which is cheaper than locking for each event).
+        """
+    def __init__(self):
+        self.received = 0
+        self.filtered = 0
+        self.dispatched = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.latency = Histogram()  # from the event to the start of its command
+        self.duration = Histogram()  # of the commands
+
+
+def render_metrics(handlers, scheduler, budget):
+    """ Return the metrics of the jobs in the Prometheus text format. """
+    queues = scheduler.stats()
+    lines = []
+
+    def metric(name, kind, help, values):
+        lines.append("# HELP watcher_{0} {1}".format(name, help))
+        lines.append("# TYPE watcher_{0} {1}".format(name, kind))
+        for labels, value in values:
+            labels = ','.join('{0}="{1}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, val in labels)
+            lines.append("watcher_{0}{1} {2}".format(name, '{' + labels + '}' if labels else '', value))
+
+    def jobs(value):
+        return [((('job', handler.opts['job']),), value(handler)) for handler in handlers]
+
+    def histogram(name, help, histograms):
+        lines.append("# HELP watcher_{0} {1}".format(name, help))
+        lines.append("# TYPE watcher_{0} histogram".format(name))
+        for handler in handlers:
+            job = handler.opts['job'].replace('\\', '\\\\').replace('"', '\\"')
+            hist = histograms(handler)
+            counts = list(hist.counts)
+            total = 0
+            for bound, count in zip(METRICS_BUCKETS + ('+Inf',), counts):
+                total += count
+                lines.append('watcher_{0}_bucket{{job="{1}",le="{2}"}} {3}'.format(name, job, bound, total))
+            lines.append('watcher_{0}_sum{{job="{1}"}} {2}'.format(name, job, hist.sum))
+            lines.append('watcher_{0}_count{{job="{1}"}} {2}'.format(name, job, total))
+
+    def queue(handler, key):
+        return queues.get(handler.opts['job'], {}).get(key, 0)
+
+    def coalesced(handler):
+        return sum((handler.debouncer.coalesced if handler.debouncer is not None else 0,
+                    handler.batcher.coalesced if handler.batcher is not None else 0,
+                    handler.pairer.paired if handler.pairer is not None else 0,
+                    queue(handler, 'coalesced')))
+
+    metric('events_received_total', 'counter', "Events received.", jobs(lambda h: h.metrics.received))
+    metric('events_filtered_total', 'counter', "Events rejected by the file filters.",
+           jobs(lambda h: h.metrics.filtered))
+    metric('events_coalesced_total', 'counter', "Events merged into others (debounce, batch, rename, queue).",
+           jobs(coalesced))
+    metric('events_deduplicated_total', 'counter', "Events of unchanged files skipped (dedup).",
+           jobs(lambda h: h.dedup.hits if h.dedup is not None else 0))
+    metric('commands_dispatched_total', 'counter', "Commands (or calls) dispatched, retries included.",
+           jobs(lambda h: h.metrics.dispatched))
+    metric('commands_completed_total', 'counter', "Commands completed, by result.",
+           [((('job', h.opts['job']), ('result', 'success')), h.metrics.succeeded) for h in handlers] +
+           [((('job', h.opts['job']), ('result', 'failure')), h.metrics.failed) for h in handlers])
+    metric('commands_dropped_total', 'counter', "Background commands dropped by a full queue.",
+           jobs(lambda h: queue(h, 'dropped')))
+    histogram('spawn_latency_seconds', "Time from an event to the start of its command.",
+              lambda h: h.metrics.latency)
+    histogram('command_duration_seconds', "Duration of the commands.", lambda h: h.metrics.duration)
+    histogram('queue_wait_seconds', "Time background commands waited for a slot.",
+              lambda h: queue(h, 'wait') or Histogram())
+    metric('children_running', 'gauge', "Background commands running.", jobs(lambda h: queue(h, 'running')))
+    metric('children_queued', 'gauge', "Background commands waiting for a slot.", jobs(lambda h: queue(h, 'queued')))
+    metric('watches', 'gauge', "Inotify watches of the job.",
+           [(labels, value) for labels, value in jobs(lambda h: h.watch_count() if h.watch_count else None)
+            if value is not None])
+    metric('queue_overflows_total', 'counter', "Overflows of the inotify queue.", jobs(lambda h: h.overflows))
+    metric('events_recovered_total', 'counter', "Events recovered by rescans after overflows.",
+           jobs(lambda h: h.recovered))
+    metric('watches_total', 'gauge', "Inotify watches of the daemon.", [((), budget.count())])
+    if budget.limit:
+        metric('watches_limit', 'gauge', "fs.inotify.max_user_watches.", [((), budget.limit)])
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_address(spec):
+    """ Return the socket family and address of `spec`: 'unix:/path', 'host:port' or 'port' (on localhost). """
+    if spec.startswith('unix:'):
+        return socket.AF_UNIX, spec[len('unix:'):]
+    host, _, port = spec.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+class MetricsServer(object):
+    """ Serve the text returned by `render()` over HTTP, on a Unix socket or a TCP port, from a thread. """
+    def __init__(self, spec, render):
+        self.render = render
+        self.family, self.address = metrics_address(spec)
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_UNIX:
+            # left by a daemon which did not stop cleanly
+            if os.path.exists(self.address) and stat.S_ISSOCK(os.stat(self.address).st_mode):
+                os.unlink(self.address)
+        else:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(16)
+        self.thread = threading.Thread(target=self.run, name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (IOError, OSError) as err:
+                if err.errno == errno.EINTR:
+                    continue
+                logger.debug("Metrics server stopped: %s", err)
+                return
+            try:
+                conn.settimeout(5)
+                request = b''
+                while b'\r\n\r\n' not in request and b'\n\n' not in request and len(request) < 8192:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    request += chunk
+                body = self.render().encode('utf-8')
+                conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n' +
+                             'Content-Length: {0}\r\n\r\n'.format(len(body)).encode('ascii') + body)
+            except Exception:
+                logger.exception("Failed to serve metrics:")
+            finally:
+                conn.close()
+
+    def close(self):
+        self.sock.close()
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+
+def fetch_metrics(spec, timeout=10):
+    """ Return the metrics served on `spec`, raise IOError or OSError on failure. """
+    family, address = metrics_address(spec)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''.join(iter(lambda: sock.recv(65536), b''))
+    finally:
+        sock.close()
+    return response.partition(b'\r\n\r\n')[2].decode('utf-8')
+
+
+def merge_metrics(texts):
+    """ Merge the metrics of the workers, `texts` being (worker, text) pairs, into a single text
+        where each sample gets a 'worker' label.
+        """
+    families = collections.OrderedDict()  # name -> (HELP and TYPE lines, samples)
+    for worker, text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                family = line.split(' ', 3)[2]
+                headers = families.setdefault(family, ([], []))[0]
+                if line not in headers:
+                    headers.append(line)
+            elif line:
+                name, sep, rest = line.partition('{')
+                if sep:
+                    sample = '{0}{{worker="{1}",{2}'.format(name, worker, rest)
+                else:
+                    name, _, value = line.partition(' ')
+                    sample = '{0}{{worker="{1}"}} {2}'.format(name, worker, value)
+                families.setdefault(family, ([], []))[1].append(sample)
+    return ''.join(line + '\n' for headers, samples in families.values() for line in headers + samples)
+
+
+def query_metrics(spec):
+    """ Print the metrics of the running daemon listening on `spec`, return the exit status. """
+    if not spec:
+        sys.stderr.write("No 'metrics' address in the config file\n")
+        return 1
+    try:
+        text = fetch_metrics(spec)
+    except (IOError, OSError) as err:
+        sys.stderr.write("Failed to query watcher on '{0}': {1}\n".format(spec, err))
+        return 1
+    sys.stdout.write(text)
+    return 0
+
+
+class EventHandler(pyinotify.ProcessEvent):
+    # events changing the files recorded by the index of the tree
+    INDEXED_EVENTS = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE |
+                      pyinotify.IN_ATTRIB | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+    # events synthesized for the changes found by a rescan, by order of preference
+    RESCAN_EVENTS = {'created': (pyinotify.IN_CREATE, pyinotify.IN_CLOSE_WRITE, pyinotify.IN_MOVED_TO),
+                     'modified': (pyinotify.IN_MODIFY, pyinotify.IN_CLOSE_WRITE),
+                     'deleted': (pyinotify.IN_DELETE, pyinotify.IN_MOVED_FROM)}
+
+    def __init__(self, **opts):
+        pyinotify.ProcessEvent.__init__(self)
+        self.opts = opts
+        opts['log_limiter'] = LogLimiter(opts['log_rate'], opts['job'])
+        opts['digests'] = {}
+        if opts.get('digest'):
+            for action in ('action_on_success', 'action_on_failure'):
+                if opts.get(action):
+                    opts['digests'][action] = Digest(functools.partial(post_digest, opts, action), opts['digest'],
+                                                     opts['digest_size'], first=opts['digest_first'],
+                                                     name="{0}-digest".format(opts['job']))
+        self.accepts = opts['accepts']
+        self.is_excluded = opts['is_excluded']
+        self.index = None
+        # polled trees do not overflow
+        if opts.get('overflow_rescan') and opts.get('backend') != 'poll' or opts.get('state_file'):
+            self.index = TreeIndex(opts['folder'], opts['recursive'], self.is_excluded, self.accepts)
+        self.state = StateFile(opts['state_file']) if opts.get('state_file') else None
+        self.dedup = DedupCache(opts['dedup_size'], opts.get('dedup_file')) if opts.get('dedup') else None
+        self.indexed = False
+        # set by the engine: watch the directories found by a rescan, count the watches of the job,
+        # watch its tree, remove its watches, and pass their events to the handler replacing it
+        self.watch_dir = None
+        self.watch_count = None
+        self.watch_job = None
+        self.unwatch = None
+        self.hand_over = None
+        self.metrics = JobMetrics()
+        self.rescan_lock = threading.Lock()
+        self.rescanning = False
+        self.rescan_pending = False
+        self.overflows = 0
+        self.recovered = 0
+        self.journal = None
+        if opts.get('journal'):
+            self.journal = Journal(opts['journal'], sync=opts['journal_sync'], segment_size=opts['journal_segment_size'],
+                                   name="{0}-journal".format(opts['job']))
+        # a journal handed over by a reload is shared with the handler replaced, which no longer closes it
+        self.owns_journal = True
+        self.pool = None
+        if opts.get('handler'):
+            self.pool = FunctionPool(self, opts['handler'], opts['handler_pool'], opts['pool_size'])
+        elif opts.get('mode') == 'coprocess':
+            self.pool = CoprocessPool(self, opts['pool_size'])
+        # the loop of engine 'asyncio' hands the events to a thread waiting for room in the pool
+        self.feed = None
+        if self.pool is not None and opts.get('runner') is not None:
+            self.feed = collections.deque()  # (event, fields), None to stop
+            self.feed_cond = threading.Condition()
+            self.feed_full = False  # the loop stopped reading the events
+            self.feeder = threading.Thread(target=self.run_feed, name="{0}-feed".format(opts['job']))
+            self.feeder.daemon = True
+            self.feeder.start()
+        self.retrier = None
+        if opts.get('max_attempts', 1) > 1:
+            self.retrier = Retrier(self.execute, name="{0}-retry".format(opts['job']))
+        self.debouncer = None
+        self.batcher = None
+        self.pairer = None
+        self.poller = None
+        if opts.get('backend') == 'poll':
+            self.poller = Poller(self, opts['poll_interval'], opts['poll_max_interval'], opts.get('poll_stat_rate'))
+        if opts.get('batch_size'):
+            self.batcher = Batcher(self.execute, opts['batch_size'], opts['batch_wait'],
+                                   name="{0}-batch".format(opts['job']))
+        if opts.get('debounce'):
+            self.debouncer = Debouncer(self.submit, opts['debounce'],
+                                       max_wait=opts.get('debounce_max_wait'),
+                                       per_mask=opts.get('debounce_per_mask'),
+                                       name="{0}-debounce".format(opts['job']))
+        if opts.get('rename_wait'):
+            self.pairer = MovePairer(self.dispatch, opts['rename_wait'], opts['rename_pending'],
+                                     name="{0}-rename".format(opts['job']))
+
+    def runCommand(self, event, label):
+        if own_listings.caused(event):
+            return
+        event.received = time.time()
+        self.metrics.received += 1
+        if self.index is not None and event.mask & self.INDEXED_EVENTS:
+            self.index.update(event)
+        if self.pairer is not None:
+            self.pairer.add(event, label)
+        else:
+            self.dispatch(event, label)
+
+    def dispatch(self, event, label):
+        # filters go first, so that rejected events cost neither logging nor templating
+        src = getattr(event, 'renamed_from', None)
+        if not self.accepts(event.pathname) and not (src is not None and self.accepts(src)):
+            self.metrics.filtered += 1
+            return
+        if src is not None:
+            log_event(self.opts, "%s: %s -> %s", label, src, event.pathname)
+        else:
+            log_event(self.opts, "%s: %s", label, event.pathname)
+
+        if self.debouncer:
+            self.debouncer.add(event)
+        else:
+            self.submit(event)
+
+    def overflowed(self):
+        """ Count an overflow of the inotify queue, and rescan the tree in the background to recover the lost events.
+            """
+        with self.rescan_lock:
+            self.overflows += 1
+            logger.warning("%s: inotify queue overflowed (%d times so far), events were lost",
+                           self.opts['job'], self.overflows)
+            if self.index is None or not self.opts['overflow_rescan']:
+                return
+            # a rescan in progress may have missed the last changes, run another one after it
+            self.rescan_pending = True
+            if self.rescanning:
+                return
+            self.rescanning = True
+        thread = threading.Thread(target=self.rescan, name="{0}-rescan".format(self.opts['job']))
+        thread.daemon = True
+        thread.start()
+
+    def build_index(self):
+        """ Index the tree and catch up with the changes made since the state file was saved,
+            then run the rescans requested meanwhile.
+            """
+        with self.rescan_lock:
+            self.rescanning = True
+        try:
+            start = time.time()
+            files, dirs = self.index.scan()
+            logger.info("%s: %d files of %d directories indexed in %.1fs",
+                        self.opts['job'], len(files), len(dirs), time.time() - start)
+            if self.state is not None:
+                self.catch_up(files)
+            self.indexed = True
+        finally:
+            self.rescan()
+
+    def catch_up(self, files):
+        """ Send the events of the `files` (as found by the first scan) which changed since the state file was saved.
+            """
+        saved = self.state.load()
+        if saved is None:
+            logger.info("%s: no state file '%s' yet, nothing to catch up with", self.opts['job'], self.state.path)
+            return
+        changes = []
+        for pathname, change in files:
+            state = saved.pop(path_hash(pathname), None)
+            if state is None:
+                changes.append((pathname, 'created'))
+            elif state != self.index.state(pathname):
+                changes.append((pathname, 'modified'))
+        # only the hashes of the paths are saved, the files deleted meanwhile cannot be named
+        logger.info("%s: caught up with %d changes made while watcher was down, %d files deleted meanwhile",
+                    self.opts['job'], self.replay(changes), len(saved))
+
+    def save_state(self):
+        """ Save the dedup cache, and the index of the tree to the state file once it is built. """
+        if self.dedup is not None and self.dedup.state is not None:
+            try:
+                self.dedup.save()
+            except (IOError, OSError) as err:
+                logger.error("%s: failed to save dedup file '%s': %s", self.opts['job'], self.dedup.state.path, err)
+        if self.state is None or not self.indexed:
+            return
+        try:
+            self.state.save([(path_hash(pathname), state) for pathname, state in self.index.files()])
+        except (IOError, OSError) as err:
+            logger.error("%s: failed to save state file '%s': %s", self.opts['job'], self.state.path, err)
+
+    def replay(self, changes):
+        """ Send the events of the (pathname, change) found by a scan of the tree, return how many were sent.
+            """
+        sent = 0
+        for pathname, change in changes:
+            mask = next((mask for mask in self.RESCAN_EVENTS[change] if mask & self.opts['mask']), None)
+            if mask is None:
+                continue
+            self(pyinotify.Event({'wd': -1,
+                                  'mask': mask,
+                                  'path': os.path.dirname(pathname),
+                                  'name': os.path.basename(pathname),
+                                  'dir': False}))
+            sent += 1
+        return sent
+
+    def rescan(self):
+        """ Send the events of the changes found by rescanning the tree, until no rescan is pending. """
+        while True:
+            with self.rescan_lock:
+                if not self.rescan_pending:
+                    self.rescanning = False
+                    return
+                self.rescan_pending = False
+            start = time.time()
+            try:
+                changes, new_dirs = self.index.scan()
+            except Exception:
+                logger.exception("%s: failed to rescan '%s':", self.opts['job'], self.opts['folder'])
+                continue
+            if self.opts['autoadd'] and self.watch_dir is not None:
+                for path in new_dirs:
+                    self.watch_dir(path)
+            recovered = self.replay(changes)
+            self.recovered += recovered
+            logger.info("%s: rescan recovered %d events in %.1fs (%d so far), %d new directories",
+                        self.opts['job'], recovered, time.time() - start, self.recovered, len(new_dirs))
+
+    def changed(self, event):
+        """ Tell whether the command must run for `event`, i.e. unless the contents of its file are
+            those it last succeeded for.
+            """
+        if event.dir or event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE_SELF |
+                                      pyinotify.IN_MOVE_SELF) or hasattr(event, 'renamed_from'):
+            self.dedup.forget(getattr(event, 'renamed_from', event.pathname))
+            return True
+        if self.dedup.check(event.pathname):
+            return True
+        log_event(self.opts, "%s: skipping unchanged '%s' (%d skipped, %d run so far)",
+                  self.opts['job'], event.pathname, self.dedup.hits, self.dedup.misses)
+        return False
+
+    def submit(self, event):
+        if self.dedup is not None and not self.changed(event):
+            return
+        if self.batcher:
+            self.batcher.add(event)
+        else:
+            self.execute(event)
+
+    def execute(self, event):
+        if self.journal is not None and not hasattr(event, 'journal_id'):
+            event.journal_id = self.journal.add(dump_event(event))
+        fields = {'job': self.opts['job'],
+                  'folder': self.opts['folder'],
+                  'watched': event.path,
+                  'filename': event.pathname,
+                  'filenames': getattr(event, 'pathnames', [event.pathname]),
+                  'tflags': event.maskname,
+                  'nflags': event.mask,
+                  'cookie': getattr(event, 'cookie', 0),
+                  'src': getattr(event, 'renamed_from', ''),
+                  'dst': event.pathname if hasattr(event, 'renamed_from') else ''}
+        self.metrics.dispatched += 1
+        if self.feed is not None and self.opts['runner'].in_loop():
+            with self.feed_cond:
+                self.feed.append((event, fields))
+                self.feed_cond.notify()
+                if len(self.feed) >= POOL_BACKLOG and not self.feed_full:
+                    # as Scheduler.submit does, stop reading the events rather than blocking the loop
+                    self.feed_full = True
+                    self.opts['runner'].pause(self)
+            return
+        if self.pool is not None:
+            self.spawned(event)
+            self.pool.submit(event, fields)
+            return
+        # large batches are passed to the command on stdin rather than on its command line
+        stdindata = None
+        if self.opts['batch_stdin'] and len(fields['filenames']) > self.opts['batch_stdin']:
+            stdindata = b''.join(p.encode(sys.getfilesystemencoding() or 'utf-8') + b'\0' for p in fields['filenames'])
+            fields['filenames'] = []
+        command = self.opts['argv'].command
+        try:
+            # a value can unbalance the quotes of the line (e.g. sh -c 'echo $filename' for it's)
+            args = self.opts['argv'].fill(fields)
+            command = ' '.join(args)
+            if not self.opts['background'] and self.opts.get('runner') is not None:
+                # run one at a time by the event loop, without delaying the next events
+                self.opts['runner'].run_command(self, args, command, stdindata, event)
+            elif not self.opts['background']:
+                # sync exec
+                log_event(self.opts, "Running command: '%s'", command)
+                self.spawned(event)
+                process = spawn_command(args, stdin=stdindata is not None)
+                if stdindata is not None:
+                    feed_stdin(process, stdindata)
+                capture = OutputCapture(self.opts)
+                try:
+                    for chunk in iter(lambda: os.read(process.stdout.fileno(), 65536), b''):
+                        capture.write(chunk)
+                finally:
+                    process.stdout.close()
+                    process.wait()
+                self.report(process, capture, event)
+            else:
+                # async exec, possibly delayed by the concurrency limits
+                key = None if hasattr(event, 'pathnames') else event.pathname
+                self.opts['scheduler'].submit(self, key, args, command, stdindata, event)
+        except Exception as err:
+            logger.exception("Failed to run command '%s':", command)
+            self.finished(event, retry=self.can_retry(event))
+
+    def spawned(self, event):
+        """ Record the start of the command of `event`. """
+        now = time.time()
+        received = getattr(event, 'received', None)
+        # the latency of the retries is their delay
+        if received is not None and getattr(event, 'attempt', 1) == 1:
+            self.metrics.latency.observe(now - received)
+        event.started = now
+
+    def can_retry(self, event):
+        return self.retrier is not None and getattr(event, 'attempt', 1) < self.opts['max_attempts']
+
+    def report(self, process, capture, event):
+        """ Report the completion of the command of `event`, and retry it if it failed and attempts are left.
+            """
+        retry = process.returncode != 0 and self.can_retry(event)
+        process_report(process, self.opts, capture, retry=retry, event=event)
+        self.finished(event, retry=retry, succeeded=process.returncode == 0)
+
+    def report_call(self, event, succeeded, output):
+        """ Report the completion of the function of `event`, and retry it if it failed and attempts are left.
+            """
+        capture = OutputCapture(self.opts)
+        if output:
+            capture.write(output)
+        capture.close()
+        if succeeded:
+            post_outcome(self.opts, 'action_on_success', capture.output(), event)
+            log_event(self.opts, "%s: handler succeeded for '%s'", self.opts['job'], event.pathname)
+            self.finished(event, succeeded=True)
+            return
+        retry = self.can_retry(event)
+        if not retry:
+            post_outcome(self.opts, 'action_on_failure', capture.output(), event)
+        log_event(self.opts, "%s: handler failed for '%s'%s", self.opts['job'], event.pathname,
+                  ", it will be retried" if retry else "", level=logging.WARNING if retry else logging.ERROR)
+        self.finished(event, retry=retry)
+
+    def report_reply(self, event, reply):
+        """ Report the `reply` line of a coprocess to `event` (None if the coprocess exited first),
+            and retry it if it failed and attempts are left.
+            """
+        if reply is not None and coprocess_succeeded(reply):
+            post_outcome(self.opts, 'action_on_success', reply, event)
+            log_event(self.opts, "%s: coprocess succeeded for '%s'", self.opts['job'], event.pathname)
+            self.finished(event, succeeded=True)
+            return
+        output = reply.rstrip() if reply is not None else b'coprocess exited'
+        retry = self.can_retry(event)
+        if not retry:
+            post_outcome(self.opts, 'action_on_failure', output, event)
+        log_event(self.opts, "%s: coprocess failed for '%s': %r%s", self.opts['job'], event.pathname, output,
+                  ", it will be retried" if retry else "", level=logging.WARNING if retry else logging.ERROR)
+        self.finished(event, retry=retry)
+
+    def finished(self, event, retry=False, succeeded=False):
+        """ Record that the command of `event` completed (or was dropped), or schedule its next attempt.
+            """
+        started = getattr(event, 'started', None)
+        if started is not None:
+            # the commands dropped from a queue never started
+            self.metrics.duration.observe(time.time() - started)
+            event.started = None
+            if succeeded:
+                self.metrics.succeeded += 1
+            else:
+                self.metrics.failed += 1
+        if retry:
+            attempt = getattr(event, 'attempt', 1)
+            delay = min(self.opts['retry_delay'] * 2 ** (attempt - 1), self.opts['retry_max_delay'])
+            event.attempt = attempt + 1
+            logger.warning("%s: attempt %d of %d failed for '%s', retrying in %.1fs", self.opts['job'], attempt,
+                           self.opts['max_attempts'], event.pathname, delay)
+            if self.journal is not None:
+                self.journal.retry(event.journal_id, event.attempt)
+            self.retrier.add(event, delay)
+            return
+        if getattr(event, 'attempt', 1) > 1:
+            logger.info("%s: '%s' done after %d attempts", self.opts['job'], event.pathname, event.attempt)
+        if succeeded and self.dedup is not None:
+            self.dedup.commit(getattr(event, 'pathnames', [event.pathname]))
+        if self.journal is not None:
+            self.journal.done(event.journal_id)
+
+    def recover_journal(self):
+        """ Start the journal, and run again in the background the commands which did not complete
+            before watcher stopped.
+            """
+        try:
+            entries = self.journal.recover()
+        except (IOError, OSError) as err:
+            logger.error("%s: failed to open journal '%s', commands are not journaled: %s",
+                         self.opts['job'], self.journal.directory, err)
+            self.journal = None
+            return
+        events = []
+        for (id, record, attempt) in entries:
+            event = load_event(record)
+            if attempt > self.opts['max_attempts']:
+                logger.error("%s: giving up '%s', interrupted by watcher stopping after %d attempts",
+                             self.opts['job'], event.pathname, attempt - 1)
+                self.journal.done(id)
+                continue
+            event.journal_id = id
+            event.attempt = attempt
+            events.append(event)
+        if not events:
+            return
+        logger.warning("%s: running again %d commands which did not complete before watcher stopped",
+                       self.opts['job'], len(events))
+        thread = threading.Thread(target=lambda: [self.execute(event) for event in events],
+                                  name="{0}-recover".format(self.opts['job']))
+        thread.daemon = True
+        thread.start()
+
+    def spawn(self, args, command, stdindata, waited, event):
+        """ Start the background command of `event`, `waited` seconds after it was submitted.
+            """
+        self.spawned(event)
+        if self.opts.get('runner') is not None:
+            self.opts['runner'].spawn(self, args, command, stdindata, waited, event)
+            return
+        try:
+            process = spawn_command(args, stdin=stdindata is not None)
+        except Exception as err:
+            logger.exception("Failed to run command '%s':", command)
+            self.opts['scheduler'].done(self.opts['job'])
+            self.finished(event, retry=self.can_retry(event))
+            return
+        if waited is None:
+            log_event(self.opts, "Executed child (%s): '%s'", process.pid, command)
+        else:
+            log_event(self.opts, "Executed child (%s) after %.3fs in queue: '%s'", process.pid, waited, command)
+        if stdindata is not None:
+            feed_stdin(process, stdindata)
+        self.opts['reaper'].add(process, self.opts, lambda process, capture: self.report(process, capture, event))
+
+    def run_feed(self):
+        """ Pass the events queued by the loop of engine 'asyncio' to the pool, waiting for room. """
+        while True:
+            with self.feed_cond:
+                while not self.feed:
+                    self.feed_cond.wait()
+                item = self.feed.popleft()
+                if self.feed_full and len(self.feed) <= POOL_BACKLOG // 2:
+                    self.feed_full = False
+                    self.opts['runner'].call(self.opts['runner'].resume, self)
+            if item is None:
+                return
+            event, fields = item
+            self.spawned(event)
+            try:
+                self.pool.submit(event, fields)
+            except Exception as err:
+                logger.error("%s: failed to run '%s': %s", self.opts['job'], event.pathname, err)
+                self.finished(event)
+
+    def close(self):
+        """ Stop the job, removed or replaced by a reload, once it gets no more events: its pending
+            events are run, and its commands already started complete.
+            """
+        if self.poller is not None:
+            self.poller.stop()
+        # in the order the events go through them
+        for stage in (self.pairer, self.debouncer, self.batcher):
+            if stage is not None:
+                stage.close()
+        if self.retrier is not None:
+            self.retrier.close()
+        if self.feed is not None:
+            # the pending events go to the pool first, unless it cannot take them (e.g. its command fails to start)
+            with self.feed_cond:
+                self.feed.append(None)
+                self.feed_cond.notify()
+            self.feeder.join(COPROCESS_MAX_RESTART_DELAY)
+        if self.pool is not None:
+            self.pool.close()
+        if self.feed is not None:
+            # the pool failing the events left, the feed thread empties the queue
+            self.feeder.join()
+        for digest in self.opts['digests'].values():
+            digest.close()
+        self.opts['log_limiter'].flush()
+        self.save_state()
+        if self.journal is not None and self.owns_journal:
+            self.journal.close()
+
+    def process_IN_ACCESS(self, event):
+        # print "Access: %s"%(event.pathname)
+        self.runCommand(event, "Access")
+
+    def process_IN_ATTRIB(self, event):
+        # print "Attrib: %s"%(event.pathname)
+        self.runCommand(event, "Attrib")
+
+    def process_IN_CLOSE_WRITE(self, event):
+        # print "Close write: %s"%(event.pathname)
+        self.runCommand(event, "Close write")
+
+    def process_IN_CLOSE_NOWRITE(self, event):
+        # print "Close nowrite: %s"%(event.pathname)
+        self.runCommand(event, "Close nowrite")
+
+    def process_IN_CREATE(self, event):
+        # print "Creating: %s"%(event.pathname)
+        self.runCommand(event, "Creating")
+
+    def process_IN_DELETE(self, event):
+        # print "Deleting: %s"%(event.pathname)
+        self.runCommand(event, "Deleting")
+
+    def process_IN_MODIFY(self, event):
+        # print "Modify: %s"%(event.pathname)
+        self.runCommand(event, "Modify")
+
+    def process_IN_MOVE_SELF(self, event):
+        # print "Move self: %s"%(event.pathname)
+        self.runCommand(event, "Move self")
+
+    def process_IN_MOVED_FROM(self, event):
+        # print "Moved from: %s"%(event.pathname)
+        self.runCommand(event, "Moved from")
+
+    def process_IN_MOVED_TO(self, event):
+        # print "Moved to: %s"%(event.pathname)
+        self.runCommand(event, "Moved to")
+
+    def process_IN_OPEN(self, event):
+        # print "Opened: %s"%(event.pathname)
+        self.runCommand(event, "Opened")
+
+    def process_IN_Q_OVERFLOW(self, event):
+        self.overflowed()
+
+
+class WatchTable(object):
+    """ Watches of several jobs sharing a single inotify instance.
+
+        Each watch descriptor is reference-counted by the handlers of the jobs
+        watching it and its kernel mask is the union of their masks, so
+        overlapping jobs cost a single kernel watch.
+        """
+    def __init__(self, wm):
+        self.wm = wm
+        self.handlers = {}  # wd -> {job: handler}
+        self.counts = collections.Counter()  # job -> number of its watches, for the metrics
+        self.lock = threading.Lock()  # for the counts, the jobs being walked by several threads
+
+    @staticmethod
+    def job_mask(handler):
+        """ Events delivered to `handler`, as a dedicated watch would deliver them. """
+        mask = handler.opts['mask']
+        if handler.opts['autoadd']:
+            mask |= pyinotify.IN_CREATE
+        return mask
+
+    def mask(self, wd):
+        mask = 0
+        for handler in self.handlers.get(wd, {}).values():
+            mask |= self.job_mask(handler)
+        return mask
+
+    def add_watch(self, handler, path, rec=False, **kwargs):
+        """ Watch `path` (and its subdirectories if `rec`) for `handler`.
+
+            Other keyword arguments are given to `watch_tree`.
+            Return the {path: wd} dict of `WatchManager.add_watch`.
+            """
+        def added(wdd):
+            job = handler.opts['job']
+            for wd in wdd.values():
+                if wd < 0:
+                    continue
+                with self.lock:
+                    handlers = self.handlers.setdefault(wd, {})
+                    if job not in handlers:
+                        self.counts[job] += 1
+                    handlers[job] = handler
+                self.wm.get_watch(wd).mask = self.mask(wd)
+
+        # IN_MASK_ADD keeps the events already watched by the other jobs
+        return watch_tree(self.wm, path, self.job_mask(handler) | pyinotify.IN_MASK_ADD, rec=rec,
+                          exclude_filter=handler.is_excluded, added=added, **kwargs)
+
+    def discard(self, job):
+        """ Drop the references of `job`, removing the watches no other job uses.
+            """
+        for wd, handlers in list(self.handlers.items()):
+            if handlers.pop(job, None) is None:
+                continue
+            if handlers:
+                self.wm.update_watch(wd, mask=self.mask(wd))
+                self.wm.get_watch(wd).mask = self.mask(wd)
+            else:
+                del self.handlers[wd]
+                self.wm.rm_watch(wd)
+        with self.lock:
+            self.counts.pop(job, None)
+
+    def watch_count(self, job):
+        """ Number of the watches used by `job`. """
+        return self.counts[job]
+
+    def replace(self, old, new):
+        """ Pass the events of the watches of `old` to `new`, of the same job and mask. """
+        job = old.opts['job']
+        for handlers in list(self.handlers.values()):
+            if handlers.get(job) is old:
+                handlers[job] = new
+
+    def forget(self, wd):
+        """ Drop a watch removed by the kernel (IN_IGNORED). """
+        with self.lock:
+            for job in self.handlers.pop(wd, {}):
+                self.counts[job] -= 1
+
+
+class EventDispatcher(pyinotify.ProcessEvent):
+    """ Dispatch the events of a `WatchTable` to the handlers of the jobs watching them.
+        """
+    def my_init(self, table):
+        self.table = table
+
+    def auto_add(self, event):
+        """ Watch a directory created (or moved) in a watched directory, for the jobs with `autoadd`.
+            """
+        wd = None
+        for handler in list(self.table.handlers.get(event.wd, {}).values()):
+            if handler.opts['autoadd'] and not handler.is_excluded(event.pathname):
+                wdd = self.table.add_watch(handler, event.pathname, rec=bool(event.mask & pyinotify.IN_MOVED_TO))
+                wd = wdd.get(event.pathname, wd)
+        if wd is None or wd < 0 or not event.mask & pyinotify.IN_CREATE:
+            return
+        # Entries may have been created (e.g. by `mkdir -p`) before the watch was added,
+        # simulate their creation as pyinotify does with auto_add.
+        own_listings.start(event.pathname)
+        try:
+            names = os.listdir(event.pathname)
+        except OSError as err:
+            logger.debug("Failed to list new directory %r: %s", event.pathname, err)
+            return
+        finally:
+            own_listings.end(event.pathname)
+        for name in names:
+            isdir = os.path.isdir(os.path.join(event.pathname, name))
+            self(pyinotify.Event({'wd': wd,
+                                  'mask': pyinotify.IN_CREATE | (pyinotify.IN_ISDIR if isdir else 0),
+                                  'path': event.pathname,
+                                  'name': name,
+                                  'dir': isdir}))
+
+    def process_IN_IGNORED(self, event):
+        self.table.forget(event.wd)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        # the lost events may have been for any job
+        jobs = {}
+        for handlers in list(self.table.handlers.values()):
+            jobs.update(handlers)
+        for handler in jobs.values():
+            handler.overflowed()
+
+    def process_default(self, event):
+        if event.dir and event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+            self.auto_add(event)
+        for handler in list(self.table.handlers.get(event.wd, {}).values()):
+            if event.mask & self.table.job_mask(handler):
+                handler(event)
+
+
+def make_handler(config, section, scheduler, reaper, runner=None):
+    """ Build the `EventHandler` of the job described by `section` of the config.
+        """
+    # mandatory opts
+    mask = parseMask(config.get(section, 'events').split(','))
+    folder = config.get(section, 'watch')
+    handler = config.get(section, 'handler')
+    command = None if handler else config.get(section, 'command')
+    argv = None
+    if command and config.get(section, 'mode') != 'coprocess':
+        # compiled once, also to report errors early
+        try:
+            argv = CommandTemplate(command)
+        except (ValueError, KeyError) as err:
+            raise ValueError("{0}: invalid command {1!r}: {2!r}".format(section, command, err))
+    # optional opts (i.e. with default values)
+    recursive = config.getboolean(section, 'recursive')
+    autoadd = config.getboolean(section, 'autoadd')
+    excluded = None if not config.get(section, 'excluded') else set(config.get(section, 'excluded').split(','))
+    excluded_re = config.get(section, 'excluded_re') or None
+    include_extensions = None if not config.get(section, 'include_extensions') else set(config.get(section, 'include_extensions').split(','))
+    exclude_extensions = None if not config.get(section, 'exclude_extensions') else set(config.get(section, 'exclude_extensions').split(','))
+    include_re = config.get(section, 'include_re') or None
+    exclude_re = config.get(section, 'exclude_re') or None
+    include_glob = None if not config.get(section, 'include_glob') else config.get(section, 'include_glob').split(',')
+    exclude_glob = None if not config.get(section, 'exclude_glob') else config.get(section, 'exclude_glob').split(',')
+    background = config.getboolean(section, 'background')
+    log_output = config.getboolean(section, 'log_output')
+    log_rate = None if not config.get(section, 'log_rate') else config.getfloat(section, 'log_rate')
+    output_limit = None if not config.get(section, 'output_limit') else config.getint(section, 'output_limit')
+    debounce = None if not config.get(section, 'debounce') else config.getfloat(section, 'debounce')
+    debounce_max_wait = None if not config.get(section, 'debounce_max_wait') else config.getfloat(section, 'debounce_max_wait')
+    debounce_per_mask = config.getboolean(section, 'debounce_per_mask')
+    rename_wait = None if not config.get(section, 'rename_wait') else config.getfloat(section, 'rename_wait')
+    rename_pending = config.getint(section, 'rename_pending')
+    dedup = config.getboolean(section, 'dedup')
+    dedup_size = config.getint(section, 'dedup_size')
+    dedup_file = config.get(section, 'dedup_file')
+    backend = config.get(section, 'backend')
+    if backend not in ('inotify', 'poll'):
+        logger.warning("%s: unknown backend %r, using 'inotify'", section, backend)
+        backend = 'inotify'
+    poll_interval = config.getfloat(section, 'poll_interval')
+    poll_max_interval = config.getfloat(section, 'poll_max_interval')
+    poll_stat_rate = None if not config.get(section, 'poll_stat_rate') else config.getfloat(section, 'poll_stat_rate')
+    if dedup_file:
+        dedup_file = string.Template(dedup_file).substitute(job=section)
+    batch_size = None if not config.get(section, 'batch_size') else config.getint(section, 'batch_size')
+    batch_wait = config.getfloat(section, 'batch_wait')
+    batch_stdin = None if not config.get(section, 'batch_stdin') else config.getint(section, 'batch_stdin')
+    walk_threads = config.getint(section, 'walk_threads')
+    overflow_rescan = config.getboolean(section, 'overflow_rescan')
+    state_file = config.get(section, 'state_file')
+    if state_file:
+        state_file = string.Template(state_file).substitute(job=section)
+    journal = config.get(section, 'journal')
+    if journal:
+        journal = string.Template(journal).substitute(job=section)
+    # set by shard_config() for a job split over workers: each shard watches a part of its tree
+    shard = config.get(section, 'shard')
+    if shard:
+        shard, shards = int(shard), config.getint(section, 'shards')
+        # each shard has files of its own
+        state_file, journal, dedup_file = ['{0}.{1}'.format(path, shard) if path else path
+                                           for path in (state_file, journal, dedup_file)]
+    journal_sync = config.getfloat(section, 'journal_sync')
+    journal_segment_size = config.getint(section, 'journal_segment_size')
+    max_attempts = config.getint(section, 'max_attempts')
+    mode = config.get(section, 'mode')
+    if mode not in ('exec', 'coprocess'):
+        logger.warning("%s: unknown mode %r, using 'exec'", section, mode)
+        mode = 'exec'
+    pool_size = config.getint(section, 'pool_size')
+    handler_pool = config.get(section, 'handler_pool')
+    if handler_pool not in ('thread', 'process'):
+        logger.warning("%s: unknown handler_pool %r, using 'thread'", section, handler_pool)
+        handler_pool = 'thread'
+    retry_delay = config.getfloat(section, 'retry_delay')
+    retry_max_delay = config.getfloat(section, 'retry_max_delay')
+    max_concurrency = None if not config.get(section, 'max_concurrency') else config.getint(section, 'max_concurrency')
+    queue_size = None if not config.get(section, 'queue_size') else config.getint(section, 'queue_size')
+    queue_policy = config.get(section, 'queue_policy')
+    if queue_policy not in Scheduler.POLICIES:
+        logger.warning("%s: unknown queue_policy %r, using 'block'", section, queue_policy)
+        queue_policy = 'block'
+
+    outfile = config.get(section, 'outfile')
+    if outfile:
+        t = string.Template(outfile)
+        outfile = t.substitute(job=section)
+        if log_output:
+            logger.debug("logging '%s' output to '%s'", section, outfile)
+    elif log_output:
+        logger.debug("logging '%s' output to daemon log", section)
+
+    action_on_success = config.get(section, 'action_on_success')
+    action_on_failure = config.get(section, 'action_on_failure')
+    digest = None if not config.get(section, 'digest') else config.getfloat(section, 'digest')
+    digest_size = config.getint(section, 'digest_size')
+    digest_first = config.getboolean(section, 'digest_first')
+
+    # parse include_extensions
+    if include_extensions and 'video' in include_extensions:
+        include_extensions.discard('video')
+        include_extensions |= set(VIDEO_EXTENSIONS)
+
+    accepts = compile_filter(include_extensions=include_extensions,
+                             exclude_extensions=exclude_extensions,
+                             include_re=include_re,
+                             exclude_re=exclude_re,
+                             include_glob=include_glob,
+                             exclude_glob=exclude_glob)
+    is_excluded = compile_exclusion(excluded, excluded_re)
+    if shard is not None:
+        owns, leaves_out = compile_shard(folder, shard, shards)
+        file_filter, dir_filter = accepts, is_excluded
+        accepts = lambda pathname: owns(pathname) and file_filter(pathname)
+        is_excluded = lambda path: leaves_out(path) or dir_filter(path)
+
+    return EventHandler(job=section,
+                        folder=folder,
+                        mask=mask,
+                        recursive=recursive,
+                        autoadd=autoadd,
+                        excluded=excluded,
+                        is_excluded=is_excluded,
+                        command=command,
+                        log_output=log_output,
+                        log_rate=log_rate,
+                        output_limit=output_limit,
+                        accepts=accepts,
+                        background=background,
+                        debounce=debounce,
+                        debounce_max_wait=debounce_max_wait,
+                        debounce_per_mask=debounce_per_mask,
+                        rename_wait=rename_wait,
+                        rename_pending=rename_pending,
+                        dedup=dedup,
+                        dedup_size=dedup_size,
+                        dedup_file=dedup_file,
+                        backend=backend,
+                        poll_interval=poll_interval,
+                        poll_max_interval=poll_max_interval,
+                        poll_stat_rate=poll_stat_rate,
+                        batch_size=batch_size,
+                        batch_wait=batch_wait,
+                        batch_stdin=batch_stdin,
+                        walk_threads=walk_threads,
+                        overflow_rescan=overflow_rescan,
+                        state_file=state_file,
+                        journal=journal,
+                        journal_sync=journal_sync,
+                        journal_segment_size=journal_segment_size,
+                        max_attempts=max_attempts,
+                        mode=mode,
+                        pool_size=pool_size,
+                        handler=handler,
+                        argv=argv,
+                        handler_pool=handler_pool,
+                        retry_delay=retry_delay,
+                        retry_max_delay=retry_max_delay,
+                        scheduler=scheduler,
+                        reaper=reaper,
+                        runner=runner,
+                        max_concurrency=max_concurrency,
+                        queue_size=queue_size,
+                        queue_policy=queue_policy,
+                        action_on_success=action_on_success,
+                        action_on_failure=action_on_failure,
+                        digest=digest,
+                        digest_size=digest_size,
+                        digest_first=digest_first,
+                        outfile=outfile
+                        )
+
+
+def watch_jobs(handlers):
+    """ Add the watches of the jobs, walking their trees. """
+    for handler in handlers:
+        logger.info("%s: watching '%s'", handler.opts['job'], handler.opts['folder'])
+        if handler.opts['excluded']:
+            logger.debug("Excluded dirs : %s", ', '.join(handler.opts['excluded']))
+        # excluded dirs are neither walked nor watched, nor auto-added later on
+        handler.watch_job()
+
+
+def threaded_notifiers(handlers, budget):
+    """ Give each job its own inotify instance and notifier thread.
+
+        Return the notifiers, the function adding the watches of the jobs, and
+        the one serving a job added later on (returning its notifier).
+        """
+    def bind(handler, notifier, wm):
+        section = handler.opts['job']
+        handler.watch_dir = lambda path: watch_tree(
+            wm, path, handler.opts['mask'], auto_add=handler.opts['autoadd'], exclude_filter=handler.is_excluded)
+        handler.watch_count = lambda: len(wm.watches)
+        handler.watch_job = lambda: watch_tree(
+            wm, handler.opts['folder'], handler.opts['mask'], rec=handler.opts['recursive'],
+            auto_add=handler.opts['autoadd'], exclude_filter=handler.is_excluded,
+            workers=handler.opts['walk_threads'], budget=budget, name=section)
+
+        def unwatch():
+            notifier.stop()
+            budget.wms.remove(wm)
+        handler.unwatch = unwatch
+
+        def hand_over(new):
+            # pyinotify has no setter, the watches having no processing function of their own
+            notifier._default_proc_fun = new
+            bind(new, notifier, wm)
+        handler.hand_over = hand_over
+
+    def attach(handler):
+        wm = watch_manager()
+        budget.wms.append(wm)
+        # Create ThreadNotifier so that each job has its own thread
+        notifier = pyinotify.ThreadedNotifier(wm, handler)
+        notifier.setName(handler.opts['job'])
+        bind(handler, notifier, wm)
+        return notifier
+
+    notifiers = dict((handler.opts['job'], attach(handler)) for handler in handlers)
+    return notifiers, lambda: watch_jobs(handlers), attach
+
+
+def shared_watches(handlers, budget):
+    """ Return the table of the watches of all the jobs, in a single inotify instance,
+        the function adding them, and the one serving a job added later on.
+        """
+    table = WatchTable(watch_manager())
+    budget.wms.append(table.wm)
+
+    def attach(handler):
+        job = handler.opts['job']
+        handler.watch_dir = lambda path: table.add_watch(handler, path)
+        handler.watch_count = lambda: table.watch_count(job)
+        handler.watch_job = lambda: table.add_watch(handler, handler.opts['folder'], rec=handler.opts['recursive'],
+                                                    workers=handler.opts['walk_threads'], budget=budget, name=job)
+        handler.unwatch = lambda: table.discard(job)
+
+        def hand_over(new):
+            table.replace(handler, new)
+            attach(new)
+        handler.hand_over = hand_over
+
+    for handler in handlers:
+        attach(handler)
+
+    def add_watches():
+        watch_jobs(handlers)
+        logger.debug("%d jobs share %d watches", len(handlers), len(table.handlers))
+    return table, add_watches, attach
+
+
+def shared_notifiers(handlers, budget):
+    """ Serve all the jobs from a single inotify instance and notifier thread.
+
+        Return the notifiers, the function adding the watches of the jobs, and
+        the one serving a job added later on.
+        """
+    table, add_watches, attach = shared_watches(handlers, budget)
+    notifier = pyinotify.ThreadedNotifier(table.wm, EventDispatcher(table=table))
+    notifier.setName('shared')
+    return {'shared': notifier}, add_watches, attach
+
+
+def asyncio_notifiers(handlers, budget, runner):
+    """ Serve all the jobs from a single inotify instance read by the event loop of `runner`.
+
+        Return the notifiers, the function adding the watches of the jobs, and
+        the one serving a job added later on.
+        """
+    table, add_watches, attach = shared_watches(handlers, budget)
+    notifier = pyinotify.AsyncioNotifier(table.wm, runner.loop, default_proc_fun=EventDispatcher(table=table))
+    runner.intake = (table.wm.get_fd(), notifier.handle_read)
+    return {'asyncio': notifier}, add_watches, attach
+
+
+def walk(add_watches, handlers, budget):
+    """ Add the watches of the jobs, the notifiers being already running, then index their trees. """
+    # journals are started first, so that new commands are numbered after the recovered ones
+    for handler in handlers:
+        if handler.journal is not None:
+            handler.recover_journal()
+    start = time.time()
+    try:
+        add_watches()
+    except Exception:
+        logger.exception("Failed to watch the jobs")
+        return
+    logger.info("All jobs watched in %.1fs: %s", time.time() - start, budget)
+    for handler in handlers:
+        if handler.index is not None:
+            handler.build_index()
+
+
+class Reloader(object):
+    """ Apply the changes of the config file to the running jobs, on SIGHUP.
+
+        Only the jobs added, removed or changed are reconfigured, the others
+        keep their watches and their commands running. A changed job whose
+        WATCH_OPTIONS did not change keeps its watches, their events going to
+        its new handler at once, and its index (or poller) if its TREE_OPTIONS
+        did not change either; the journal and dedup cache of a same file are
+        handed over too. The other changed jobs are watched again. A removed or
+        replaced handler runs its pending events and completes its commands
+        with its former options. A worker (see `Supervisor`) reloads its own
+        share of the jobs, which may move jobs between the workers.
+        """
+    def __init__(self, config, handlers, notifiers, attach, scheduler, reaper, runner, budget, worker=None):
+        self.config = config
+        self.handlers = handlers  # updated in place, shared with the metrics and the state saver
+        self.notifiers = notifiers
+        self.attach = attach
+        self.scheduler = scheduler
+        self.reaper = reaper
+        self.runner = runner
+        self.budget = budget
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pending = False
+
+    def request(self):
+        """ Reload from a thread of its own, once more if a reload is running. Called by the signal handler. """
+        with self.lock:
+            if self.thread is not None:
+                self.pending = True
+                return
+            self.thread = threading.Thread(target=self.run, name='reload')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Failed to reload the config:")
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                self.pending = False
+
+    def same(self, config, section, options):
+        return all(config.get(section, option, raw=True) == self.config.get(section, option, raw=True)
+                   for option in options)
+
+    def options(self, config, section):
+        return dict((key, value) for key, value in config.items(section, raw=True) if key not in RESTART_OPTIONS)
+
+    def reload(self):
+        start = time.time()
+        logger.info("Reloading the config from %s", ', '.join(self.config.paths))
+        try:
+            config = read_config(self.config.paths)
+        except configparser.Error as err:
+            logger.error("Failed to read the config, nothing reloaded: %s", err)
+            return
+        if config is None:
+            logger.error("Failed to read the config, nothing reloaded")
+            return
+        if self.worker is not None:
+            shard_config(config, self.worker.index, self.worker.count)
+        for option in RESTART_OPTIONS:
+            if config.defaults().get(option) != self.config.defaults().get(option):
+                logger.warning("Changes of '%s' need a restart, ignored", option)
+        current = collections.OrderedDict((handler.opts['job'], handler) for handler in self.handlers)
+        changed = [section for section in config.sections()
+                   if section in current and self.options(config, section) != self.options(self.config, section)]
+        added = [section for section in config.sections() if section not in current]
+        removed = [job for job in current if not config.has_section(job)]
+
+        # the new handlers are built first, so that an invalid job changes nothing
+        new = collections.OrderedDict()
+        try:
+            for section in changed + added:
+                new[section] = make_handler(config, section, self.scheduler, self.reaper, self.runner)
+        except Exception as err:
+            logger.error("Invalid config, nothing reloaded: %s", err)
+            for handler in new.values():
+                handler.close()
+            return
+
+        for job in removed:
+            handler = current[job]
+            if handler.poller is None:
+                handler.unwatch()
+                self.notifiers.pop(job, None)
+            handler.close()
+            self.handlers.remove(handler)
+            logger.info("%s: job removed", job)
+
+        watch, journals, indexes, pollers = [], [], [], []
+        kept = 0
+        for section, handler in new.items():
+            old = current.get(section)
+            if old is None:
+                self.handlers.append(handler)
+                logger.info("%s: job added", section)
+            else:
+                kept += self.hand_over(config, old, handler)
+                self.handlers[self.handlers.index(old)] = handler
+                self.scheduler.replace(old, handler)
+                old.close()
+                logger.info("%s: job changed", section)
+            if handler.watch_job is None and handler.poller is None:
+                watch.append(handler)
+            if handler.journal is not None and handler.journal.fh is None:
+                journals.append(handler)
+            if handler.index is not None and not handler.indexed:
+                indexes.append(handler)
+            if handler.poller is not None and not handler.poller.thread.is_alive():
+                pollers.append(handler)
+
+        for handler in watch:
+            notifier = self.attach(handler)
+            if notifier is not None:
+                notifier.start()
+                self.notifiers[handler.opts['job']] = notifier
+        for handler in journals:
+            handler.recover_journal()
+        for handler in pollers:
+            handler.poller.start()
+        watch_jobs(watch)
+        for handler in indexes:
+            handler.build_index()
+        self.config = config
+        logger.info("Config reloaded in %.1fs: %d jobs added, %d removed, %d changed (%d kept their watches): %s",
+                    time.time() - start, len(added), len(removed), len(changed), kept, self.budget)
+
+    def hand_over(self, config, old, new):
+        """ Give `new` the watches, index, poller, journal and dedup cache of `old` it can keep.
+            Return whether it kept the watches (or poller).
+            """
+        section = old.opts['job']
+        same_watches = self.same(config, section, WATCH_OPTIONS)
+        same_tree = same_watches and self.same(config, section, TREE_OPTIONS)
+        if old.journal is not None and new.journal is not None and old.journal.directory == new.journal.directory:
+            # the commands of `old` still running or flushed by its close complete in it
+            new.journal, old.owns_journal = old.journal, False
+        if (old.dedup is not None and new.dedup is not None and
+                (old.dedup.state and old.dedup.state.path) == (new.dedup.state and new.dedup.state.path)):
+            with old.dedup.lock:
+                old.dedup.size = new.dedup.size
+                old.dedup.trim(old.dedup.files)
+            new.dedup = old.dedup
+        if same_tree and old.indexed and new.index is not None:
+            new.index, new.indexed = old.index, True
+        if old.poller is not None:
+            if not same_tree:
+                return False
+            new.poller, old.poller = old.poller, None
+            new.poller.handler = new
+            return True
+        if not same_watches:
+            old.unwatch()
+            self.notifiers.pop(section, None)
+            return False
+        old.hand_over(new)
+        return True
+
+
+def save_states(handlers, interval):
+    """ Save the state files of the jobs every `interval` seconds. """
+    while True:
+        time.sleep(interval)
+        for handler in handlers:
+            handler.save_state()
+
+
+def terminate(signum, frame):
+    """ Exit on SIGTERM by raising SystemExit, as `daemon.DaemonContext` does, so that the cleanups run. """
+    raise SystemExit("Terminating on signal {0}".format(signum))
+
+
+class Worker(object):
+    """ A process of the `Supervisor`, running its share of the jobs (see `shard_config`). """
+    def __init__(self, index, count, metrics=None):
+        self.index = index
+        self.count = count
+        self.metrics = metrics  # private address of its metrics server, read by the supervisor
+        self.pid = None
+        self.heartbeat = None  # pipe written by the worker every WORKER_HEARTBEAT seconds
+        self.beat = 0
+        self.started = 0
+        self.restarts = 0
+        self.delay = WORKER_RESTART_DELAY
+        self.restart_at = None
+
+    def beating(self):
+        """ Send heartbeats to the supervisor until it is gone, then stop the worker. """
+        while True:
+            try:
+                os.write(self.heartbeat, b'.')
+            except OSError as err:
+                logger.error("Worker %d: the supervisor is gone (%s), stopping", self.index, err)
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            time.sleep(WORKER_HEARTBEAT)
+
+
+class Supervisor(object):
+    """ Run the jobs from 'workers' processes, each of them running a share of the jobs.
+
+        The supervisor holds the PID file, stops the workers on SIGTERM and
+        passes SIGHUP on to them, reading the config again for the workers it
+        starts from then on (each worker keeps its share of the jobs with
+        `shard_config`). A worker which exits, or sends no heartbeat
+        for WORKER_TIMEOUT seconds, is killed and started again, waiting longer
+        each time it exits quickly; the other workers go on. With 'metrics',
+        each worker serves its metrics on a socket of a private directory, and
+        the supervisor serves all of them, labeled by worker.
+        """
+    def __init__(self, config, count):
+        self.config = config
+        self.poller = select.poll()
+        self.metrics = config.get('DEFAULT', 'metrics')
+        self.directory = tempfile.mkdtemp(prefix='watcher-') if self.metrics else None
+        self.workers = [Worker(index, count,
+                               'unix:' + os.path.join(self.directory, '{0}.sock'.format(index)) if self.directory else None)
+                        for index in range(count)]
+        self.server = None
+
+    def run(self):
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        try:
+            if self.metrics:
+                try:
+                    self.server = MetricsServer(self.metrics, self.render)
+                    logger.info("Serving metrics on '%s'", self.metrics)
+                except (IOError, OSError, ValueError) as err:
+                    logger.error("Failed to serve metrics on '%s': %s", self.metrics, err)
+            for worker in self.workers:
+                self.spawn(worker)
+            while True:
+                self.supervise()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            logger.exception("Supervisor failed:")
+        finally:
+            self.stop()
+
+    def spawn(self, worker):
+        heartbeat, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(heartbeat)
+            self.work(worker, write)
+        os.close(write)
+        set_nonblocking(heartbeat)
+        self.poller.register(heartbeat, select.POLLIN)
+        worker.pid, worker.heartbeat = pid, heartbeat
+        worker.started = worker.beat = time.time()
+        worker.restart_at = None
+        logger.info("Worker %d started with pid %d", worker.index, pid)
+
+    def work(self, worker, heartbeat):
+        """ Run `worker` in the forked process, never return. """
+        status = 1
+        try:
+            for other in self.workers:
+                if other.heartbeat is not None:
+                    os.close(other.heartbeat)
+            if self.server is not None:
+                self.server.sock.close()
+            # stopped by the supervisor, reloaded once its reloader is set up
+            signal.signal(signal.SIGINT, lambda signum, frame: None)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, terminate)
+            worker.heartbeat = heartbeat
+            watcher(self.config, worker)
+            status = 0
+        except SystemExit:
+            status = 0
+        except BaseException:
+            logger.exception("Worker %d failed:", worker.index)
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def supervise(self):
+        try:
+            events = self.poller.poll(WORKER_HEARTBEAT * 1000)
+        except (select.error, IOError, OSError) as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            events = ()
+        now = time.time()
+        for fd, event in events:
+            worker = next(worker for worker in self.workers if worker.heartbeat == fd)
+            try:
+                beats = os.read(fd, 4096)
+            except OSError as err:
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                continue
+            if beats:
+                worker.beat = now
+            else:
+                # exited, collected below
+                self.poller.unregister(fd)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+            for worker in self.workers:
+                if worker.pid == pid:
+                    self.exited(worker, status, now)
+        for worker in self.workers:
+            if worker.pid is not None and now - worker.beat > WORKER_TIMEOUT:
+                logger.error("Worker %d (%d) sent no heartbeat for %ds, killing it", worker.index, worker.pid,
+                             now - worker.beat)
+                self.kill(worker, signal.SIGKILL)
+                worker.beat = now  # killed once
+            elif worker.pid is None and worker.restart_at <= now:
+                try:
+                    self.spawn(worker)
+                except OSError as err:
+                    logger.error("Failed to start worker %d again: %s", worker.index, err)
+                    worker.restart_at = now + worker.delay
+
+    def exited(self, worker, status, now):
+        try:
+            self.poller.unregister(worker.heartbeat)
+        except KeyError:
+            pass
+        os.close(worker.heartbeat)
+        if os.WIFSIGNALED(status):
+            how = "was killed by signal {0}".format(os.WTERMSIG(status))
+        else:
+            how = "exited with status {0}".format(os.WEXITSTATUS(status))
+        # start again at once a worker which ran for a while, back off from one which keeps failing
+        if now - worker.started > WORKER_MAX_RESTART_DELAY:
+            worker.delay = WORKER_RESTART_DELAY
+        logger.error("Worker %d (%d) %s, starting it again in %ds", worker.index, worker.pid, how, worker.delay)
+        worker.pid, worker.heartbeat = None, None
+        worker.restart_at = now + worker.delay
+        worker.delay = min(worker.delay * 2, WORKER_MAX_RESTART_DELAY)
+        worker.restarts += 1
+
+    def reload(self):
+        """ Read the config again for the workers started from now on, which keep the options needing
+            a restart of the others, and let the running workers reload it.
+            """
+        try:
+            config = read_config(self.config.paths)
+        except configparser.Error as err:
+            logger.error("Failed to read the config, the workers started again keep the former one: %s", err)
+            config = None
+        if config is None:
+            logger.error("Failed to read the config, the workers started again keep the former one")
+        else:
+            former = self.config.defaults()
+            for option in RESTART_OPTIONS:
+                if option in former:
+                    config.set('DEFAULT', option, former[option])
+                else:
+                    config.remove_option('DEFAULT', option)
+            self.config = config
+        self.signal(signal.SIGHUP)
+
+    def kill(self, worker, signum):
+        try:
+            os.kill(worker.pid, signum)
+        except OSError as err:
+            if err.errno != errno.ESRCH:
+                raise
+
+    def signal(self, signum):
+        for worker in self.workers:
+            if worker.pid is not None:
+                self.kill(worker, signum)
+
+    def stop(self):
+        """ Stop the workers, killing those still running after WORKER_STOP_TIMEOUT seconds. """
+        # a second signal does not leave them behind
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_IGN)
+        self.signal(signal.SIGTERM)
+        deadline = time.time() + WORKER_STOP_TIMEOUT
+        for worker in self.workers:
+            while worker.pid is not None:
+                pid, status = os.waitpid(worker.pid, os.WNOHANG)
+                if pid:
+                    worker.pid = None
+                elif time.time() > deadline:
+                    logger.error("Worker %d (%d) did not stop, killing it", worker.index, worker.pid)
+                    self.kill(worker, signal.SIGKILL)
+                    os.waitpid(worker.pid, 0)
+                    worker.pid = None
+                else:
+                    time.sleep(0.1)
+        if self.server is not None:
+            self.server.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def render(self):
+        texts = []
+        for worker in self.workers:
+            if worker.pid is None:
+                continue
+            try:
+                texts.append((worker.index, fetch_metrics(worker.metrics, timeout=5)))
+            except (IOError, OSError) as err:
+                logger.debug("Failed to read the metrics of worker %d: %s", worker.index, err)
+        lines = ["# HELP watcher_worker_up Whether the worker process runs.",
+                 "# TYPE watcher_worker_up gauge"]
+        lines.extend('watcher_worker_up{{worker="{0}"}} {1}'.format(worker.index, int(worker.pid is not None))
+                     for worker in self.workers)
+        lines.extend(["# HELP watcher_worker_restarts_total Restarts of the worker process.",
+                      "# TYPE watcher_worker_restarts_total counter"])
+        lines.extend('watcher_worker_restarts_total{{worker="{0}"}} {1}'.format(worker.index, worker.restarts)
+                     for worker in self.workers)
+        return merge_metrics(texts) + '\n'.join(lines) + '\n'
+
+
+def watcher(config, worker=None):
+    """ Run the jobs of `config`, or the share of them of `worker` (see `Supervisor`). """
+    workers = int(config.get('DEFAULT', 'workers') or 1)
+    if worker is None and workers > 1:
+        # the supervisor forks the workers, the log thread is started by each of them
+        Supervisor(config, workers).run()
+        return
+
+    # the daemon runs: the records are written by a thread from now on
+    for loghandler in logger.handlers:
+        if isinstance(loghandler, AsyncLogHandler):
+            loghandler.start()
+
+    if worker is not None:
+        shard_config(config, worker.index, worker.count)
+        logger.info("Worker %d runs %s", worker.index, ', '.join(
+            section if not config.get(section, 'shard') else
+            '{0} (shard {1} of {2})'.format(section, config.get(section, 'shard'), config.get(section, 'shards'))
+            for section in config.sections()) or "no job")
+        beating = threading.Thread(target=worker.beating, name='heartbeat')
+        beating.daemon = True
+        beating.start()
+
+    max_children = config.get('DEFAULT', 'max_children')
+    scheduler = Scheduler(int(max_children) if max_children else None)
+    reaper = Reaper(scheduler)
+    budget = WatchBudget()
+
+    # the size of the inotify queues is read when they are created
+    max_queued_events = config.get('DEFAULT', 'max_queued_events')
+    if max_queued_events:
+        try:
+            pyinotify.max_queued_events.value = int(max_queued_events)
+        except (IOError, OSError) as err:
+            logger.warning("Failed to set fs.inotify.max_queued_events to %s: %s", max_queued_events, err)
+    try:
+        logger.debug("inotify queues hold %d events", pyinotify.max_queued_events.value)
+    except (IOError, OSError):
+        pass
+
+    engine = config.get('DEFAULT', 'engine')
+    runner = None
+    if engine == 'asyncio':
+        if asyncio is None:
+            logger.warning("Engine 'asyncio' needs python 3, using 'threaded'")
+            engine = 'threaded'
+        else:
+            runner = scheduler.runner = AsyncRunner(scheduler)
+
+    # read jobs from config file
+    handlers = [make_handler(config, section, scheduler, reaper, runner) for section in config.sections()]
+    # the jobs of the poll backend are scanned by their own thread
+    watched = [handler for handler in handlers if handler.poller is None]
+
+    if engine == 'shared':
+        notifiers, add_watches, attach = shared_notifiers(watched, budget)
+    elif engine == 'asyncio':
+        notifiers, add_watches, attach = asyncio_notifiers(watched, budget, runner)
+    else:
+        if engine != 'threaded':
+            logger.warning("Unknown engine %r, using 'threaded'", engine)
+        notifiers, add_watches, attach = threaded_notifiers(watched, budget)
+
+    # Start all the notifiers, the one of engine 'asyncio' being run by the loop
+    for (name, notifier) in notifiers.items():
+        if not hasattr(notifier, 'start'):
+            continue
+        try:
+            notifier.start()
+            logger.debug('Notifier for %s is instanciated', name)
+        except pyinotify.NotifierError as err:
+            logger.warning('%r %r', sys.stderr, err)
+
+    for handler in handlers:
+        if handler.poller is not None:
+            handler.poller.start()
+
+    # Walk the trees in the background: the directories already watched get their events meanwhile
+    walker = threading.Thread(target=walk, args=(add_watches, handlers, budget), name='walker')
+    walker.daemon = True
+    walker.start()
+
+    server = None
+    metrics = config.get('DEFAULT', 'metrics') if worker is None else worker.metrics
+    if metrics:
+        try:
+            server = MetricsServer(metrics, lambda: render_metrics(handlers, scheduler, budget))
+            logger.info("Serving metrics on '%s'", metrics)
+        except (IOError, OSError, ValueError) as err:
+            logger.error("Failed to serve metrics on '%s': %s", metrics, err)
+
+    # started even if no job has a state file yet, as a reload may add one
+    saver = threading.Thread(target=save_states, args=(handlers, config.getfloat('DEFAULT', 'state_interval')),
+                             name='state')
+    saver.daemon = True
+    saver.start()
+
+    reloader = Reloader(config, handlers, notifiers, attach, scheduler, reaper, runner, budget, worker)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloader.request())
+
+    # Collect background children until SIGTERM
+    try:
+        if runner is not None:
+            runner.run()
+        else:
+            reaper.run()
+    except:
+        try:
+            cleanup_notifiers(notifiers)
+        finally:
+            if server is not None:
+                server.close()
+            for handler in handlers:
+                for digest in handler.opts['digests'].values():
+                    digest.close()
+                handler.opts['log_limiter'].flush()
+                handler.save_state()
+                if handler.journal is not None:
+                    handler.journal.close()
+
+
+def cleanup_notifiers(notifiers):
+    """Close notifiers instances when the process is killed
+    """
+    for notifier in notifiers.values():
+        notifier.stop()
+
+
+def parseMask(masks):
+    ret = False
+
+    for mask in masks:
+        mask = mask.strip()
 
         if 'access' == mask:
             ret = addMask(pyinotify.IN_ACCESS, ret)
@@ -506,6 +4587,114 @@ def addMask(new_option, current_options):
         return current_options | new_option
 
 
+# options of the config, by default
+CONFIG_DEFAULTS = {'engine': "threaded",
+                   'recursive': "true",
+                   'autoadd': "true",
+                   'excluded': None,
+                   'excluded_re': None,
+                   'include_extensions': None,
+                   'exclude_extensions': None,
+                   'include_re': None,
+                   'exclude_re': None,
+                   'include_glob': None,
+                   'exclude_glob': None,
+                   'background': "false",
+                   'debounce': None,
+                   'debounce_max_wait': None,
+                   'debounce_per_mask': "false",
+                   'rename_wait': None,
+                   'rename_pending': "10000",
+                   'dedup': "false",
+                   'dedup_size': "100000",
+                   'dedup_file': None,
+                   'backend': "inotify",
+                   'poll_interval': "2",
+                   'poll_max_interval': "30",
+                   'poll_stat_rate': None,
+                   'batch_size': None,
+                   'batch_wait': "1",
+                   'batch_stdin': None,
+                   'max_children': None,
+                   'walk_threads': "4",
+                   'max_queued_events': None,
+                   'overflow_rescan': "false",
+                   'state_file': None,
+                   'state_interval': "60",
+                   'metrics': None,
+                   'workers': "1",
+                   'shards': "1",
+                   'shard': None,  # set by shard_config()
+                   'journal': None,
+                   'journal_sync': "0.1",
+                   'journal_segment_size': "4194304",
+                   'max_attempts': "1",
+                   'mode': "exec",
+                   'pool_size': "1",
+                   'handler': None,
+                   'handler_pool': "thread",
+                   'retry_delay': "1",
+                   'retry_max_delay': "300",
+                   'max_concurrency': None,
+                   'queue_size': None,
+                   'queue_policy': "block",
+                   'log_output': "true",
+                   'log_rate': "100",
+                   'output_limit': "65536",
+                   'action_on_success': None,
+                   'action_on_failure': None,
+                   'digest': None,
+                   'digest_size': "1000",
+                   'digest_first': "false",
+                   'outfile': None}
+
+# options of [DEFAULT] only read at startup, a reload does not apply their changes (listed in README.md)
+RESTART_OPTIONS = ('logfile', 'pidfile', 'working_directory', 'umask', 'gid', 'uid', 'engine', 'max_children',
+                   'max_queued_events', 'state_interval', 'metrics', 'workers')
+# options of a job telling what it watches (listed in README.md), and then which files it runs commands for
+# (see `Reloader`)
+WATCH_OPTIONS = ('watch', 'events', 'recursive', 'autoadd', 'excluded', 'excluded_re', 'backend', 'shards', 'shard')
+TREE_OPTIONS = ('include_extensions', 'exclude_extensions', 'include_re', 'exclude_re', 'include_glob',
+                'exclude_glob', 'poll_interval', 'poll_max_interval', 'poll_stat_rate')
+
+
+def read_config(paths):
+    """ Read the config files `paths`, return the config or None if none of them could be read.
+
+        The files read are kept as its `paths` attribute, absolute as the daemon changes
+        its working directory, for reloads.
+        """
+    # python 3 only takes strings as values otherwise
+    config = configparser.ConfigParser(CONFIG_DEFAULTS, allow_no_value=True)
+    config.paths = [os.path.abspath(path) for path in config.read(paths)]
+    return config if config.paths else None
+
+
+def shard_config(config, worker, workers):
+    """ Keep in `config` the jobs run by worker `worker` of `workers`, and return it.
+
+        The jobs, or their shards for those split by 'shards', are spread over
+        the workers in turn, in the order of the config; the shards of a job go
+        to different workers. A shard gets the 'shard' option telling which
+        part of the tree it watches (see `compile_shard`).
+        """
+    unit = 0
+    for section in config.sections():
+        shards = min(max(config.getint(section, 'shards'), 1), workers)
+        if shards > 1 and not config.getboolean(section, 'recursive'):
+            if worker == 0:
+                logger.warning("%s: only recursive jobs can be split into shards", section)
+            shards = 1
+        mine = [shard for shard in range(shards) if (unit + shard) % workers == worker]
+        unit += shards
+        if not mine:
+            config.remove_section(section)
+        elif shards > 1:
+            config.set(section, 'shard', str(mine[0]))
+            config.set(section, 'shards', str(shards))
+    return config
+
+
 def init_daemon(cf):
     """Convert config.defaults() OrderedDict to a `dict` to use in daemon initialization
     """
@@ -555,35 +4744,27 @@ if __name__ == "__main__":
                         help='Path to the config file (default: %(default)s)')
     parser.add_argument('command',
                         action='store',
-                        choices=['start', 'stop', 'restart', 'debug'],
+                        choices=['start', 'stop', 'restart', 'reload', 'debug', 'stats'],
                         help='What to do.')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
 
     args = parser.parse_args()
 
     # Parse the config file
-    config = configparser.ConfigParser({'recursive': "true",
-                                        'autoadd': "true",
-                                        'excluded': None,
-                                        'include_extensions': None,
-                                        'exclude_extensions': None,
-                                        'exclude_re': None,
-                                        'background': "false",
-                                        'log_output': "true",
-                                        'action_on_success': None,
-                                        'action_on_failure': None,
-                                        'outfile': None
-                                        })
     if args.config:
         # load config file specified by commandline
-        confok = config.read(args.config)
+        config = read_config(args.config)
     else:
         # load config file from default locations
-        confok = config.read(['/etc/watcher.ini', os.path.expanduser('~/.watcher.ini')])
-    if not confok:
+        config = read_config(['/etc/watcher.ini', os.path.expanduser('~/.watcher.ini')])
+    if config is None:
         sys.stderr.write("Failed to read config file. Try -c parameter\n")
         sys.exit(4)
 
+    if args.command == 'stats':
+        # query the running daemon, without touching its log or pid files
+        sys.exit(query_metrics(config.get('DEFAULT', 'metrics')))
+
     # Initialize logging
     if args.command == 'debug':
         loghandler = logging.StreamHandler()
@@ -596,15 +4777,14 @@ if __name__ == "__main__":
         loghandler.setFormatter(logformatter_debug)
     else:
         loghandler.setFormatter(logformatter)
-    logger.addHandler(loghandler)
+    # written by a thread once the daemon runs, see watcher()
+    logger.addHandler(AsyncLogHandler(loghandler))
 
     # Initialize the daemon
     options = init_daemon(config.defaults())
     options['files_preserve'] = [loghandler.stream]
     options['func_arg'] = config
     daemon = DaemonRunner(watcher, **options)
-    # for background processes polling
-    processes = {}
 
     # Execute the command
     if 'start' == args.command:
@@ -616,6 +4796,8 @@ if __name__ == "__main__":
     elif 'restart' == args.command:
         daemon.restart()
         # logger.info('Daemon restarted')
+    elif 'reload' == args.command:
+        daemon.reload()
     elif 'debug' == args.command:
         logger.warning('Press Control+C to quit...')
         daemon.run()